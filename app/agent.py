@@ -0,0 +1,182 @@
+# app/agent.py
+"""
+Пайплайн одного хода чата: system + инструменты, RAG-контекст, выбор модели (routing), вызов LLM,
+авто-вызов инструмента.
+Используется /chat, /chat/batch, офлайн-раннером (app.batch) и /ws/chat (stream_chat).
+"""
+import re
+import threading
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from .models import Gem, ChatRequest, ChatResponse, Message
+from .tools import run_tool
+from .llm import chat as llm_chat, chat_stream as llm_chat_stream
+from . import kb, stats, tracing, compiled, routing
+
+
+# ищем JSON с экранированными кавычками (часто так отвечает LLM)
+_TOOL_RE = re.compile(r'\{\s*\\"tool\\"\s*:\s*\\"([^\\"]+)\\"\s*,\s*\\"input\\"\s*:\s*\\"([\s\S]*?)\\"\s*\}')
+
+
+def _prepare(
+    messages: List[Message], gem: Gem, tools_mode: str, filters: Optional[Dict],
+) -> Tuple[compiled.CompiledGem, List[Dict[str, str]], bool, int, routing.Decision]:
+    """(скомпилированная gem, convo для LLM, авто-инструменты?, число KB-сниппетов, выбор модели)."""
+    stats.record(gem.id)
+    cg = compiled.get(gem)  # промпт, инструменты, backend/модель — из кэша по хэшу gem
+    auto = tools_mode == "auto" and bool(cg.tools)
+
+    # 1) system + инструменты
+    sys = cg.system_prompt_tools if auto else cg.system_prompt
+
+    convo = [{"role": "system", "content": sys}]
+    for m in messages:
+        convo.append({"role": m.role, "content": m.content})
+
+    # 2) RAG-контекст на основе запроса пользователя
+    n_snips = 0
+    last_user = next((m.content for m in reversed(messages) if m.role == "user"), "")
+    if last_user and kb.has_index(gem.id):
+        with tracing.span("retrieve") as sp:
+            snips = kb.retrieve(gem.id, last_user, **cg.retrieval, filters=filters)
+            sp["snippets"] = n_snips = len(snips)
+        ctx = kb.build_context(snips)
+        if ctx:
+            # даём как system, чтобы LLM опирался на факты
+            convo.append({"role": "system", "content": ctx})
+
+    # 3) простой ход — в малую модель, сложный — в модель gem
+    dec = routing.Decision(routing.LARGE, cg.model, 0.0, ("off",))
+    if cg.small_model is not None:
+        with tracing.span("route") as sp:
+            dec = routing.decide(gem, cg.backend, cg.model, last_user, n_snips, auto, len(messages))
+            sp.update(route=dec.route, score=dec.score)
+    return cg, convo, auto, n_snips, dec
+
+
+def _match_tool(text: str, cg: compiled.CompiledGem) -> Optional[Tuple[str, str]]:
+    m = _TOOL_RE.search(text)
+    if m and m.group(1).strip() in cg.tools:
+        return m.group(1).strip(), m.group(2).strip()
+    return None
+
+
+def _call_tool(convo: List[Dict[str, str]], first: str, tname: str, tinp: str, gem_id: str) -> str:
+    with tracing.span("tool", tool=tname):
+        tool_result = run_tool(tname, tinp, gem_id=gem_id)
+    # feed back: что сказал ассистент и что вернул инструмент
+    convo.append({"role": "assistant", "content": first})
+    convo.append({"role": "tool", "content": f"Tool {tname} result:\n{tool_result}"})
+    return tool_result
+
+
+def run_chat(body: ChatRequest, gem: Gem) -> ChatResponse:
+    filters = body.filters.model_dump() if body.filters else None
+    cg, convo, auto, _, dec = _prepare(body.messages, gem, body.tools_mode, filters)
+    timer = routing.Timer()
+    model, escalated = dec.model, False
+
+    # 4) первый ход модели
+    with timer:
+        first = llm_chat(convo, temperature=gem.temperature, model_override=model, backend=cg.backend)
+
+    # 5) авто-вызов инструмента по JSON {"tool":"...","input":"..."}
+    call = _match_tool(first, cg) if auto else None
+    if dec.route == routing.SMALL and routing.needs_escalation(first, auto, call is not None):
+        model, escalated = cg.model, True
+        with timer:
+            first = llm_chat(convo, temperature=gem.temperature, model_override=model, backend=cg.backend)
+        call = _match_tool(first, cg) if auto else None
+    route = routing.LARGE if escalated else dec.route
+
+    if call:
+        tname, tinp = call
+        _call_tool(convo, first, tname, tinp, gem.id)
+        with timer:
+            final = llm_chat(convo, temperature=gem.temperature, model_override=model, backend=cg.backend)
+        routing.record(gem.id, route, timer.ms, escalated)
+        return ChatResponse(content=final, used_tool=tname, tool_input=tinp)
+
+    # 6) без инструмента — сразу отдаём ответ
+    routing.record(gem.id, route, timer.ms, escalated)
+    return ChatResponse(content=first)
+
+
+def stream_chat(
+    messages: List[Message],
+    gem: Gem,
+    tools_mode: str = "auto",
+    filters: Optional[Dict] = None,
+    cancel: Optional[threading.Event] = None,
+) -> Iterator[Dict]:
+    """
+    Тот же ход, но событиями для WebSocket:
+    {"type": "context"} → {"type": "token"}* → [{"type": "tool_call"}, {"type": "tool_result"}, {"type": "token"}*]
+    → {"type": "done"} или {"type": "cancelled"} (cancel.set() обрывает генерацию у бэкенда).
+    """
+    cancel = cancel or threading.Event()
+    cg, convo, auto, n_snips, dec = _prepare(messages, gem, tools_mode, filters)
+    yield {"type": "context", "snippets": n_snips}
+    timer = routing.Timer()
+    model, escalated = dec.model, False
+
+    def _gen(text: List[str], hold_tool_json: bool) -> Iterator[Dict]:
+        # ответ, начинающийся с "{", может оказаться вызовом инструмента — его не стримим, а копим
+        held = hold_tool_json
+        for piece in llm_chat_stream(convo, temperature=gem.temperature, model_override=model,
+                                     backend=cg.backend, cancel=cancel):
+            text.append(piece)
+            if held:
+                head = "".join(text).lstrip()
+                if not head or head.startswith("{"):
+                    continue
+                held = False
+                yield {"type": "token", "text": "".join(text)}
+                continue
+            yield {"type": "token", "text": piece}
+
+    first: List[str] = []
+    with timer:
+        yield from _gen(first, hold_tool_json=auto)
+    first_text = "".join(first)
+    if cancel.is_set():
+        yield {"type": "cancelled", "content": first_text}
+        return
+
+    call = _match_tool(first_text, cg) if auto else None
+    # пустой ответ или удержанный JSON ещё не ушли клиенту — можно тихо переспросить большую модель
+    if dec.route == routing.SMALL and routing.needs_escalation(first_text, auto, call is not None):
+        model, escalated, first = cg.model, True, []
+        with timer:
+            yield from _gen(first, hold_tool_json=auto)
+        first_text = "".join(first)
+        if cancel.is_set():
+            yield {"type": "cancelled", "content": first_text}
+            return
+        call = _match_tool(first_text, cg) if auto else None
+    route = routing.LARGE if escalated else dec.route
+
+    if call is None:
+        routing.record(gem.id, route, timer.ms, escalated)
+        if auto and first_text.lstrip().startswith("{"):
+            yield {"type": "token", "text": first_text}  # JSON, но не вызов инструмента
+        yield {"type": "done", "content": first_text, "used_tool": None, "tool_input": None}
+        return
+
+    tname, tinp = call
+    yield {"type": "tool_call", "tool": tname, "input": tinp}
+    result = _call_tool(convo, first_text, tname, tinp, gem.id)
+    yield {"type": "tool_result", "tool": tname, "content": result}
+    if cancel.is_set():
+        yield {"type": "cancelled", "content": ""}
+        return
+
+    final: List[str] = []
+    with timer:
+        yield from _gen(final, hold_tool_json=False)
+    final_text = "".join(final)
+    if cancel.is_set():
+        yield {"type": "cancelled", "content": final_text}
+        return
+    routing.record(gem.id, route, timer.ms, escalated)
+    yield {"type": "done", "content": final_text, "used_tool": tname, "tool_input": tinp}
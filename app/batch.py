@@ -0,0 +1,138 @@
+# app/batch.py
+"""
+Пакетный прогон ChatRequest'ов (JSONL) — для /chat/batch и офлайн-раннера.
+- ограниченная параллельность: в полёте не больше concurrency запросов, вход читается по мере освобождения мест,
+  так что JSONL не держится в памяти целиком, а брошенный клиентом батч не продолжает ходить в LLM;
+- KB-индекс каждой gem поднимается один раз, при первом её запросе;
+- результаты отдаются JSONL в порядке завершения, с latency_ms на элемент.
+
+CLI:
+    python -m app.batch input.jsonl -o results.jsonl -c 8 [--resume]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from pydantic import ValidationError
+
+from .models import ChatRequest
+from . import store, kb, agent, tracing
+
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "4"))
+
+Item = Tuple[str, Optional[ChatRequest], Optional[str]]  # (id, запрос, ошибка разбора)
+
+
+def parse_jsonl(lines: Iterable[str]) -> Iterator[Item]:
+    """Строка — ChatRequest; необязательное поле "id", иначе id = номер строки."""
+    for n, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        key = str(n)
+        try:
+            obj = json.loads(line)
+            if isinstance(obj, dict) and obj.get("id") is not None:
+                key = str(obj["id"])  # и для ошибки валидации: клиент сопоставляет ответ со своим id
+            yield key, ChatRequest.model_validate(obj), None
+        except (json.JSONDecodeError, ValidationError) as e:
+            yield key, None, f"Invalid request: {e}"
+
+
+def run_batch(items: Iterable[Item], concurrency: int = BATCH_CONCURRENCY) -> Iterator[Dict]:
+    """
+    items читаются лениво. Закрытие генератора (клиент /chat/batch отключился) отменяет ещё не начатые
+    запросы и не ждёт уже идущих.
+    """
+    gems = {g.id: g for g in store.load_all()}
+    preloaded: Set[str] = set()
+    window = max(1, concurrency)
+
+    def _one(key: str, req: ChatRequest) -> Dict:
+        t = time.perf_counter()
+        try:
+            resp = agent.run_chat(req, gems[req.gem_id])
+            out = {"id": key, "gem_id": req.gem_id, "ok": True, "response": resp.model_dump()}
+        except Exception as e:
+            out = {"id": key, "gem_id": req.gem_id, "ok": False, "error": str(e)}
+        out["latency_ms"] = round((time.perf_counter() - t) * 1000, 1)
+        return out
+
+    pool = ThreadPoolExecutor(max_workers=window)
+    inflight: Set[Future] = set()
+    finished = False
+    try:
+        for key, req, err in items:
+            if err:
+                yield {"id": key, "ok": False, "error": err, "latency_ms": 0.0}
+                continue
+            if req.gem_id not in gems:
+                yield {"id": key, "gem_id": req.gem_id, "ok": False, "error": "Gem not found", "latency_ms": 0.0}
+                continue
+            if req.gem_id not in preloaded:
+                preloaded.add(req.gem_id)
+                kb.preload(req.gem_id)
+            inflight.add(pool.submit(tracing.bind(_one), key, req))
+            if len(inflight) >= window:
+                done, inflight = wait(inflight, return_when=FIRST_COMPLETED)
+                for f in done:
+                    yield f.result()
+        while inflight:
+            done, inflight = wait(inflight, return_when=FIRST_COMPLETED)
+            for f in done:
+                yield f.result()
+        finished = True
+    finally:
+        # GeneratorExit: не ждём брошенный батч, очередь отменяется, идущие запросы дорабатывают сами
+        pool.shutdown(wait=finished, cancel_futures=not finished)
+
+
+def _done_ids(path: str) -> Set[str]:
+    # чекпоинт = уже записанные успешные результаты; упавшие при --resume повторяются
+    done: Set[str] = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                row = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # недописанная строка после обрыва
+            if row.get("ok"):
+                done.add(str(row.get("id")))
+    return done
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    ap = argparse.ArgumentParser(description="Batch-прогон ChatRequest'ов из JSONL")
+    ap.add_argument("input", help="JSONL с ChatRequest (по одному на строку)")
+    ap.add_argument("-o", "--output", default="batch_results.jsonl")
+    ap.add_argument("-c", "--concurrency", type=int, default=BATCH_CONCURRENCY)
+    ap.add_argument("--resume", action="store_true", help="пропустить id, уже успешно записанные в output")
+    args = ap.parse_args(argv)
+
+    done = _done_ids(args.output) if args.resume else set()
+
+    t0 = time.perf_counter()
+    ok = failed = 0
+    with open(args.input, "r", encoding="utf-8") as f, \
+            open(args.output, "a" if args.resume else "w", encoding="utf-8") as out:
+        items = (it for it in parse_jsonl(f) if it[0] not in done)
+        for row in run_batch(items, args.concurrency):
+            out.write(json.dumps(row, ensure_ascii=False) + "\n")
+            out.flush()
+            ok += bool(row.get("ok"))
+            failed += not row.get("ok")
+    print(
+        f"done: {ok} ok, {failed} failed, {len(done)} skipped in {time.perf_counter() - t0:.1f}s",
+        file=sys.stderr,
+    )
+    return 0 if failed == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,214 @@
+# app/bulk.py
+"""
+Массовая загрузка KB из архива zip/tar(.gz/.bz2/.xz) — POST /gems/{id}/archive.
+- архив спулится во временный файл (не в память), члены читаются по одному, на диск не распаковываются;
+- извлечение текста (PDF) и нарезка на чанки — в пуле процессов (KB_ARCHIVE_WORKERS ядер),
+  в полёте не больше 2 x workers членов, так что память ограничена, а не растёт с архивом;
+- нарезанные члены копятся в группу до KB_ARCHIVE_GROUP_CHUNKS чанков; группа эмбеддится
+  (пачками, параллельно — см. kb.KB_EMBED_BATCH) в отдельном потоке, пока читаются и режутся следующие;
+- весь архив — одна сессия kb.ingest_session: одно новое поколение индекса в конце;
+- ход работы — события NDJSON: member (queued/indexed/unchanged/skipped/error), group, done/error.
+
+KB_ARCHIVE_WORKERS=0 — без процессов (нарезка в потоке).
+"""
+from __future__ import annotations
+import io
+import os
+import queue
+import tarfile
+import threading
+import time
+import zipfile
+from collections import deque
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import PurePosixPath
+from typing import IO, Callable, Deque, Dict, Iterator, List, Optional, Tuple
+
+from . import kb, startup, store, tracing
+from .chunker import iter_chunks
+from .models import Gem
+
+KB_ARCHIVE_WORKERS = int(os.getenv("KB_ARCHIVE_WORKERS", str(min(4, os.cpu_count() or 1))))
+KB_ARCHIVE_GROUP_CHUNKS = int(os.getenv("KB_ARCHIVE_GROUP_CHUNKS", "512"))
+KB_ARCHIVE_MAX_MEMBER_MB = float(os.getenv("KB_ARCHIVE_MAX_MEMBER_MB", "64"))
+KB_ARCHIVE_EXT = {e.strip().lower() for e in os.getenv("KB_ARCHIVE_EXT", kb.DOC_EXT).split(",") if e.strip()}
+
+_pool: Optional[Executor] = None
+_pool_lock = threading.Lock()
+
+
+def extract_chunks(name: str, data: bytes, chunk_tokens: int, chunk_overlap: int) -> List[str]:
+    """Текст -> чанки; выполняется в процессе пула, поэтому только из байтов и без состояния kb."""
+    if name.lower().endswith(".pdf"):
+        reader = startup.lazy("pypdf").PdfReader(io.BytesIO(data))
+        pages = (p.extract_text() or "" for p in reader.pages)
+    else:
+        pages = iter([data.decode("utf-8", errors="ignore")])
+    return list(iter_chunks(pages, chunk_tokens, chunk_overlap))
+
+
+def _executor() -> Executor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            if KB_ARCHIVE_WORKERS > 0:
+                import multiprocessing
+                # spawn, а не fork: воркер uvicorn многопоточный, fork копировал бы чужие блокировки
+                _pool = ProcessPoolExecutor(KB_ARCHIVE_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+            else:
+                _pool = ThreadPoolExecutor(1, thread_name_prefix="chunk")
+    return _pool
+
+
+def shutdown() -> None:
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None
+
+
+# ---------- чтение архива ----------
+
+def _member_name(path: str) -> Optional[str]:
+    """Имя в KB для пути члена архива; None — пропустить (каталоги, скрытые, ../, чужие расширения)."""
+    parts = PurePosixPath(path.replace("\\", "/")).parts
+    if not parts or any(p in ("..", "") or p.startswith(".") or p == "__MACOSX" for p in parts):
+        return None
+    if parts[0] == "/" or PurePosixPath(parts[-1]).suffix.lower() not in KB_ARCHIVE_EXT:
+        return None
+    return kb.flat_name("/".join(parts))
+
+
+def open_archive(fh: IO[bytes]) -> Iterator[Tuple[str, Optional[str], Optional[bytes]]]:
+    """
+    Итератор (путь, имя в KB | None, байты | None) по членам. ValueError — не zip и не tar.
+    Формат определяется сразу, до первого next(), чтобы эндпоинт ответил 400, а не пустым стримом.
+    """
+    limit = int(KB_ARCHIVE_MAX_MEMBER_MB * 1024 * 1024)
+    if zipfile.is_zipfile(fh):
+        fh.seek(0)
+        zf = zipfile.ZipFile(fh)
+
+        def zip_members():
+            with zf:
+                for info in zf.infolist():
+                    if info.is_dir():
+                        continue
+                    name = _member_name(info.filename)
+                    ok = name is not None and info.file_size <= limit
+                    yield info.filename, name if ok else None, zf.read(info) if ok else None
+        return zip_members()
+    fh.seek(0)
+    try:
+        tar = tarfile.open(fileobj=fh, mode="r|*")
+    except tarfile.TarError:
+        raise ValueError("Expected a zip or tar archive")
+
+    def tar_members():
+        with tar:
+            for m in tar:
+                if not m.isfile():
+                    continue
+                name = _member_name(m.name)
+                ok = name is not None and m.size <= limit
+                yield m.name, name if ok else None, tar.extractfile(m).read() if ok else None
+    return tar_members()
+
+
+# ---------- конвейер ----------
+
+def _run(gem: Gem, members, tags: List[str], emit: Callable[[Dict], None]) -> Dict:
+    pool = _executor()
+    limit = max(2, 2 * max(1, KB_ARCHIVE_WORKERS))
+    inflight: Deque[Tuple[str, str, bytes, Future]] = deque()
+    group: List[Tuple[str, str, bytes, List[str]]] = []
+    group_chunks = 0
+    stats = {"members": 0, "skipped": 0, "errors": 0, "groups": 0}
+
+    with kb.ingest_session(
+        gem.id, chunk_tokens=gem.chunk_tokens, chunk_overlap=gem.chunk_overlap, quantization=gem.quantization,
+        tags=tags, projection=gem.projection, projection_dim=gem.projection_dim,
+    ) as sess, ThreadPoolExecutor(1, thread_name_prefix="bulk-embed") as committer:
+        pending: Optional[Future] = None
+
+        def commit(items: List[Tuple[str, str, bytes, List[str]]]) -> None:
+            # эмбеддинг и запись группы; сессию трогает только этот поток
+            info = sess.add([(name, data) for _, name, data, _ in items], {name: ch for _, name, _, ch in items})
+            unchanged = set(info["unchanged"])
+            for path, name, _, ch in items:
+                emit({"event": "member", "path": path, "name": name,
+                      "status": "unchanged" if name in unchanged else "indexed", "chunks": len(ch)})
+            emit({"event": "group", "files": len(items), "added": info["added"], "embedded": info["embedded"]})
+
+        def flush() -> None:
+            nonlocal pending, group, group_chunks
+            if pending is not None:
+                pending.result()  # одна группа в полёте: порядок строк и ограниченная память
+            pending = committer.submit(tracing.bind(commit), group) if group else None
+            stats["groups"] += bool(group)
+            group, group_chunks = [], 0
+
+        def drain() -> None:
+            nonlocal group_chunks
+            path, name, data, fut = inflight.popleft()
+            try:
+                chunks = fut.result()
+            except Exception as e:
+                if isinstance(e, BrokenProcessPool):
+                    shutdown()  # упавший воркер ломает весь пул: следующая загрузка создаст новый
+                stats["errors"] += 1
+                emit({"event": "member", "path": path, "name": name, "status": "error", "error": str(e)})
+                return
+            group.append((path, name, data, chunks))
+            group_chunks += len(chunks)
+            if group_chunks >= KB_ARCHIVE_GROUP_CHUNKS:
+                flush()
+
+        for path, name, data in members:
+            if name is None:
+                stats["skipped"] += 1
+                emit({"event": "member", "path": path, "status": "skipped"})
+                continue
+            stats["members"] += 1
+            emit({"event": "member", "path": path, "name": name, "status": "queued", "bytes": len(data)})
+            fut = pool.submit(extract_chunks, name, data, gem.chunk_tokens, gem.chunk_overlap)
+            inflight.append((path, name, data, fut))
+            while len(inflight) >= limit:
+                drain()
+        while inflight:
+            drain()
+        flush()
+        if pending is not None:
+            pending.result()
+    return {**stats, **sess.info}
+
+
+def ingest_archive(gem: Gem, members, tags: Optional[List[str]] = None, on_close: Optional[Callable] = None) -> Iterator[Dict]:
+    """
+    События загрузки архива. Конвейер идёт в своём потоке (блокировка записи kb привязана к потоку),
+    генератор только отдаёт события; если клиент отключился — загрузка всё равно доводится до конца.
+    """
+    events: "queue.Queue[Optional[Dict]]" = queue.Queue()
+    t0 = time.perf_counter()
+
+    def work():
+        try:
+            info = _run(gem, members, tags or [], events.put)
+            if info["files"] and "kb_search" not in (gem.tools or []):
+                store.update_gem(gem.id, {"tools": (gem.tools or []) + ["kb_search"]})
+            events.put({"event": "done", "ms": round((time.perf_counter() - t0) * 1000, 1), **info})
+        except Exception as e:
+            events.put({"event": "error", "error": str(e)})
+        finally:
+            if on_close is not None:
+                on_close()
+            events.put(None)
+
+    threading.Thread(target=tracing.bind(work), name="bulk-ingest", daemon=True).start()
+    while True:
+        ev = events.get()
+        if ev is None:
+            return
+        yield ev
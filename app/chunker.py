@@ -0,0 +1,157 @@
+# app/chunker.py
+"""
+Структурный чанкер для KB.
+- Режет по абзацам/заголовкам, длинные абзацы — по предложениям, длинные предложения — по словам.
+- Размер и перекрытие считаются в оценочных токенах, а не в словах.
+- Работает потоково: на вход — итератор страниц, на выход — итератор чанков.
+"""
+from __future__ import annotations
+import re
+from typing import Iterable, Iterator, List, Tuple
+
+DEFAULT_CHUNK_TOKENS = 400
+DEFAULT_CHUNK_OVERLAP = 60
+
+_PARA_RE = re.compile(r"\n\s*\n")
+_SENT_RE = re.compile(r"(?<=[.!?…])\s+(?=[\"'«(\[]?[A-ZА-ЯЁ0-9])")
+# нумерованный заголовок — только многоуровневый ("2.1 Обзор"): "3. Шаг" — пункт списка, а не раздел
+_HEADING_RE = re.compile(r"^(#{1,6}\s+\S.*|\d+(\.\d+)+\.?\s+[^\s.].{0,80}|[A-ZА-ЯЁ0-9][A-ZА-ЯЁ0-9 \-:,]{2,80})$")
+
+
+def estimate_tokens(s: str) -> int:
+    """Грубая оценка: ~4 ASCII-символа или ~2 не-ASCII символа (кириллица) на токен."""
+    if not s:
+        return 0
+    ascii_n = len(s.encode("ascii", "ignore"))
+    return max(1, (ascii_n + 3) // 4 + (len(s) - ascii_n + 1) // 2)
+
+
+def _is_heading(block: str) -> bool:
+    return "\n" not in block and len(block) <= 100 and bool(_HEADING_RE.match(block))
+
+
+def _split_long(text: str, max_tokens: int) -> List[str]:
+    # предложения; если и предложение слишком длинное — окна по словам
+    out: List[str] = []
+    for sent in _SENT_RE.split(text):
+        sent = sent.strip()
+        if not sent:
+            continue
+        if estimate_tokens(sent) <= max_tokens:
+            out.append(sent)
+            continue
+        cur: List[str] = []
+        cur_t = 0
+        for w in sent.split():
+            wt = estimate_tokens(w) + 1
+            if cur and cur_t + wt > max_tokens:
+                out.append(" ".join(cur))
+                cur, cur_t = [], 0
+            cur.append(w)
+            cur_t += wt
+        if cur:
+            out.append(" ".join(cur))
+    return out
+
+
+def _units(pages: Iterable[str], max_tokens: int) -> Iterator[Tuple[str, str, int]]:
+    """(kind, text, tokens), kind: heading | para | sent."""
+    for page in pages:
+        if not page:
+            continue
+        for block in _PARA_RE.split(page):
+            block = re.sub(r"[ \t]*\n[ \t]*", "\n", block.strip())
+            if not block:
+                continue
+            if _is_heading(block) and estimate_tokens(block) <= max_tokens // 4:
+                yield "heading", block, estimate_tokens(block)
+                continue
+            block = re.sub(r"\s+", " ", block)
+            t = estimate_tokens(block)
+            if t <= max_tokens:
+                yield "para", block, t
+            else:
+                for i, s in enumerate(_split_long(block, max_tokens)):
+                    yield ("para" if i == 0 else "sent"), s, estimate_tokens(s)
+
+
+def _join(units: List[Tuple[str, str, int]]) -> str:
+    parts: List[str] = []
+    for kind, text, _ in units:
+        if parts:
+            parts.append(" " if kind == "sent" else "\n\n")
+        parts.append(text)
+    return "".join(parts)
+
+
+def iter_chunks(
+    pages: Iterable[str],
+    max_tokens: int = DEFAULT_CHUNK_TOKENS,
+    overlap_tokens: int = DEFAULT_CHUNK_OVERLAP,
+) -> Iterator[str]:
+    """
+    Упаковывает структурные единицы в чанки не больше max_tokens.
+    Перекрытие — хвостовые предложения/абзацы предыдущего чанка (не больше overlap_tokens).
+    Заголовок всегда открывает новый чанк и приклеивается к следующему тексту; цепочка заголовков
+    длиннее max_tokens // 2 (оглавление, список подзаголовков) выдаётся как обычный текст, а не копится.
+    """
+    max_tokens = max(16, int(max_tokens))
+    overlap_tokens = max(0, min(int(overlap_tokens), max_tokens // 2))
+    heading_budget = max_tokens // 2
+
+    cur: List[Tuple[str, str, int]] = []
+    cur_t = 0
+    fresh = False  # есть ли в cur что-то кроме перекрытия
+
+    for kind, text, t in _units(pages, max_tokens):
+        t += 1  # разделитель при склейке: у списка из коротких пунктов он заметен в бюджете
+        unit = (kind, text, t)
+        if kind == "heading":
+            if fresh:
+                yield _join(cur)
+                cur = []
+            # подряд идущие заголовки копим, перекрытие перед заголовком не нужно
+            cur = [u for u in cur if u[0] == "heading"]
+            cur_t = sum(u[2] for u in cur)
+            if cur and cur_t + t > heading_budget:
+                yield _join(cur)
+                cur, cur_t = [], 0
+            cur.append(unit)
+            cur_t += t
+            fresh = False
+            continue
+        if fresh and cur_t + t > max_tokens:
+            yield _join(cur)
+            tail: List[Tuple[str, str, int]] = []
+            tail_t = 0
+            for u in reversed(cur):
+                if u[0] == "heading" or tail_t + u[2] > overlap_tokens or tail_t + u[2] + t > max_tokens:
+                    break
+                tail.insert(0, u)
+                tail_t += u[2]
+            cur, cur_t = tail, tail_t
+        elif not fresh and cur_t + t > max_tokens:
+            # заголовок/перекрытие + длинный абзац не влезают вместе — отбрасываем перекрытие,
+            # а если не влезают и одни заголовки — они уходят отдельным чанком
+            cur = [u for u in cur if u[0] == "heading"]
+            cur_t = sum(u[2] for u in cur)
+            if cur_t + t > max_tokens:
+                if cur:
+                    yield _join(cur)
+                cur, cur_t = [], 0
+        cur.append(unit)
+        cur_t += t
+        fresh = True
+
+    if fresh:
+        yield _join(cur)
+    elif cur:
+        yield _join([u for u in cur if u[0] == "heading"])  # заголовок в конце документа
+
+
+def chunk_text(
+    text: str,
+    max_tokens: int = DEFAULT_CHUNK_TOKENS,
+    overlap_tokens: int = DEFAULT_CHUNK_OVERLAP,
+) -> List[str]:
+    return list(iter_chunks([text], max_tokens, overlap_tokens))
@@ -0,0 +1,128 @@
+# app/chunkstore.py
+"""
+Компактное хранилище текстов чанков KB (замена meta.json).
+
+Формат chunks.bin (little-endian):
+    header   <8sIIQQQ: magic, version, reserved, count, blob_off, tail_off
+    rows     count записей (off u8, len u4, src u4, i u4): смещение/длина текста в блобе,
+             id источника в таблице имён и номер чанка в файле
+    blob     UTF-8 тексты подряд
+    tail     JSON {"sources": [...], "extras": {row: {...}}} — интернированные имена файлов
+             и редкие доп. поля чанков (например, dups)
+
+Файл отображается в память (mmap): запрос декодирует только выбранные строки,
+а status читает число чанков из заголовка.
+"""
+from __future__ import annotations
+import json
+import mmap
+import os
+import struct
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional
+import numpy as np
+
+MAGIC = b"GEMCHNK1"
+VERSION = 1
+_HEADER = struct.Struct("<8sIIQQQ")
+ROW_DTYPE = np.dtype([("off", "<u8"), ("len", "<u4"), ("src", "<u4"), ("i", "<u4")])
+_BASE_KEYS = ("text", "source", "i")
+
+
+def write(path: Path, chunks: Iterable[Dict]) -> int:
+    """Пишет чанки во временный файл и атомарно подменяет path. Возвращает число чанков."""
+    chunks = list(chunks)
+    sources: List[str] = []
+    src_ids: Dict[str, int] = {}
+    extras: Dict[str, Dict] = {}
+    rows = np.zeros(len(chunks), dtype=ROW_DTYPE)
+    blobs: List[bytes] = []
+    off = 0
+    for r, c in enumerate(chunks):
+        data = c["text"].encode("utf-8")
+        sid = src_ids.get(c["source"])
+        if sid is None:
+            sid = src_ids[c["source"]] = len(sources)
+            sources.append(c["source"])
+        rows[r] = (off, len(data), sid, c.get("i") or 0)
+        blobs.append(data)
+        off += len(data)
+        extra = {k: v for k, v in c.items() if k not in _BASE_KEYS}
+        if extra:
+            extras[str(r)] = extra
+
+    blob_off = _HEADER.size + rows.nbytes
+    tail_off = blob_off + off
+    tail = json.dumps({"sources": sources, "extras": extras}, ensure_ascii=False).encode("utf-8")
+
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, "wb") as f:
+        f.write(_HEADER.pack(MAGIC, VERSION, 0, len(chunks), blob_off, tail_off))
+        f.write(rows.tobytes())
+        for b in blobs:
+            f.write(b)
+        f.write(tail)
+    os.replace(tmp, path)
+    return len(chunks)
+
+
+def count(path: Path) -> int:
+    """Число чанков — только заголовок, без чтения текстов."""
+    with open(path, "rb") as f:
+        magic, _, _, n, _, _ = _HEADER.unpack(f.read(_HEADER.size))
+    if magic != MAGIC:
+        raise ValueError(f"Not a chunk store: {path}")
+    return int(n)
+
+
+class ChunkStore:
+    """Ленивый доступ к чанкам по номеру строки; поддерживает len(), [row] и итерацию."""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        with open(self.path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else None
+        if self._mm is None:
+            raise ValueError(f"Empty chunk store: {path}")
+        magic, version, _, n, self._blob_off, self._tail_off = _HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"Unsupported chunk store: {path}")
+        self._n = int(n)
+        self.rows = np.frombuffer(self._mm, dtype=ROW_DTYPE, count=self._n, offset=_HEADER.size)
+        self._tail: Optional[Dict] = None
+
+    def _meta(self) -> Dict:
+        if self._tail is None:
+            self._tail = json.loads(self._mm[self._tail_off:].decode("utf-8"))
+        return self._tail
+
+    @property
+    def sources(self) -> List[str]:
+        return self._meta()["sources"]
+
+    def __len__(self) -> int:
+        return self._n
+
+    def text(self, row: int) -> str:
+        r = self.rows[row]
+        start = self._blob_off + int(r["off"])
+        return self._mm[start:start + int(r["len"])].decode("utf-8")
+
+    def source(self, row: int) -> str:
+        return self.sources[int(self.rows[row]["src"])]
+
+    def __getitem__(self, row: int) -> Dict:
+        if row < 0:
+            row += self._n
+        if not 0 <= row < self._n:
+            raise IndexError(row)
+        r = self.rows[row]
+        item = {"text": self.text(row), "source": self.sources[int(r["src"])], "i": int(r["i"])}
+        extra = self._meta()["extras"].get(str(row))
+        if extra:
+            item.update(extra)
+        return item
+
+    def __iter__(self) -> Iterator[Dict]:
+        for row in range(self._n):
+            yield self[row]
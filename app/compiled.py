@@ -0,0 +1,81 @@
+# app/compiled.py
+"""
+Скомпилированная gem: всё, что /chat раньше собирал заново на каждый запрос.
+- итоговые system-промпты (с инструкцией по инструментам и без неё);
+- набор доступных инструментов;
+- backend/модель, выбранные llm.resolve(), и малая модель для routing="auto" (см. routing);
+- настройки retrieval.
+Кэш ключуется (gem_id, content_hash): правка gem даёт новый хэш, а update_gem/delete_gem
+ещё и явно сбрасывают старую запись (store.on_change).
+"""
+from __future__ import annotations
+import threading
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+
+from .models import Gem
+from .tools import TOOLS
+from . import llm, routing, store
+
+TOOLS_INSTRUCTION = (
+    "You have access to the following tools: {tools}.\n"
+    "When you want to call a tool, reply with ONLY this JSON (no extra text):\n"
+    "{{\"tool\":\"<tool_name>\",\"input\":\"<text>\"}}\n"
+    "After the tool result is provided, produce a concise final answer for the user.\n"
+)
+
+
+@dataclass(frozen=True)
+class CompiledGem:
+    gem: Gem
+    hash: str
+    system_prompt: str         # tools_mode="off" или инструментов нет
+    system_prompt_tools: str   # tools_mode="auto"
+    tools: Tuple[str, ...]
+    backend: str
+    model: str
+    small_model: Optional[str]  # None — маршрутизация выключена
+    retrieval: Dict
+
+
+_cache: Dict[str, CompiledGem] = {}
+_lock = threading.Lock()
+
+
+def compile_gem(gem: Gem, h: str) -> CompiledGem:
+    # неизвестные реестру инструменты отбрасываем — модель не должна их видеть
+    tools = tuple(t for t in gem.tools if t in TOOLS)
+    sys_tools = gem.system_prompt
+    if tools:
+        sys_tools += "\n\n" + TOOLS_INSTRUCTION.format(tools=", ".join(tools))
+    backend, model = llm.resolve(gem.model)
+    return CompiledGem(
+        gem=gem,
+        hash=h,
+        system_prompt=gem.system_prompt,
+        system_prompt_tools=sys_tools,
+        tools=tools,
+        backend=backend,
+        model=model,
+        small_model=routing.small_model(gem, backend),
+        retrieval={"budget_tokens": gem.context_tokens, "min_score": gem.min_score},
+    )
+
+
+def get(gem: Gem) -> CompiledGem:
+    h = store.gem_hash(gem)
+    cg = _cache.get(gem.id)
+    if cg is not None and cg.hash == h:
+        return cg
+    cg = compile_gem(gem, h)
+    with _lock:
+        _cache[gem.id] = cg
+    return cg
+
+
+def invalidate(gem_id: str) -> None:
+    with _lock:
+        _cache.pop(gem_id, None)
+
+
+store.on_change(invalidate)
@@ -0,0 +1,84 @@
+# app/dedup.py
+"""
+Поиск почти-дубликатов чанков при загрузке в KB: MinHash + LSH-бэндинг.
+- сигнатура: 128 min-хэшей по словесным 5-граммам (multiply-shift хэши);
+- LSH: 16 полос по 8 строк, кандидаты проверяются оценкой Жаккара >= KB_DEDUP_THRESHOLD.
+Режимы (KB_DEDUP): link — дубликат не индексируется, а привязывается к исходному чанку;
+drop — просто отбрасывается; off — без дедупликации.
+"""
+from __future__ import annotations
+import os
+import re
+import zlib
+from typing import Dict, Iterable, List, Optional, Set
+import numpy as np
+
+NUM_PERM = 128
+BANDS = 16
+ROWS = NUM_PERM // BANDS
+SHINGLE = 5
+
+DEDUP_MODE = os.getenv("KB_DEDUP", "link").lower()
+THRESHOLD = float(os.getenv("KB_DEDUP_THRESHOLD", "0.85"))
+
+_rng = np.random.default_rng(0x6E3D)
+_A = _rng.integers(1, 2**63, NUM_PERM, dtype=np.uint64) | np.uint64(1)
+_B = _rng.integers(0, 2**63, NUM_PERM, dtype=np.uint64)
+_WORD_RE = re.compile(r"\w+")
+
+
+def _shingles(text: str) -> np.ndarray:
+    words = _WORD_RE.findall(text.lower())
+    if len(words) <= SHINGLE:
+        grams = {" ".join(words)}
+    else:
+        grams = {" ".join(words[i:i + SHINGLE]) for i in range(len(words) - SHINGLE + 1)}
+    return np.fromiter((zlib.crc32(g.encode("utf-8")) for g in grams), dtype=np.uint64, count=len(grams))
+
+
+def signature(text: str) -> np.ndarray:
+    sh = _shingles(text)
+    # (a * x + b) mod 2^64, старшие 32 бита — multiply-shift; переполнение uint64 здесь и нужно
+    with np.errstate(over="ignore"):
+        h = (_A[:, None] * sh[None, :] + _B[:, None]) >> np.uint64(32)
+    return h.min(axis=1).astype(np.uint32)
+
+
+def signatures(texts: Iterable[str]) -> np.ndarray:
+    sigs = [signature(t) for t in texts]
+    return np.stack(sigs) if sigs else np.zeros((0, NUM_PERM), dtype=np.uint32)
+
+
+def similarity(a: np.ndarray, b: np.ndarray) -> float:
+    """Оценка коэффициента Жаккара по доле совпавших min-хэшей."""
+    return float(np.mean(a == b))
+
+
+class LSHIndex:
+    """LSH по строкам индекса KB; удалённые строки просто исключаются при поиске."""
+
+    def __init__(self) -> None:
+        self._buckets: List[Dict[bytes, List[int]]] = [{} for _ in range(BANDS)]
+        self._sigs: Dict[int, np.ndarray] = {}
+        self._dead: Set[int] = set()
+
+    def add(self, row: int, sig: np.ndarray) -> None:
+        self._sigs[row] = sig
+        for band in range(BANDS):
+            key = sig[band * ROWS:(band + 1) * ROWS].tobytes()
+            self._buckets[band].setdefault(key, []).append(row)
+
+    def remove(self, rows: Iterable[int]) -> None:
+        self._dead.update(rows)
+
+    def find(self, sig: np.ndarray, threshold: float = THRESHOLD) -> Optional[int]:
+        """Самая похожая живая строка с оценкой Жаккара >= threshold."""
+        cands: Set[int] = set()
+        for band in range(BANDS):
+            cands.update(self._buckets[band].get(sig[band * ROWS:(band + 1) * ROWS].tobytes(), ()))
+        best, best_sim = None, threshold
+        for row in cands - self._dead:
+            sim = similarity(self._sigs[row], sig)
+            if sim >= best_sim:
+                best, best_sim = row, sim
+        return best
@@ -0,0 +1,69 @@
+# app/httpcache.py
+"""
+Условные GET и быстрая сериализация для «тяжёлых» ответов UI (/gems, /templates, /manage).
+- dumps(): orjson, если установлен, иначе json (одинаковый JSON на выходе);
+- Cached: готовое тело + ETag, считаются один раз на поколение данных;
+- respond(): 304 при совпадении If-None-Match, иначе тело с ETag и Cache-Control: no-cache
+  (браузер кэширует, но каждый раз ревалидирует).
+"""
+from __future__ import annotations
+import hashlib
+import json
+import threading
+from typing import Any, Callable, Dict, Hashable, Optional
+
+from fastapi import Request
+from fastapi.responses import Response
+
+try:
+    import orjson  # необязательная зависимость: в разы быстрее json.dumps на списках моделей
+except ImportError:  # pragma: no cover
+    orjson = None
+
+
+def dumps(obj: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+class Cached:
+    def __init__(self, body: bytes, media_type: str = "application/json", etag: Optional[str] = None):
+        self.body = body
+        self.media_type = media_type
+        self.etag = f'"{etag or hashlib.sha256(body).hexdigest()[:16]}"'
+
+
+def _matches(request: Request, etag: str) -> bool:
+    inm = request.headers.get("if-none-match")
+    if not inm:
+        return False
+    tags = {t.strip().removeprefix("W/") for t in inm.split(",")}
+    return "*" in tags or etag in tags
+
+
+def respond(request: Request, cached: Cached, headers: Optional[Dict[str, str]] = None) -> Response:
+    h = {"ETag": cached.etag, "Cache-Control": "no-cache", **(headers or {})}
+    if _matches(request, cached.etag):
+        return Response(status_code=304, headers=h)
+    return Response(content=cached.body, media_type=cached.media_type, headers=h)
+
+
+class Memo:
+    """Готовые тела по ключу поколения: пересобираем, только когда данные изменились."""
+
+    def __init__(self, size: int = 64):
+        self._size = size
+        self._items: Dict[Hashable, Cached] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, build: Callable[[], Cached]) -> Cached:
+        hit = self._items.get(key)
+        if hit is not None:
+            return hit
+        val = build()
+        with self._lock:
+            if len(self._items) >= self._size:
+                self._items.pop(next(iter(self._items)))
+            self._items[key] = val
+        return val
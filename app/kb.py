@@ -1,106 +1,1057 @@
 # app/kb.py
 from __future__ import annotations
+from collections import OrderedDict
 from pathlib import Path
-from typing import List, Dict
-import json, numpy as np
-from pypdf import PdfReader
-from .llm import embed
+from typing import List, Dict, Iterator, Optional, Sequence, Tuple
+import hashlib, json, os, shutil, threading, time
+from contextlib import contextmanager
+try:
+    import fcntl  # межпроцессная блокировка записи (POSIX)
+except ImportError:  # pragma: no cover - Windows
+    fcntl = None
+from . import startup, tracing, qcache
+from .llm import embed, embed_identity
+from .chunker import iter_chunks, DEFAULT_CHUNK_TOKENS, DEFAULT_CHUNK_OVERLAP
+from .packing import mmr, pack, DEFAULT_CONTEXT_TOKENS, DEFAULT_MIN_SCORE, FETCH_K, MMR_LAMBDA
 
 BASE = Path(__file__).resolve().parent.parent / "data"
 
+# numpy/pypdf и векторный код грузим при первой операции с KB, а не при старте воркера
+def _np():
+    return startup.lazy("numpy")
+
+def _quant():
+    return startup.lazy(f"{__package__}.quant")
+
+def _dedup():
+    return startup.lazy(f"{__package__}.dedup")
+
+def _chunkstore():
+    return startup.lazy(f"{__package__}.chunkstore")
+
+def _proj():
+    return startup.lazy(f"{__package__}.projection")
+
+CHUNKS = "chunks.bin"
+LEGACY_META = "meta.json"
+DOC_EXT = ".txt,.md,.markdown,.rst,.pdf,.html,.htm,.csv,.json"  # что брать из каталогов и архивов
+
+# эмбеддинг новых чанков пачками по KB_EMBED_BATCH, до KB_EMBED_CONCURRENCY запросов параллельно
+KB_EMBED_BATCH = int(os.getenv("KB_EMBED_BATCH", "64"))
+KB_EMBED_CONCURRENCY = int(os.getenv("KB_EMBED_CONCURRENCY", "4"))
+
+# Опубликованные поколения индекса: data/<gem>/idx/<gen>/{*.npy, chunks.bin, manifest.json, postings.json},
+# номер текущего — в idx/CURRENT (подменяется атомарно). Массивы — несжатые .npy, открываются mmap'ом
+# только на чтение: воркеры uvicorn делят одну копию в page cache ОС, а не грузят по копии на процесс.
+INDEX_DIR = "idx"
+CURRENT = "CURRENT"
+KB_KEEP_GENERATIONS = max(2, int(os.getenv("KB_KEEP_GENERATIONS", "2")))
+
+# кэш загруженных индексов в процессе: gem_id -> (поколение/подпись файлов, meta, arrays, postings)
+KB_CACHE_GEMS = int(os.getenv("KB_CACHE_GEMS", "8"))
+_index_cache: "OrderedDict[str, Tuple[tuple, List[Dict], Dict, Dict]]" = OrderedDict()
+_index_lock = threading.Lock()
+
 def _gem_dir(gem_id: str) -> Path:
     d = BASE / gem_id
     d.mkdir(parents=True, exist_ok=True)
     return d
 
-def _read_text(path: Path) -> str:
+def _iter_pages(path: Path) -> Iterator[str]:
+    # PDF отдаём постранично, чтобы чанкер не держал весь документ в памяти
     if path.suffix.lower() == ".pdf":
         try:
-            r = PdfReader(str(path))
-            return "\n\n".join([p.extract_text() or "" for p in r.pages])
+            r = startup.lazy("pypdf").PdfReader(str(path))
+            for p in r.pages:
+                yield p.extract_text() or ""
         except Exception:
-            return ""
+            return
+        return
     # txt/md/etc
     try:
-        return path.read_text(encoding="utf-8", errors="ignore")
+        yield path.read_text(encoding="utf-8", errors="ignore")
     except Exception:
-        return ""
+        return
 
-def _chunk(text: str, size: int = 800, overlap: int = 150) -> List[str]:
-    words = text.split()
-    if not words:
-        return []
-    out, i = [], 0
-    step = max(1, size - overlap)
-    while i < len(words):
-        out.append(" ".join(words[i:i+size]))
-        i += step
-    return out
+def flat_name(rel: str) -> str:
+    """Имя файла в KB для пути из каталога/архива: files/ плоский, подкаталоги кодируем в имени."""
+    return rel.strip("/").replace("/", "__")
 
-def ingest_files(gem_id: str, file_paths: List[Path]) -> Dict:
+def _read_text(path: Path) -> str:
+    return "\n\n".join(_iter_pages(path))
+
+def _chunk(text: str, size: int = DEFAULT_CHUNK_TOKENS, overlap: int = DEFAULT_CHUNK_OVERLAP) -> List[str]:
+    # size/overlap — в оценочных токенах (см. chunker.estimate_tokens)
+    return list(iter_chunks([text], size, overlap))
+
+def ingest_files(
+    gem_id: str,
+    file_paths: List[Path],
+    chunk_tokens: int = DEFAULT_CHUNK_TOKENS,
+    chunk_overlap: int = DEFAULT_CHUNK_OVERLAP,
+    quantization: str = "none",
+    tags: Optional[List[str]] = None,
+    projection: str = "none",
+    projection_dim: int = 256,
+) -> Dict:
+    """
+    Добавляет/заменяет файлы в KB без пересборки всего индекса.
+    Файл с тем же именем заменяется: старые строки помечаются надгробиями,
+    а эмбеддинги чанков с неизменившимся хэшем переиспользуются.
+    Почти-дубликаты уже проиндексированных чанков не эмбеддятся (см. dedup).
+    projection — понижение размерности (см. projection): обучается один раз, когда хватает строк.
+    """
+    return ingest_docs(
+        gem_id, [(p.name, p.read_bytes()) for p in file_paths],
+        chunk_tokens=chunk_tokens, chunk_overlap=chunk_overlap, quantization=quantization,
+        tags=tags, projection=projection, projection_dim=projection_dim,
+    )
+
+def ingest_docs(
+    gem_id: str,
+    docs: List[Tuple[str, bytes]],
+    chunk_tokens: int = DEFAULT_CHUNK_TOKENS,
+    chunk_overlap: int = DEFAULT_CHUNK_OVERLAP,
+    quantization: str = "none",
+    tags: Optional[List[str]] = None,
+    projection: str = "none",
+    projection_dim: int = 256,
+    remove: Sequence[str] = (),
+) -> Dict:
+    """
+    То же, что ingest_files, для документов в памяти (имя, байты).
+    remove — имена файлов, которые снимаются из KB в том же поколении (синхронизация каталога).
+    """
+    with tracing.span("ingest", files=len(docs)), _write_lock(gem_id):
+        st = _read_state(gem_id)
+        retired, removed = _retire(gem_id, st, remove)
+        info = _ingest(
+            gem_id, st, docs,
+            chunking=[int(chunk_tokens), int(chunk_overlap)],
+            quantization=quantization,
+            tags=sorted(set(tags or [])),
+            projection=(projection, int(projection_dim)),
+        )
+        info["removed"] += removed
+        info["retired"] = retired
+        _reingest_dependents(
+            gem_id, st, set(info["files"]) | set(retired), info,
+            quantization=quantization, projection=(projection, int(projection_dim)),
+        )
+        _commit(gem_id, st, info, dirty=bool(info["files"] or info["unchanged"] or retired))
+    return info
+
+class IngestSession:
+    """Много пачек документов — одно поколение индекса (массовая загрузка, см. bulk)."""
+
+    def __init__(self, gem_id: str, st: Dict, opts: Dict):
+        self.gem_id = gem_id
+        self.st = st
+        self.opts = opts
+        self.info: Dict = {
+            "files": [], "unchanged": [], "added": 0, "embedded": 0, "reused": 0, "removed": 0,
+            "dedup": {"mode": _dedup().DEDUP_MODE, "checked": 0, "dropped": 0, "linked": 0},
+        }
+
+    def add(self, docs: List[Tuple[str, bytes]], prepared: Optional[Dict[str, List[str]]] = None) -> Dict:
+        info = _ingest(self.gem_id, self.st, docs, prepared=prepared, **self.opts)
+        for key in ("files", "unchanged"):
+            self.info[key] += info[key]
+        for key in ("added", "embedded", "reused", "removed"):
+            self.info[key] += info[key]
+        for key in ("checked", "dropped", "linked"):
+            self.info["dedup"][key] += info["dedup"][key]
+        return info
+
+@contextmanager
+def ingest_session(
+    gem_id: str,
+    chunk_tokens: int = DEFAULT_CHUNK_TOKENS,
+    chunk_overlap: int = DEFAULT_CHUNK_OVERLAP,
+    quantization: str = "none",
+    tags: Optional[List[str]] = None,
+    projection: str = "none",
+    projection_dim: int = 256,
+) -> Iterator[IngestSession]:
+    """
+    Блокировка записи и состояние индекса держатся всю сессию; поколение публикуется один раз в конце,
+    а не на каждую пачку (иначе массовая загрузка переписывала бы индекс целиком N раз).
+    Исключение внутри — ничего не публикуется.
+    """
+    with tracing.span("ingest_session"), _write_lock(gem_id):
+        sess = IngestSession(gem_id, _read_state(gem_id), {
+            "chunking": [int(chunk_tokens), int(chunk_overlap)],
+            "quantization": quantization,
+            "tags": sorted(set(tags or [])),
+            "projection": (projection, int(projection_dim)),
+        })
+        yield sess
+        info = sess.info
+        _reingest_dependents(
+            gem_id, sess.st, set(info["files"]), info,
+            quantization=quantization, projection=(projection, int(projection_dim)),
+        )
+        _commit(gem_id, sess.st, info, dirty=bool(info["files"] or info["unchanged"]))
+
+def _retire(gem_id: str, st: Dict, names: Sequence[str]) -> Tuple[List[str], int]:
+    """Снимает файлы из состояния и files/ (под _write_lock): (снятые имена, строк в надгробия)."""
+    fdir = files_dir(gem_id)
+    retired, removed = [], 0
+    for name in names:
+        entry = st["manifest"]["files"].pop(name, None)
+        path = fdir / Path(name).name
+        if path.is_file():
+            path.unlink()
+        if entry is not None:
+            removed += _tombstone(st, entry)
+            retired.append(name)
+    return retired, removed
+
+def delete_file(
+    gem_id: str,
+    name: str,
+    quantization: str = "none",
+    projection: str = "none",
+    projection_dim: int = 256,
+) -> Optional[Dict]:
+    """
+    Удаляет документ из KB: файл, строки индекса (надгробия) и postings. None — файла нет.
+    Настройки формата gem — для переиндексации файлов, чьи дубликаты ссылались на удалённый.
+    """
     gdir = _gem_dir(gem_id)
-    fdir = gdir / "files"
+    path = gdir / "files" / Path(name).name
+    with _write_lock(gem_id):
+        st = _read_state(gem_id)
+        entry = st["manifest"]["files"].pop(name, None)
+        if entry is None and not path.is_file():
+            return None
+        if path.is_file():
+            path.unlink()
+        info = {"deleted": name, "removed": 0, "reingested": [], "compacted": False}
+        if entry is not None:
+            info["removed"] = _tombstone(st, entry)
+            _reingest_dependents(
+                gem_id, st, {name}, info,
+                quantization=quantization, projection=(projection, int(projection_dim)),
+            )
+            _commit(gem_id, st, info, dirty=True)
+        info["chunks"] = _live_count(st["manifest"])
+    return info
+
+def _tombstone(st: Dict, entry: Dict) -> int:
+    rows = _ranges_to_rows(entry["rows"]).tolist()
+    st["manifest"]["dead"].extend(entry["rows"])
+    if st.get("lsh") is not None:
+        st["lsh"].remove(rows)
+    return len(rows)
+
+def _lsh(st: Dict):
+    """LSH по живым строкам; строится лениво при первой проверке на дубликаты."""
+    if st.get("lsh") is None:
+        lsh = _dedup().LSHIndex()
+        mh = st["arrays"].get("mh")
+        if mh is not None:
+            dead = set(_ranges_to_rows(st["manifest"]["dead"]).tolist())
+            for f in st["manifest"]["files"].values():
+                for row in _ranges_to_rows(f["rows"]).tolist():
+                    if row not in dead:
+                        lsh.add(row, mh[row])
+        st["lsh"] = lsh
+    return st["lsh"]
+
+def _ingest(
+    gem_id: str,
+    st: Dict,
+    docs: List[Tuple[str, bytes]],
+    chunking: List[int],
+    quantization: str,
+    tags: List[str],
+    force: bool = False,
+    projection: Tuple[str, int] = ("none", 0),
+    prepared: Optional[Dict[str, List[str]]] = None,
+) -> Dict:
+    """prepared — уже нарезанные тексты чанков по имени файла (нарезка в пуле процессов, см. bulk)."""
+    np, quant, dedup = _np(), _quant(), _dedup()
+    fdir = _gem_dir(gem_id) / "files"
     fdir.mkdir(exist_ok=True)
+    meta, arrays, manifest = st["meta"], st["arrays"], st["manifest"]
+    base_rows = manifest["rows"]
+    copied: List[str] = []
+    unchanged: List[str] = []
+    removed = 0
+    new_meta: List[Dict] = []
+    new_sigs: List = []
+    reuse_rows: List[Tuple[int, int]] = []  # (позиция в new_meta, старая строка)
+    embed_pos: List[int] = []
+    dd = {"mode": dedup.DEDUP_MODE, "checked": 0, "dropped": 0, "linked": 0}
 
-    chunks = []
-    copied = []
-    for p in file_paths:
-        dst = fdir / p.name
-        dst.write_bytes(p.read_bytes())
-        copied.append(dst.name)
-        text = _read_text(dst)
-        for idx, ch in enumerate(_chunk(text)):
-            chunks.append({"text": ch, "source": dst.name, "i": idx})
-
-    # пустой корпус — создаём «пустые» артефакты, чтобы статусы не падали
-    if not chunks:
-        (gdir / "meta.json").write_text("[]", encoding="utf-8")
-        np.savez_compressed(gdir / "index.npz", vecs=np.zeros((0, 1)))
-        return {"files": copied, "chunks": 0}
-
-    vecs = np.array(embed([c["text"] for c in chunks]), dtype=float)
-    np.savez_compressed(gdir / "index.npz", vecs=vecs)
-    (gdir / "meta.json").write_text(
-        json.dumps(chunks, ensure_ascii=False),
-        encoding="utf-8"
-    )
-    return {"files": copied, "chunks": len(chunks)}
+    for name, data in docs:
+        sha = hashlib.sha256(data).hexdigest()
+        old = manifest["files"].get(name)
+        if not force and old and old.get("sha256") == sha and old.get("chunking") == chunking:
+            # тот же файл с теми же настройками — обновляем только теги
+            old["tags"] = tags or old.get("tags", [])
+            unchanged.append(name)
+            continue
+
+        dst = fdir / name
+        dst.write_bytes(data)
+        copied.append(name)
+        with tracing.span("chunk", source=name) as sp:
+            texts = (prepared or {}).get(name)
+            if texts is None:
+                texts = iter_chunks(_iter_pages(dst), chunking[0], chunking[1])
+            chunks = [{"text": ch, "source": name, "i": idx} for idx, ch in enumerate(texts)]
+            sp["chunks"] = len(chunks)
+
+        reuse: Dict[str, int] = {}
+        if old:
+            for h, row in zip(old.get("hashes", []), _ranges_to_rows(old["rows"]).tolist()):
+                reuse.setdefault(h, row)
+            removed += _tombstone(st, old)
+
+        entry = {
+            "rows": [], "hashes": [], "sha256": sha, "chunking": chunking,
+            "uploaded_at": time.time(), "tags": tags, "duplicates": {},
+            "linked": [],  # [строка оригинала, номер чанка в этом файле] — дубликаты в режиме link
+        }
+        for c in chunks:
+            row = base_rows + len(new_meta)
+            sig = dedup.signature(c["text"])
+            if dedup.DEDUP_MODE != "off":
+                dd["checked"] += 1
+                dup = _lsh(st).find(sig)
+                if dup is not None:
+                    # почти-дубликат: не эмбеддим и не храним отдельной строкой
+                    target = meta if dup < base_rows else new_meta
+                    k = dup if dup < base_rows else dup - base_rows
+                    src = target[k]["source"]
+                    entry["duplicates"][src] = entry["duplicates"].get(src, 0) + 1
+                    if dedup.DEDUP_MODE == "link":
+                        target[k] = {**target[k], "dups": target[k].get("dups", []) + [{"source": name, "i": c["i"]}]}
+                        entry["linked"].append([int(dup), c["i"]])
+                        dd["linked"] += 1
+                    else:
+                        dd["dropped"] += 1
+                    continue
+            h = _chunk_hash(c["text"])
+            _add_row(entry["rows"], row)
+            entry["hashes"].append(h)
+            if h in reuse:
+                reuse_rows.append((len(new_meta), reuse[h]))
+            else:
+                embed_pos.append(len(new_meta))
+            new_meta.append(c)
+            new_sigs.append(sig)
+            if dedup.DEDUP_MODE != "off":
+                _lsh(st).add(row, sig)
+        manifest["files"][name] = entry
+
+    if new_meta:
+        vecs = np.array(_embed_texts([new_meta[i]["text"] for i in embed_pos]), dtype=np.float32) if embed_pos else None
+        if vecs is not None:
+            vecs = _project(st, vecs, projection)
+            arrays = st["arrays"]
+        parts, order = [], []
+        if reuse_rows:
+            taken = quant.take(arrays, np.array([r for _, r in reuse_rows]))
+            taken.pop("mh", None)  # сигнатуры строк блока проставим ниже
+            parts.append(taken)
+            order += [pos for pos, _ in reuse_rows]
+        if vecs is not None:
+            fresh = quant.encode_like(arrays, vecs) if quant.size(arrays) else quant.encode(vecs, quantization)
+            parts.append(fresh)
+            order += embed_pos
+        block = parts[0] if len(parts) == 1 else quant.concat(parts[0], parts[1])
+        block = quant.take(block, np.argsort(np.array(order)))
+        block["mh"] = np.stack(new_sigs)
+        st["arrays"] = quant.concat(arrays, block) if quant.size(arrays) else {**_proj().params(arrays), **block}
+        st["meta"] = meta + new_meta
+        manifest["rows"] = base_rows + len(new_meta)
+
+    return {
+        "files": copied,
+        "unchanged": unchanged,
+        "added": len(new_meta),
+        "embedded": len(embed_pos),
+        "reused": len(reuse_rows),
+        "removed": removed,
+        "dedup": dd,
+    }
+
+def _embed_texts(texts: List[str]) -> List[List[float]]:
+    """Эмбеддинг пачками: несколько запросов к бэкенду в полёте вместо одного огромного или по одному."""
+    if len(texts) <= KB_EMBED_BATCH or KB_EMBED_CONCURRENCY <= 1:
+        return embed(texts)
+    from concurrent.futures import ThreadPoolExecutor
+    batches = [texts[i:i + KB_EMBED_BATCH] for i in range(0, len(texts), KB_EMBED_BATCH)]
+    with ThreadPoolExecutor(min(KB_EMBED_CONCURRENCY, len(batches)), thread_name_prefix="embed") as pool:
+        futs = [pool.submit(tracing.bind(embed), b) for b in batches]
+        return [v for f in futs for v in f.result()]
+
+def _project(st: Dict, vecs, projection: Tuple[str, int]):
+    """
+    Новые векторы в пространство индекса. Если проекции ещё нет, а gem её просит и строк уже хватает,
+    обучаем её на старых строках + новых и один раз переводим в неё весь индекс.
+    Уже обученная проекция не меняется: другой projection_dim — только пересборкой (rebuild, PUT ?reindex=true).
+    """
+    np, quant, proj = _np(), _quant(), _proj()
+    arrays = st["arrays"]
+    if proj.params(arrays):
+        return proj.apply(arrays, vecs)
+    kind, dim = projection
+    n_old = quant.size(arrays)
+    if not proj.ready(kind, dim, n_old + len(vecs), vecs.shape[1]):
+        return vecs
+    old = quant.decode(arrays, np.arange(n_old)) if n_old else None
+    params = proj.fit(vecs if old is None else np.concatenate([old, vecs]), kind, dim)
+    if old is None:
+        st["arrays"] = {**arrays, **params}
+    else:
+        extra = {k: v for k, v in arrays.items() if k == "mh"}
+        st["arrays"] = {**quant.encode(proj.apply(params, old), quant.kind_of(arrays)), **extra, **params}
+        st["lsh"] = None
+    return proj.apply(params, vecs)
+
+def _reingest_dependents(
+    gem_id: str, st: Dict, changed: set, info: Dict,
+    quantization: str = "none", projection: Tuple[str, int] = ("none", 0),
+) -> None:
+    """
+    Файлы, чьи чанки были привязаны как дубликаты к изменённым/удалённым файлам,
+    переиндексируем из files/, чтобы их содержимое не пропало из поиска.
+    quantization/projection — настройки gem: нужны, если индекс к этому моменту пуст или проекция не обучена.
+    """
+    fdir = _gem_dir(gem_id) / "files"
+    done: set = set()
+    while changed:
+        deps = [
+            n for n, f in st["manifest"]["files"].items()
+            if n not in done and n not in changed and changed.intersection(f.get("duplicates", {}))
+        ]
+        done |= changed
+        changed = set()
+        for n in deps:
+            f = st["manifest"]["files"][n]
+            if not (fdir / n).is_file():
+                continue
+            _ingest(
+                gem_id, st, [(n, (fdir / n).read_bytes())],
+                chunking=f.get("chunking") or [DEFAULT_CHUNK_TOKENS, DEFAULT_CHUNK_OVERLAP],
+                quantization=quantization, tags=f.get("tags", []), force=True, projection=projection,
+            )
+            info.setdefault("reingested", []).append(n)
+            changed.add(n)
+
+def _commit(gem_id: str, st: Dict, info: Dict, dirty: bool) -> None:
+    compacted = _maybe_compact(st["meta"], st["arrays"], st["manifest"])
+    if compacted:
+        st["meta"], st["arrays"], st["manifest"] = compacted
+        st["lsh"] = None
+    if dirty or not has_index(gem_id):
+        _write_state(gem_id, st["meta"], st["arrays"], st["manifest"])
+    info["chunks"] = _live_count(st["manifest"])
+    info["compacted"] = bool(compacted)
+
+# ---------- состояние индекса: manifest + надгробия + уплотнение ----------
+
+KB_COMPACT_RATIO = float(os.getenv("KB_COMPACT_RATIO", "0.3"))
+
+_write_locks: Dict[str, threading.RLock] = {}
+_write_locks_guard = threading.Lock()
+_flock_depth: Dict[str, int] = {}
+
+@contextmanager
+def _write_lock(gem_id: str):
+    """Запись в KB gem: RLock внутри процесса + flock на idx/.lock между воркерами."""
+    with _write_locks_guard:
+        lock = _write_locks.setdefault(gem_id, threading.RLock())
+    with lock:
+        depth = _flock_depth.get(gem_id, 0)
+        fh = None
+        if depth == 0 and fcntl is not None:
+            idir = _gem_dir(gem_id) / INDEX_DIR
+            idir.mkdir(exist_ok=True)
+            fh = open(idir / ".lock", "a+b")
+            fcntl.flock(fh.fileno(), fcntl.LOCK_EX)
+        _flock_depth[gem_id] = depth + 1
+        try:
+            yield
+        finally:
+            _flock_depth[gem_id] = depth
+            if fh is not None:
+                fcntl.flock(fh.fileno(), fcntl.LOCK_UN)
+                fh.close()
+
+def _chunk_hash(text: str) -> str:
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+def _live_count(manifest: Dict) -> int:
+    return sum(e - s for f in manifest["files"].values() for s, e in f["rows"])
+
+def _manifest_from_meta(meta: List[Dict], files_info: Dict[str, Dict]) -> Dict:
+    # индексы до manifest: все строки живые, sha256 файла неизвестен
+    files: Dict[str, Dict] = {}
+    for row, c in enumerate(meta):
+        f = files.get(c["source"])
+        if f is None:
+            info = files_info.get(c["source"], {})
+            f = files[c["source"]] = {
+                "rows": [], "hashes": [], "sha256": None, "chunking": None,
+                "uploaded_at": info.get("uploaded_at", 0), "tags": info.get("tags", []),
+            }
+        _add_row(f["rows"], row)
+        f["hashes"].append(_chunk_hash(c["text"]))
+    return {"files": files, "dead": [], "rows": len(meta)}
+
+def _empty_state() -> Dict:
+    np = _np()
+    return {
+        "meta": [], "arrays": {"vecs": np.zeros((0, 1), dtype=np.float32)},
+        "manifest": {"files": {}, "dead": [], "rows": 0}, "lsh": None,
+    }
+
+def _read_state(gem_id: str) -> Dict:
+    """Состояние для изменения: meta, arrays, manifest (копии, кэш не трогаем)."""
+    if not has_index(gem_id):
+        return _empty_state()
+    meta, arrays, postings = _load(gem_id)
+    mpath = _state_dir(_gem_dir(gem_id)) / "manifest.json"
+    if mpath.exists():
+        manifest = json.loads(mpath.read_text(encoding="utf-8"))
+    else:
+        manifest = _manifest_from_meta(meta, postings.get("files", {}))
+    arrays = _quant().upgrade(dict(arrays))  # в т.ч. int8 с масштабом на измерение -> на строку
+    if "mh" not in arrays and _quant().size(arrays):
+        # индексы до дедупликации: считаем сигнатуры по тексту один раз
+        arrays["mh"] = _dedup().signatures(c["text"] for c in meta)
+    return {"meta": list(meta), "arrays": arrays, "manifest": manifest, "lsh": None}
+
+def _maybe_compact(meta: List[Dict], arrays: Dict, manifest: Dict):
+    """Если мёртвых строк больше KB_COMPACT_RATIO — переписываем индекс только из живых."""
+    np, quant = _np(), _quant()
+    total = manifest["rows"]
+    dead = total - _live_count(manifest)
+    if total == 0 or dead == 0 or dead / total <= KB_COMPACT_RATIO:
+        return None
+    keep = _ranges_to_rows([r for f in manifest["files"].values() for r in f["rows"]])
+    pos = np.full(total, -1, dtype=np.int64)
+    pos[keep] = np.arange(len(keep))
+    for f in manifest["files"].values():
+        rows: List[List[int]] = []
+        for r in pos[_ranges_to_rows(f["rows"])].tolist():
+            _add_row(rows, r)
+        f["rows"] = rows
+        if f.get("linked"):
+            f["linked"] = [[int(pos[r]), i] for r, i in f["linked"] if pos[r] >= 0]
+    manifest = {**manifest, "dead": [], "rows": int(len(keep))}
+    arrays = quant.take(arrays, keep) if len(keep) else {"vecs": np.zeros((0, 1), dtype=np.float32)}
+    return [meta[r] for r in keep.tolist()], arrays, manifest
+
+def _atomic_write(path: Path, write) -> None:
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, "wb") as f:
+        write(f)
+    os.replace(tmp, path)
+
+def _write_state(gem_id: str, meta: List[Dict], arrays: Dict, manifest: Dict) -> None:
+    """
+    Публикует новое поколение: пишет его каталог целиком, затем атомарно подменяет CURRENT.
+    Читатели видят либо старое, либо новое поколение; старые каталоги удаляются с запасом
+    KB_KEEP_GENERATIONS (открытые mmap'ы удалённых файлов в POSIX остаются валидными).
+    """
+    with tracing.span("write_index", rows=len(meta)):
+        _publish(gem_id, meta, arrays, manifest)
+
+def _publish(gem_id: str, meta, arrays: Dict, manifest: Dict) -> None:
+    np = _np()
+    gen, sdir = _new_generation(gem_id)
+    for key, arr in arrays.items():
+        np.save(sdir / f"{key}.npy", arr)
+    _chunkstore().write(sdir / CHUNKS, meta)
+    (sdir / "manifest.json").write_text(json.dumps(manifest, ensure_ascii=False), encoding="utf-8")
+    _write_postings(sdir, _build_postings(manifest))
+    _swap_generation(gem_id, gen)
+
+def _new_generation(gem_id: str) -> Tuple[int, Path]:
+    """Пустой каталог следующего поколения (вызывать под _write_lock)."""
+    gen = generation(gem_id) + 1
+    sdir = _gem_dir(gem_id) / INDEX_DIR / f"{gen:08d}"
+    if sdir.exists():  # недописанное поколение после сбоя
+        shutil.rmtree(sdir)
+    sdir.mkdir(parents=True)
+    return gen, sdir
+
+def _swap_generation(gem_id: str, gen: int) -> None:
+    """Атомарно делает gen текущим и чистит старые поколения и плоский формат."""
+    gdir = _gem_dir(gem_id)
+    idir = gdir / INDEX_DIR
+    _atomic_write(idir / CURRENT, lambda f: f.write(str(gen).encode("ascii")))
+    qcache.forget_gem(gem_id)  # ключи и так сменились вместе с поколением — освобождаем место сразу
+
+    for name in ("index.npz", CHUNKS, LEGACY_META, "manifest.json", "postings.json"):
+        if (gdir / name).exists():  # плоский формат до поколений
+            (gdir / name).unlink()
+    for old in idir.iterdir():
+        if old.is_dir() and old.name.isdigit() and int(old.name) <= gen - KB_KEEP_GENERATIONS:
+            shutil.rmtree(old, ignore_errors=True)
+
+def ensure_generation(gem_id: str) -> int:
+    """Номер текущего поколения; индекс плоского формата сначала переписывается в поколение."""
+    gen = generation(gem_id)
+    if gen or not has_index(gem_id):
+        return gen
+    with _write_lock(gem_id):
+        if not generation(gem_id) and has_index(gem_id):
+            st = _read_state(gem_id)
+            _write_state(gem_id, st["meta"], st["arrays"], st["manifest"])
+        return generation(gem_id)
+
+@contextmanager
+def staged_generation(gem_id: str) -> Iterator[Path]:
+    """
+    Каталог нового поколения для уже готовых файлов (импорт снапшота).
+    Публикуется атомарно, если блок завершился без исключения; иначе удаляется.
+    """
+    with _write_lock(gem_id):
+        gen, sdir = _new_generation(gem_id)
+        try:
+            yield sdir
+        except BaseException:
+            shutil.rmtree(sdir, ignore_errors=True)
+            raise
+        _swap_generation(gem_id, gen)
+
+# ---------- postings: значение атрибута -> диапазоны строк индекса ----------
+
+def _add_row(ranges: List[List[int]], row: int) -> None:
+    # полуинтервалы [start, end); чанки одного файла идут подряд, так что диапазонов мало
+    if ranges and ranges[-1][1] == row:
+        ranges[-1][1] = row + 1
+    else:
+        ranges.append([row, row + 1])
+
+def _build_postings(manifest: Dict) -> Dict:
+    """
+    Postings только по живым строкам — надгробия в поиск не попадают.
+    Чанки-дубликаты (режим link) хранятся строкой оригинала, но в postings числятся и за своим файлом,
+    чтобы фильтры по source/тегам/дате и пересказ файла их находили; linked — их номера в файле.
+    """
+    source: Dict[str, List[List[int]]] = {}
+    tag: Dict[str, List[List[int]]] = {}
+    linked: Dict[str, List[List[int]]] = {}
+    files_info: Dict[str, Dict] = {}
+    dead_rows = None
+    for name, f in manifest["files"].items():
+        files_info[name] = {"uploaded_at": f.get("uploaded_at", 0), "tags": f.get("tags", [])}
+        rows = f["rows"]
+        if f.get("linked"):
+            if dead_rows is None:
+                dead_rows = set(_ranges_to_rows(manifest["dead"]).tolist())
+            pairs = [[r, i] for r, i in f["linked"] if r not in dead_rows]
+            if pairs:
+                linked[name] = pairs
+                rows = []
+                for r in _ranges_to_rows(f["rows"] + [[r, r + 1] for r, _ in pairs]).tolist():
+                    _add_row(rows, r)
+        if rows:
+            source[name] = rows
+        for t in f.get("tags", []):
+            tag.setdefault(t, []).extend(rows)
+    dead = manifest["rows"] - _live_count(manifest)
+    return {
+        "files": files_info, "source": source, "tag": tag, "linked": linked,
+        "dead": dead, "dead_rows": manifest["dead"],
+    }
+
+def _write_postings(gdir: Path, postings: Dict) -> None:
+    (gdir / "postings.json").write_text(json.dumps(postings, ensure_ascii=False), encoding="utf-8")
+
+def _ts(v) -> Optional[float]:
+    if v is None:
+        return None
+    return v.timestamp() if hasattr(v, "timestamp") else float(v)
+
+def _filter_rows(postings: Dict, filters: Optional[Dict]):
+    """
+    Строки индекса под фильтр или None (фильтра нет).
+    sources/tags — OR внутри списка; между атрибутами и датами — AND.
+    """
+    if not filters:
+        return None
+    np = _np()
+    groups: List[set] = []
+    sources = filters.get("sources")
+    tags = filters.get("tags")
+    t_from, t_to = _ts(filters.get("uploaded_from")), _ts(filters.get("uploaded_to"))
+    if sources:
+        groups.append({n for n in sources if n in postings["source"]})
+    if t_from is not None or t_to is not None:
+        groups.append({
+            n for n, info in postings["files"].items()
+            if (t_from is None or info.get("uploaded_at", 0) >= t_from)
+            and (t_to is None or info.get("uploaded_at", 0) <= t_to)
+        })
+    rows = None
+    if groups:
+        names = set.intersection(*groups)
+        rows = _ranges_to_rows([r for n in names for r in postings["source"].get(n, [])])
+    if tags:
+        tagged = _ranges_to_rows([r for t in tags for r in postings["tag"].get(t, [])])
+        rows = tagged if rows is None else np.intersect1d(rows, tagged)
+    return rows
+
+def _ranges_to_rows(ranges: List[List[int]]):
+    np = _np()
+    if not ranges:
+        return np.zeros(0, dtype=np.int64)
+    return np.unique(np.concatenate([np.arange(s, e, dtype=np.int64) for s, e in ranges]))
+
+def generation(gem_id: str) -> int:
+    """Номер опубликованного поколения индекса; 0 — поколений ещё нет (пусто или плоский формат)."""
+    try:
+        return int((_gem_dir(gem_id) / INDEX_DIR / CURRENT).read_text(encoding="ascii").strip() or 0)
+    except (FileNotFoundError, ValueError):
+        return 0
+
+def _state_dir(gdir: Path, gen: Optional[int] = None) -> Path:
+    gen = generation(gdir.name) if gen is None else gen
+    return gdir / INDEX_DIR / f"{gen:08d}" if gen else gdir
+
+def generation_dir(gem_id: str, gen: Optional[int] = None) -> Path:
+    """Каталог поколения (по умолчанию текущего); для плоского формата — каталог gem."""
+    return _state_dir(_gem_dir(gem_id), gen)
+
+def files_dir(gem_id: str) -> Path:
+    return _gem_dir(gem_id) / "files"
 
 def has_index(gem_id: str) -> bool:
     gdir = _gem_dir(gem_id)
-    return (gdir / "index.npz").exists() and (gdir / "meta.json").exists()
+    sdir = _state_dir(gdir)
+    if sdir == gdir:
+        return (gdir / "index.npz").exists() and _meta_path(gdir).exists()
+    return (sdir / CHUNKS).exists()
+
+def _meta_path(gdir: Path) -> Path:
+    # тексты чанков: chunks.bin; meta.json — формат старых индексов, читается до первой записи
+    return gdir / CHUNKS if (gdir / CHUNKS).exists() or not (gdir / LEGACY_META).exists() else gdir / LEGACY_META
+
+def _open_meta(gdir: Path):
+    path = _meta_path(gdir)
+    if path.name == CHUNKS:
+        return _chunkstore().ChunkStore(path)
+    return json.loads(path.read_text(encoding="utf-8"))
 
 def list_files(gem_id: str) -> List[str]:
-    fdir = _gem_dir(gem_id) / "files"
+    fdir = files_dir(gem_id)
     return [p.name for p in fdir.iterdir() if p.is_file()] if fdir.exists() else []
 
 def status(gem_id: str) -> Dict:
     gdir = _gem_dir(gem_id)
     ok = has_index(gem_id)
     chunks = 0
+    dead = 0
+    kind = proj = None
     if ok:
+        np, quant = _np(), _quant()
+        gdir = _state_dir(gdir)
         try:
-            meta = json.loads((gdir / "meta.json").read_text(encoding="utf-8"))
-            chunks = len(meta)
+            path = _meta_path(gdir)
+            if path.name == CHUNKS:
+                total = _chunkstore().count(path)  # только заголовок
+            else:
+                total = len(json.loads(path.read_text(encoding="utf-8")))
+            if (gdir / "postings.json").exists():
+                dead = json.loads((gdir / "postings.json").read_text(encoding="utf-8")).get("dead", 0)
+            chunks = total - dead
+            if (gdir / "index.npz").exists():
+                with np.load(gdir / "index.npz") as z:
+                    names = dict.fromkeys(z.files)  # по именам массивов, без распаковки
+            else:
+                names = dict.fromkeys(p.stem for p in gdir.glob("*.npy"))
+            kind = quant.kind_of(names)
+            proj = _proj().kind_of(names)
         except Exception:
             pass
-    return {"indexed": ok, "chunks": chunks, "files": list_files(gem_id)}
+    return {
+        "indexed": ok, "chunks": chunks, "tombstones": dead,
+        "quantization": kind, "projection": proj, "files": list_files(gem_id),
+    }
 
-def query(gem_id: str, q: str, k: int = 4) -> List[Dict]:
+def effective_settings(gem_id: str) -> Dict:
+    """Формат, в котором индекс реально хранится (None — индекса нет); настройки gem действуют только на пустой индекс."""
+    out = {"quantization": None, "projection": None, "projection_dim": None}
     if not has_index(gem_id):
-        return []
+        return out
+    quant, proj = _quant(), _proj()
+    _, arrays, _ = _load(gem_id)
+    if not quant.size(arrays):
+        return out
+    return {"quantization": quant.kind_of(arrays), "projection": proj.kind_of(arrays), "projection_dim": proj.out_dim(arrays)}
+
+def settings_drift(gem_id: str, configured: Dict) -> Dict[str, Dict]:
+    """
+    Настройки gem, расходящиеся с форматом индекса: {поле: {"configured", "effective"}}.
+    Ещё не обученная проекция — не расхождение: _project обучит её при следующей записи, когда хватит строк.
+    """
+    eff = effective_settings(gem_id)
+    if eff["quantization"] is None:
+        return {}
+    diff = {k: configured[k] for k in ("quantization", "projection") if k in configured and configured[k] != eff[k]}
+    if eff["projection"] == "none":
+        diff.pop("projection", None)
+    elif "projection" not in diff and configured.get("projection_dim", eff["projection_dim"]) != eff["projection_dim"]:
+        diff["projection_dim"] = configured["projection_dim"]
+    return {k: {"configured": v, "effective": eff[k]} for k, v in diff.items()}
+
+def rebuild(
+    gem_id: str,
+    quantization: str = "none",
+    projection: str = "none",
+    projection_dim: int = 256,
+) -> Dict:
+    """
+    Пересобирает индекс из files/ с новыми настройками формата: все чанки эмбеддятся заново
+    (квантованные и спроецированные векторы обратно не восстановить). Теги и нарезка файлов сохраняются.
+    """
+    with tracing.span("kb_rebuild"), _write_lock(gem_id):
+        old = _read_state(gem_id)["manifest"]["files"]
+        st = _empty_state()
+        fdir = files_dir(gem_id)
+        info: Dict = {"files": [], "unchanged": [], "added": 0, "embedded": 0, "missing": []}
+        for name, f in old.items():
+            path = fdir / name
+            if not path.is_file():
+                info["missing"].append(name)
+                continue
+            res = _ingest(
+                gem_id, st, [(name, path.read_bytes())],
+                chunking=f.get("chunking") or [DEFAULT_CHUNK_TOKENS, DEFAULT_CHUNK_OVERLAP],
+                quantization=quantization, tags=f.get("tags", []), force=True,
+                projection=(projection, int(projection_dim)),
+            )
+            info["files"] += res["files"]
+            info["added"] += res["added"]
+            info["embedded"] += res["embedded"]
+        _commit(gem_id, st, info, dirty=True)
+    return info
+
+def _sig(path: Path) -> tuple:
+    try:
+        st = os.stat(path)
+        return (st.st_mtime_ns, st.st_size)
+    except FileNotFoundError:
+        return (0, 0)
+
+def _index_sig(gem_id: str, gen: Optional[int] = None) -> tuple:
+    """Версия индекса gem: номер поколения или подписи файлов плоского формата."""
+    gen = generation(gem_id) if gen is None else gen
+    if gen:
+        return ("gen", gen)
+    gdir = _gem_dir(gem_id)
+    return tuple(_sig(path) for path in (_meta_path(gdir), gdir / "index.npz", gdir / "postings.json"))
+
+def _load(gem_id: str):
+    """
+    meta + массивы индекса + postings. Для поколения ключ кэша — его номер (одно чтение CURRENT),
+    для плоского формата — подписи файлов.
+    """
+    np = _np()
     gdir = _gem_dir(gem_id)
-    meta = json.loads((gdir / "meta.json").read_text(encoding="utf-8"))
-    vecs = np.load(gdir / "index.npz")["vecs"]
-    if vecs.size == 0:
+    gen = generation(gem_id)
+    sig = _index_sig(gem_id, gen)
+    with _index_lock:
+        hit = _index_cache.get(gem_id)
+        if hit and hit[0] == sig:
+            _index_cache.move_to_end(gem_id)
+            return hit[1], hit[2], hit[3]
+    if gen:
+        gdir = _state_dir(gdir, gen)
+        meta = _open_meta(gdir)
+        # mmap только на чтение: страницы общие для всех воркеров на хосте
+        arrays = {p.stem: np.load(p, mmap_mode="r") for p in gdir.glob("*.npy")}
+    else:
+        meta = _open_meta(gdir)
+        with np.load(gdir / "index.npz") as z:
+            arrays = _quant().upgrade({k: z[k] for k in z.files})
+    if (gdir / "postings.json").exists():
+        postings = json.loads((gdir / "postings.json").read_text(encoding="utf-8"))
+    else:
+        # индексы до postings: восстанавливаем диапазоны по source, без тегов и дат
+        postings = _build_postings(_manifest_from_meta(meta, {}))
+    with _index_lock:
+        _index_cache[gem_id] = (sig, meta, arrays, postings)
+        _index_cache.move_to_end(gem_id)
+        while len(_index_cache) > KB_CACHE_GEMS:
+            _index_cache.popitem(last=False)
+    return meta, arrays, postings
+
+def preload(gem_id: str, warm: bool = False) -> bool:
+    """
+    Заранее поднимает индекс gem в кэш процесса (batch, прогрев).
+    warm=True ещё и читает массивы целиком, чтобы страницы mmap были в page cache до первого запроса.
+    """
+    if not has_index(gem_id):
+        return False
+    _, arrays, _ = _load(gem_id)
+    if warm:
+        for a in arrays.values():
+            for i in range(0, len(a) if a.ndim else 0, 65536):
+                a[i:i + 65536].max(initial=0)
+    return True
+
+def _score(gem_id: str, q: str, shortlist: Optional[int] = None, filters: Optional[Dict] = None):
+    """
+    (meta, массивы индекса, строки-кандидаты, косинусы) или None, если индекса нет.
+    С фильтрами считаем косинус только по строкам из postings.
+    """
+    if not has_index(gem_id):
+        return None
+    np, quant = _np(), _quant()
+    meta, arrays, postings = _load(gem_id)
+    if quant.size(arrays) == 0:
+        return None
+    subset = _filter_rows(postings, filters)
+    dead = None
+    if subset is None and postings.get("dead"):
+        # есть надгробия: скорим массивы поколения как есть (mmap, без копии) и выкидываем мёртвые строки
+        if "dead_rows" in postings:
+            dead = _ranges_to_rows(postings["dead_rows"])
+        else:  # postings до dead_rows — только по живым строкам
+            subset = _ranges_to_rows([r for rs in postings["source"].values() for r in rs])
+    if subset is not None and subset.size == 0:
+        return None
+    qv = _proj().apply(arrays, _query_vec(q))
+    with tracing.span("score", kind=quant.kind_of(arrays), rows=int(quant.size(arrays) if subset is None else subset.size)):
+        rows, sims = quant.score(arrays, qv, shortlist=shortlist or quant.SHORTLIST, rows=subset, dead=dead)
+    return meta, arrays, rows, sims
+
+def _query_vec(q: str):
+    """Эмбеддинг запроса через qcache: повторный текст не идёт в сеть."""
+    ident = embed_identity()
+
+    def build():
+        v = _np().array(embed([q])[0], dtype=_np().float32)
+        v.setflags(write=False)  # один массив на всех читателей кэша
+        return v
+
+    return qcache.embeddings.get_or_build((ident["backend"], ident["model"], qcache.text_key(q)), build)
+
+def _cached(gem_id: str, q: str, params: tuple, filters: Optional[Dict], build) -> List[Dict]:
+    key = (gem_id, _index_sig(gem_id), qcache.text_key(q), params, qcache.filters_key(filters))
+    return [dict(s) for s in qcache.results.get_or_build(key, build)]
+
+def _snip(meta: List[Dict], row: int, score: float) -> Dict:
+    m = meta[row]
+    return {"text": m["text"], "source": m["source"], "i": m.get("i"), "score": score}
+
+def query(gem_id: str, q: str, k: int = 4, filters: Optional[Dict] = None) -> List[Dict]:
+    """
+    filters: {"sources": [...], "tags": [...], "uploaded_from": ts|datetime, "uploaded_to": ts|datetime}
+    Результат кэшируется по (gem, версия индекса, запрос, k, фильтры) — см. qcache.
+    """
+    return _cached(gem_id, q, ("query", k), filters, lambda: _query(gem_id, q, k, filters))
+
+def document_chunks(gem_id: str, source: Optional[str] = None) -> List[Dict]:
+    """
+    Живые чанки документа (или всей KB при source=None) в порядке текста: {"text", "source", "i", "hash"}.
+    Для задач по документу целиком (summarize), где top-k сниппетов не хватает. KeyError — нет такого файла.
+    """
+    if not has_index(gem_id):
+        if source is not None:
+            raise KeyError(source)
         return []
-    qv = np.array(embed([q])[0], dtype=float)
-    sims = (vecs @ qv) / (np.linalg.norm(vecs, axis=1) * (np.linalg.norm(qv) + 1e-8))
-    idx = np.argsort(-sims)[:k]
-    return [
-        {"text": meta[int(i)]["text"], "source": meta[int(i)]["source"], "score": float(sims[int(i)])}
-        for i in idx
-    ]
+    meta, _, postings = _load(gem_id)
+    if source is not None and source not in postings["source"]:
+        raise KeyError(source)
+    names = [source] if source is not None else sorted(postings["source"])
+    out = []
+    for name in names:
+        # свои строки файла; для одного файла — ещё и строки оригиналов, к которым привязаны его дубликаты
+        # (со своими номерами чанков); по всей KB текст дубликата уже есть у оригинала
+        rows = _ranges_to_rows(postings["source"][name]).tolist()
+        chunks = [(meta[r].get("i") or 0, meta[r]["text"]) for r in rows if meta[r]["source"] == name]
+        if source is not None:
+            chunks += [(i or 0, meta[r]["text"]) for r, i in postings.get("linked", {}).get(name, [])]
+        chunks.sort(key=lambda c: c[0])
+        out += [{"text": text, "source": name, "i": i, "hash": _chunk_hash(text)} for i, text in chunks]
+    return out
+
+def _query(gem_id: str, q: str, k: int, filters: Optional[Dict]) -> List[Dict]:
+    np, quant = _np(), _quant()
+    scored = _score(gem_id, q, shortlist=max(k, quant.SHORTLIST), filters=filters)
+    if scored is None:
+        return []
+    meta, _, rows, sims = scored
+    top = np.argsort(-sims)[:k]
+    return [_snip(meta, int(rows[j]), float(sims[j])) for j in top]
+
+def retrieve(
+    gem_id: str,
+    q: str,
+    budget_tokens: int = DEFAULT_CONTEXT_TOKENS,
+    min_score: float = DEFAULT_MIN_SCORE,
+    fetch_k: int = FETCH_K,
+    lambda_mult: float = MMR_LAMBDA,
+    filters: Optional[Dict] = None,
+) -> List[Dict]:
+    """
+    query + упаковка контекста: отсечка по min_score, MMR по fetch_k кандидатам,
+    склейка соседних чанков одного файла, набор до budget_tokens. Кэшируется, как query.
+    """
+    params = ("retrieve", budget_tokens, min_score, fetch_k, lambda_mult)
+    return _cached(gem_id, q, params, filters, lambda: _retrieve(gem_id, q, *params[1:], filters))
+
+def _retrieve(gem_id, q, budget_tokens, min_score, fetch_k, lambda_mult, filters) -> List[Dict]:
+    np, quant = _np(), _quant()
+    scored = _score(gem_id, q, shortlist=max(fetch_k, quant.SHORTLIST), filters=filters)
+    if scored is None:
+        return []
+    meta, arrays, rows, sims = scored
+    top = np.argsort(-sims)[:fetch_k]
+    top = top[sims[top] >= min_score]
+    if top.size == 0:
+        return []
+    with tracing.span("pack", candidates=int(top.size)):
+        vecs = quant.decode(arrays, rows[top])
+        order = mmr(sims[top], vecs, lambda_mult=lambda_mult, k=len(top))
+        cands = [_snip(meta, int(rows[top[j]]), float(sims[top[j]])) for j in order]
+        return pack(cands, budget_tokens)
+
+def quant_report(gem_id: str, k: int = 10) -> Dict:
+    """Отчёт точность/память по вариантам квантизации на векторах этой gem."""
+    if not has_index(gem_id):
+        return {"chunks": 0, "report": []}
+    np, quant = _np(), _quant()
+    _, arrays, _ = _load(gem_id)
+    n = quant.size(arrays)
+    if n == 0:
+        return {"chunks": 0, "report": []}
+    vecs = quant.decode(arrays, np.arange(n))
+    return {
+        "chunks": n,
+        "dim": int(vecs.shape[1]),
+        "stored_as": quant.kind_of(arrays),
+        "report": quant.report(vecs, k=k),
+    }
+
+def projection_report(gem_id: str, dims: Optional[List[int]] = None, k: int = 10) -> Dict:
+    """Recall@k проекций (pca/truncate) на векторах этой gem относительно поиска по хранимой ширине."""
+    if not has_index(gem_id):
+        return {"chunks": 0, "report": []}
+    np, quant, proj = _np(), _quant(), _proj()
+    _, arrays, _ = _load(gem_id)
+    n = quant.size(arrays)
+    if n == 0:
+        return {"chunks": 0, "report": []}
+    vecs = quant.decode(arrays, np.arange(n))
+    return {
+        "chunks": n,
+        "dim": int(vecs.shape[1]),
+        # индекс уже спроецирован — сравнение идёт с его шириной, а не с шириной бэкенда
+        "stored_projection": proj.kind_of(arrays),
+        "report": proj.report(vecs, dims=dims or (64, 128, 256, 384, 512), k=k),
+    }
 
 def build_context(snips: List[Dict]) -> str:
     if not snips:
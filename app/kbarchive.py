@@ -0,0 +1,297 @@
+# app/kbarchive.py
+"""
+Переносимый снапшот KB gem: один несжатый tar, который отдаётся потоком и принимается обратно
+без повторного эмбеддинга и без разбора JSON с векторами.
+
+Состав архива (порядок важен — читается потоком):
+    kb.json          формат/версия, поколение, идентичность модели эмбеддингов, размерность, число строк
+    index/*.npy      массивы индекса как есть (vecs / q8 / bits / f16 / mh ...)
+    index/chunks.bin тексты чанков, index/manifest.json, index/postings.json
+    files/*          исходные файлы (для переиндексации), если include_files
+    SHA256SUMS       sha256 всех членов выше; считается на лету при отдаче
+
+Импорт распаковывает архив прямо в каталог нового поколения, сверяет контрольные суммы,
+заголовки .npy и модель эмбеддингов, затем публикует поколение атомарной подменой CURRENT —
+массивы дальше открываются mmap'ом, как и у обычного индекса.
+"""
+from __future__ import annotations
+import hashlib
+import json
+import os
+import re
+import shutil
+import tarfile
+import time
+from pathlib import Path
+from typing import IO, Dict, Iterator, List, Optional, Tuple
+
+from . import kb, llm, startup
+
+FORMAT = "gems-kb"
+VERSION = 1
+SUMS = "SHA256SUMS"
+_BLOCK = 512
+_COPY = 1 << 20
+_INDEX_FILES = {kb.CHUNKS, "manifest.json", "postings.json"}
+_NPY_RE = re.compile(r"^[a-z0-9_]+\.npy$")
+_MAX_META = 1 << 20
+
+
+class EmbeddingMismatch(ValueError):
+    """Векторы архива посчитаны другой моделью — поиск по ним с нашими запросами бессмыслен."""
+
+
+def _np():
+    return startup.lazy("numpy")
+
+
+# ---------- экспорт ----------
+
+def _npy_shape(fh: IO[bytes]) -> Tuple[int, ...]:
+    fmt = _np().lib.format
+    version = fmt.read_magic(fh)
+    read = fmt.read_array_header_1_0 if version == (1, 0) else fmt.read_array_header_2_0
+    shape = read(fh)[0]
+    fh.seek(0)
+    return shape
+
+
+def _dim(handles: Dict[str, IO[bytes]]) -> Optional[int]:
+    for key in ("vecs", "f16", "q8"):
+        fh = handles.get(f"index/{key}.npy")
+        if fh is not None:
+            shape = _npy_shape(fh)
+            return int(shape[1]) if len(shape) == 2 else None
+    fh = handles.get("index/dim.npy")
+    if fh is not None:
+        dim = int(_np().load(fh))
+        fh.seek(0)
+        return dim
+    return None
+
+
+def _open_generation(gem_id: str) -> Tuple[int, Dict[str, IO[bytes]]]:
+    """
+    Открывает все файлы текущего поколения сразу: открытые дескрипторы переживают GC поколения,
+    пока архив отдаётся. Если поколение удалили между чтением CURRENT и open — пробуем ещё раз.
+    """
+    for _ in range(3):
+        gen = kb.ensure_generation(gem_id)
+        if not gen:
+            raise FileNotFoundError(f"KB of gem {gem_id} is empty")
+        sdir = kb.generation_dir(gem_id, gen)
+        handles: Dict[str, IO[bytes]] = {}
+        try:
+            for p in sorted(sdir.iterdir()):
+                if p.is_file() and (p.name in _INDEX_FILES or _NPY_RE.match(p.name)):
+                    handles[f"index/{p.name}"] = open(p, "rb")
+            return gen, handles
+        except FileNotFoundError:
+            for fh in handles.values():
+                fh.close()
+    raise FileNotFoundError(f"KB of gem {gem_id} is being rewritten, retry")
+
+
+def _member(name: str, size: int, mtime: float) -> bytes:
+    ti = tarfile.TarInfo(name)
+    ti.size = size
+    ti.mtime = int(mtime)
+    ti.mode = 0o644
+    return ti.tobuf(tarfile.PAX_FORMAT)
+
+
+def open_export(gem_id: str, include_files: bool = True) -> Tuple[Dict, Iterator[bytes]]:
+    """
+    (kb.json, поток байтов tar). Файлы открываются до начала отдачи, так что 404/ошибки
+    случаются до первого байта ответа, а запись нового поколения во время отдачи не мешает.
+    """
+    gen, handles = _open_generation(gem_id)
+    try:
+        fdir = kb.files_dir(gem_id)
+        if include_files and fdir.exists():
+            for p in sorted(fdir.iterdir()):
+                if p.is_file():
+                    handles[f"files/{p.name}"] = open(p, "rb")
+        quant = startup.lazy(f"{__package__}.quant")
+        names = dict.fromkeys(Path(n).stem for n in handles if n.endswith(".npy"))
+        chunks = handles.get(f"index/{kb.CHUNKS}")
+        meta = {
+            "format": FORMAT,
+            "version": VERSION,
+            "gem_id": gem_id,
+            "generation": gen,
+            "created_at": time.time(),
+            "embedding": {**llm.embed_identity(), "dim": _dim(handles)},
+            "quantization": quant.kind_of(names),
+            "projection": startup.lazy(f"{__package__}.projection").kind_of(names),
+            "rows": startup.lazy(f"{__package__}.chunkstore").count(Path(chunks.name)) if chunks else 0,
+            "members": sorted(handles),
+        }
+    except BaseException:
+        for fh in handles.values():
+            fh.close()
+        raise
+    return meta, _stream(meta, handles)
+
+
+def _stream(meta: Dict, handles: Dict[str, IO[bytes]]) -> Iterator[bytes]:
+    sums: List[str] = []
+    now = meta["created_at"]
+    try:
+        body = json.dumps(meta, ensure_ascii=False, indent=2).encode("utf-8")
+        sums.append(f"{hashlib.sha256(body).hexdigest()}  kb.json\n")
+        yield _member("kb.json", len(body), now) + body + b"\0" * (-len(body) % _BLOCK)
+        for name, fh in handles.items():
+            st = os.fstat(fh.fileno())
+            yield _member(name, st.st_size, st.st_mtime)
+            h = hashlib.sha256()
+            left = st.st_size
+            while left > 0:
+                buf = fh.read(min(_COPY, left))
+                if not buf:
+                    # файл обрезали на ходу: заголовок с размером уже отдан, так что экспорт обрываем намеренно —
+                    # клиент получает недокачанный tar (соединение закрыто без финального чанка), импорт его отвергнет
+                    raise IOError(f"{name} changed during export")
+                h.update(buf)
+                left -= len(buf)
+                yield buf
+            yield b"\0" * (-st.st_size % _BLOCK)
+            sums.append(f"{h.hexdigest()}  {name}\n")
+        tail = "".join(sums).encode("ascii")
+        yield _member(SUMS, len(tail), now) + tail + b"\0" * (-len(tail) % _BLOCK)
+        yield b"\0" * (2 * _BLOCK)
+    finally:
+        for fh in handles.values():
+            fh.close()
+
+
+# ---------- импорт ----------
+
+def _copy(src: IO[bytes], dst: Path) -> str:
+    h = hashlib.sha256()
+    with open(dst, "wb") as out:
+        while True:
+            buf = src.read(_COPY)
+            if not buf:
+                break
+            h.update(buf)
+            out.write(buf)
+    return h.hexdigest()
+
+
+def _check_meta(meta: Dict, force: bool) -> None:
+    if meta.get("format") != FORMAT:
+        raise ValueError("Not a KB archive")
+    if meta.get("version") != VERSION:
+        raise ValueError(f"Unsupported KB archive version: {meta.get('version')}")
+    theirs = meta.get("embedding") or {}
+    ours = llm.embed_identity()
+    if not force and (theirs.get("backend"), theirs.get("model")) != (ours["backend"], ours["model"]):
+        raise EmbeddingMismatch(
+            f"Archive embeddings are {theirs.get('backend')}/{theirs.get('model')}, "
+            f"this server uses {ours['backend']}/{ours['model']}; pass force=true to import anyway"
+        )
+
+
+def _target(name: str, sdir: Path, staging: Path) -> Path:
+    # только плоские имена из известного набора: никаких путей наружу, ссылок и устройств
+    folder, _, base = name.partition("/")
+    if folder == "index" and (base in _INDEX_FILES or _NPY_RE.match(base)):
+        return sdir / base
+    if folder == "files" and base and base == Path(base).name and base not in (".", ".."):
+        return staging / base
+    raise ValueError(f"Unexpected archive member: {name}")
+
+
+def _verify_arrays(sdir: Path, meta: Dict) -> Dict:
+    np = _np()
+    quant = startup.lazy(f"{__package__}.quant")
+    chunkstore = startup.lazy(f"{__package__}.chunkstore")
+    if not (sdir / kb.CHUNKS).exists() or not (sdir / "manifest.json").exists():
+        raise ValueError("Archive has no chunk store or manifest")
+    try:
+        # заголовки .npy и размер файла проверяет сам np.load; object-массивы (pickle) не открываются
+        arrays = {p.stem: np.load(p, mmap_mode="r") for p in sdir.glob("*.npy")}
+        rows = chunkstore.count(sdir / kb.CHUNKS)
+    except Exception as e:
+        raise ValueError(f"Corrupted KB archive: {e}")
+    if quant.size(arrays) != rows or rows != meta.get("rows", rows):
+        raise ValueError(f"Row count mismatch: vectors {quant.size(arrays)}, chunks {rows}")
+    return {"rows": rows, "quantization": quant.kind_of(arrays)}
+
+
+def _replace_files(gem_id: str, staging: Path) -> None:
+    fdir = kb.files_dir(gem_id)
+    old = fdir.with_name(".files.old")
+    shutil.rmtree(old, ignore_errors=True)
+    if fdir.exists():
+        fdir.rename(old)
+    staging.rename(fdir)
+    shutil.rmtree(old, ignore_errors=True)
+
+
+def _extract(tar: tarfile.TarFile, sdir: Path, staging: Path, force: bool):
+    """(kb.json, sha256 распакованных членов, SHA256SUMS архива)."""
+    meta: Optional[Dict] = None
+    got: Dict[str, str] = {}
+    sums: Optional[Dict[str, str]] = None
+    for m in tar:
+        if not m.isfile():
+            raise ValueError(f"Unexpected archive member: {m.name}")
+        fh = tar.extractfile(m)
+        if meta is None:
+            # kb.json первым: модель эмбеддингов проверяем до распаковки гигабайтов векторов
+            if m.name != "kb.json" or m.size > _MAX_META:
+                raise ValueError("Not a KB archive")
+            raw = fh.read()
+            meta = json.loads(raw)
+            _check_meta(meta, force)
+            got["kb.json"] = hashlib.sha256(raw).hexdigest()
+        elif m.name == SUMS:
+            sums = {}
+            for line in fh.read(_MAX_META).decode("ascii").splitlines():
+                digest, _, name = line.partition("  ")
+                sums[name] = digest
+        elif sums is not None:
+            raise ValueError(f"Archive member after {SUMS}: {m.name}")
+        else:
+            got[m.name] = _copy(fh, _target(m.name, sdir, staging))
+    if meta is None:
+        raise ValueError("Empty archive")
+    if sums is None:
+        raise ValueError(f"Archive has no {SUMS}")
+    return meta, got, sums
+
+
+def import_archive(gem_id: str, src: IO[bytes], force: bool = False) -> Dict:
+    """
+    Читает tar потоком (так что подходит и сжатый tar.gz) прямо в каталог нового поколения.
+    Любая ошибка — ValueError, поколение не публикуется и текущий индекс не меняется.
+    """
+    with kb.staged_generation(gem_id) as sdir:
+        staging = sdir.parent / ".import-files"
+        shutil.rmtree(staging, ignore_errors=True)
+        staging.mkdir()
+        try:
+            try:
+                with tarfile.open(fileobj=src, mode="r|*") as tar:
+                    meta, got, sums = _extract(tar, sdir, staging, force)
+            except tarfile.TarError as e:
+                raise ValueError(f"Broken archive: {e}")
+            bad = sorted(n for n in sums.keys() | got.keys() if sums.get(n) != got.get(n))
+            if bad:
+                raise ValueError(f"Checksum mismatch: {', '.join(bad)}")
+            info = _verify_arrays(sdir, meta)
+            n_files = sum(1 for n in got if n.startswith("files/"))
+            _replace_files(gem_id, staging)  # files/ соответствует импортированному индексу, даже если пуст
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+    return {
+        "imported": True,
+        "generation": int(sdir.name),
+        "source_gem": meta.get("gem_id"),
+        "embedding": meta.get("embedding"),
+        "forced": force,
+        "files": n_files,
+        **info,
+    }
@@ -1,12 +1,16 @@
 # app/llm.py
+import json
 import os
 import re
-from typing import List, Dict, Optional
+import threading
+import time
+from typing import Iterator, List, Dict, Optional
 
 import requests
-import google.generativeai as genai
 from dotenv import load_dotenv
 
+from . import startup, tracing
+
 load_dotenv()
 
 # -------- Общие настройки --------
@@ -18,6 +22,7 @@ _EMBED_TIMEOUT  = float(os.getenv("EMBED_TIMEOUT", "120"))
 # -------- Чат-модели --------
 OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL", "http://127.0.0.1:11434")
 OLLAMA_MODEL    = os.getenv("OLLAMA_MODEL", "llama3.1:8b")
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE")  # например "30m" или "-1"; по умолчанию решает Ollama
 
 OPENAI_API_KEY  = os.getenv("OPENAI_API_KEY")
 OPENAI_MODEL    = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
@@ -26,6 +31,7 @@ GEMINI_API_KEY  = os.getenv("GEMINI_API_KEY")
 GEMINI_MODEL    = os.getenv("GEMINI_MODEL", "gemini-2.0-flash")
 
 # -------- Эмбеддинги --------
+# EMBED_BACKEND=local — встроенный эмбеддер на хэшированных n-граммах (app/local_embed.py), без сети
 OLLAMA_EMBED_MODEL = os.getenv("OLLAMA_EMBED_MODEL", "nomic-embed-text")
 OPENAI_EMBED_MODEL = os.getenv("OPENAI_EMBED_MODEL", "text-embedding-3-small")
 GEMINI_EMBED_MODEL = os.getenv("GEMINI_EMBED_MODEL", "text-embedding-004")
@@ -43,6 +49,29 @@ def _pick_backend(requested: Optional[str]) -> str:
         return "gemini" if GEMINI_API_KEY else "ollama"
     return b
 
+_genai_lock = threading.Lock()
+_genai_ready = False
+
+def _genai():
+    # SDK Gemini тяжёлый — грузим только при первом обращении к этому бэкенду; configure — один раз
+    global _genai_ready
+    genai = startup.lazy("google.generativeai")
+    if not _genai_ready:
+        with _genai_lock:
+            if not _genai_ready:
+                genai.configure(api_key=GEMINI_API_KEY)
+                _genai_ready = True
+    return genai
+
+def _keep_alive() -> Dict:
+    return {"keep_alive": OLLAMA_KEEP_ALIVE} if OLLAMA_KEEP_ALIVE else {}
+
+def resolve(model_override: Optional[str] = None):
+    """(backend, модель) для чата — то же, что выберет chat() при этих настройках."""
+    backend = _pick_backend(DEFAULT_BACKEND)
+    default = {"ollama": OLLAMA_MODEL, "openai": OPENAI_MODEL, "gemini": GEMINI_MODEL}[backend]
+    return backend, model_override or default
+
 # убираем управляющие символы/мусор и ограничиваем длину
 _CONTROL_RE = re.compile(r'[\x00-\x08\x0B\x0C\x0E-\x1F]+')
 def _sanitize_for_embed(s: str, max_len: int = 8000) -> str:
@@ -63,14 +92,17 @@ def chat(
     messages: List[Dict[str, str]],
     temperature: float = 0.2,
     model_override: Optional[str] = None,
+    backend: Optional[str] = None,
 ) -> str:
-    backend = _pick_backend(DEFAULT_BACKEND)
-    if backend == "ollama":
-        return _chat_ollama(messages, temperature, model_override or OLLAMA_MODEL)
-    elif backend == "openai":
-        return _chat_openai(messages, temperature, model_override or OPENAI_MODEL)
-    elif backend == "gemini":
-        return _chat_gemini(messages, temperature, model_override or GEMINI_MODEL)
+    # backend — уже выбранный через resolve() (скомпилированная gem), иначе выбираем здесь
+    backend = backend or _pick_backend(DEFAULT_BACKEND)
+    with tracing.span("llm", backend=backend, model=model_override or "default", messages=len(messages)):
+        if backend == "ollama":
+            return _chat_ollama(messages, temperature, model_override or OLLAMA_MODEL)
+        elif backend == "openai":
+            return _chat_openai(messages, temperature, model_override or OPENAI_MODEL)
+        elif backend == "gemini":
+            return _chat_gemini(messages, temperature, model_override or GEMINI_MODEL)
     raise RuntimeError(f"Unknown backend: {backend}")
 
 def _chat_ollama(messages: List[Dict[str, str]], temperature: float, model: str) -> str:
@@ -80,6 +112,7 @@ def _chat_ollama(messages: List[Dict[str, str]], temperature: float, model: str)
         "messages": messages,
         "stream": False,
         "options": {"temperature": temperature},
+        **_keep_alive(),
     }
     resp = requests.post(url, json=payload, timeout=_HTTP_TIMEOUT)
     resp.raise_for_status()
@@ -98,10 +131,7 @@ def _chat_openai(messages: List[Dict[str, str]], temperature: float, model: str)
     data = resp.json()
     return data["choices"][0]["message"]["content"]
 
-def _chat_gemini(messages: List[Dict[str, str]], temperature: float, model: str) -> str:
-    genai.configure(api_key=GEMINI_API_KEY)
-    model = genai.GenerativeModel(model)
-    
+def _gemini_prompt(messages: List[Dict[str, str]]) -> str:
     # Конвертируем messages в формат Gemini
     prompt = ""
     for msg in messages:
@@ -113,6 +143,11 @@ def _chat_gemini(messages: List[Dict[str, str]], temperature: float, model: str)
             prompt += f"User: {content}\n\n"
         elif role == "assistant":
             prompt += f"Assistant: {content}\n\n"
+    return prompt
+
+def _chat_gemini(messages: List[Dict[str, str]], temperature: float, model: str) -> str:
+    genai = _genai()
+    model = genai.GenerativeModel(model)
     
     generation_config = genai.types.GenerationConfig(
         temperature=temperature,
@@ -120,15 +155,124 @@ def _chat_gemini(messages: List[Dict[str, str]], temperature: float, model: str)
     )
     
     response = model.generate_content(
-        prompt,
+        _gemini_prompt(messages),
         generation_config=generation_config
     )
     return response.text
 
 
+# ==================== STREAMING ====================
+
+def chat_stream(
+    messages: List[Dict[str, str]],
+    temperature: float = 0.2,
+    model_override: Optional[str] = None,
+    backend: Optional[str] = None,
+    cancel: Optional[threading.Event] = None,
+) -> Iterator[str]:
+    """
+    Потоковая генерация: отдаёт куски текста по мере прихода.
+    cancel.set() прерывает генерацию: HTTP-ответ Ollama/OpenAI закрывается, и сервер модели
+    перестаёт генерировать (Ollama останавливается при обрыве соединения клиента).
+    """
+    backend = backend or _pick_backend(DEFAULT_BACKEND)
+    cancel = cancel or threading.Event()
+    with tracing.span("llm", backend=backend, model=model_override or "default", messages=len(messages), stream=True):
+        if backend == "gemini":
+            genai = _genai()
+            response = genai.GenerativeModel(model_override or GEMINI_MODEL).generate_content(
+                _gemini_prompt(messages),
+                generation_config=genai.types.GenerationConfig(temperature=temperature, max_output_tokens=8192),
+                stream=True,
+            )
+            for chunk in response:
+                if cancel.is_set():
+                    break
+                if chunk.text:
+                    yield chunk.text
+            return
+
+        if backend == "ollama":
+            url = f"{OLLAMA_BASE_URL}/api/chat"
+            headers = None
+            payload = {
+                "model": model_override or OLLAMA_MODEL, "messages": messages, "stream": True,
+                "options": {"temperature": temperature}, **_keep_alive(),
+            }
+        elif backend == "openai":
+            url = "https://api.openai.com/v1/chat/completions"
+            headers = {"Authorization": f"Bearer {OPENAI_API_KEY}", "Content-Type": "application/json"}
+            payload = {"model": model_override or OPENAI_MODEL, "messages": messages,
+                       "temperature": temperature, "stream": True}
+        else:
+            raise RuntimeError(f"Unknown backend: {backend}")
+
+        with requests.post(url, headers=headers, json=payload, timeout=_HTTP_TIMEOUT, stream=True) as resp:
+            resp.raise_for_status()
+            for line in resp.iter_lines():
+                if cancel.is_set():
+                    break  # выход из with закрывает соединение — бэкенд прекращает генерацию
+                if not line:
+                    continue
+                if backend == "ollama":
+                    data = json.loads(line)
+                    piece = data.get("message", {}).get("content", "")
+                    done = data.get("done")
+                else:
+                    line = line.decode("utf-8") if isinstance(line, bytes) else line
+                    if not line.startswith("data:"):
+                        continue
+                    body = line[5:].strip()
+                    if body == "[DONE]":
+                        break
+                    choices = json.loads(body).get("choices") or [{}]
+                    piece = (choices[0].get("delta") or {}).get("content") or ""
+                    done = False
+                if piece:
+                    yield piece
+                if done:
+                    break
+
+
 # ==================== EMBEDDINGS ====================
 
+_EMBED_BACKENDS = ("local", "openai", "gemini", "ollama")
+
+
+def _embed_backend() -> str:
+    backend = EMBED_BACKEND
+    if backend not in _EMBED_BACKENDS:
+        backend = "ollama"  # неизвестное значение _embed и раньше отправлял в Ollama — идентичность та же
+    if backend == "openai" and not OPENAI_API_KEY:
+        backend = "gemini" if GEMINI_API_KEY else "ollama"
+    if backend == "gemini" and not GEMINI_API_KEY:
+        backend = "ollama"
+    return backend
+
+
+def _local_embed():
+    return startup.lazy(f"{__package__}.local_embed")
+
+
+def embed_identity(model_override: Optional[str] = None) -> Dict[str, str]:
+    """Какой бэкенд/модель реально считает эмбеддинги — векторы разных моделей несовместимы."""
+    backend = _embed_backend()
+    if backend == "local":
+        return {"backend": backend, "model": _local_embed().MODEL}
+    model = {
+        "openai": OPENAI_EMBED_MODEL,
+        "gemini": "text-embedding-004",  # см. _embed: модель Gemini зашита
+        "ollama": OLLAMA_EMBED_MODEL,
+    }[backend]
+    return {"backend": backend, "model": model_override or model}
+
+
 def embed(texts: List[str], model_override: Optional[str] = None) -> List[List[float]]:
+    with tracing.span("embed", backend=EMBED_BACKEND, n=len(texts)):
+        return _embed(texts, model_override)
+
+
+def _embed(texts: List[str], model_override: Optional[str] = None) -> List[List[float]]:
     """
     Надёжная обёртка над Ollama/OpenAI/Gemini эмбеддингами.
     - Очистка текста от управляющих символов/мусора.
@@ -136,15 +280,15 @@ def embed(texts: List[str], model_override: Optional[str] = None) -> List[List[f
     - Gemini: text-embedding-004 (batch).
     - Ollama: по одному тексту; пробуем {"prompt": ...} → {"input": ...};
       если пусто — фолбэки моделей (mxbai-embed-large → nomic-embed-text).
+    - local: в процессе, весь батч за один вызов numpy.
+    Если эмбеддинг получить не удалось — RuntimeError: нулевые векторы молча портили бы индекс.
     """
-    backend = EMBED_BACKEND
-    if backend == "openai" and not OPENAI_API_KEY:
-        backend = "gemini" if GEMINI_API_KEY else "ollama"
-    if backend == "gemini" and not GEMINI_API_KEY:
-        backend = "ollama"
-
+    backend = _embed_backend()
     sanitized = [_sanitize_for_embed(str(t or "")) for t in texts]
 
+    if backend == "local":
+        return _local_embed().embed(sanitized).tolist()
+
     if backend == "openai":
         url = "https://api.openai.com/v1/embeddings"
         headers = {"Authorization": f"Bearer {OPENAI_API_KEY}", "Content-Type": "application/json"}
@@ -156,7 +300,7 @@ def embed(texts: List[str], model_override: Optional[str] = None) -> List[List[f
         return [[float(x) for x in d["embedding"]] for d in data]
     
     if backend == "gemini":
-        genai.configure(api_key=GEMINI_API_KEY)
+        genai = _genai()
         
         embeddings = []
         for text in sanitized:
@@ -168,9 +312,7 @@ def embed(texts: List[str], model_override: Optional[str] = None) -> List[List[f
                 )
                 embeddings.append([float(x) for x in result['embedding']])
             except Exception as e:
-                print(f"Ошибка эмбеддинга Gemini: {e}")
-                # Фолбэк на нулевой вектор
-                embeddings.append([0.0] * 768)
+                raise RuntimeError(f"Gemini embedding failed: {e}") from e
         return embeddings
 
     # ---- OLLAMA ----
@@ -181,7 +323,7 @@ def embed(texts: List[str], model_override: Optional[str] = None) -> List[List[f
     def _one(model: str, text: str) -> List[float]:
         # сначала формат prompt, затем input — встречаются обе реализации
         for payload in ({"prompt": text}, {"input": text}):
-            r = requests.post(url, json={"model": model, **payload}, timeout=_EMBED_TIMEOUT)
+            r = requests.post(url, json={"model": model, **payload, **_keep_alive()}, timeout=_EMBED_TIMEOUT)
             r.raise_for_status()
             data = r.json()
             emb = data.get("embedding") or (data.get("data", [{}])[0].get("embedding"))
@@ -198,12 +340,39 @@ def embed(texts: List[str], model_override: Optional[str] = None) -> List[List[f
                 if v:
                     break
         if not v:
-            # как последняя защита — вернём нулевой вектор, чтобы пайплайн не падал
-            # (или можно raise RuntimeError — на твой выбор)
-            v = [0.0] * 768
+            raise RuntimeError(f"Ollama returned no embedding (models: {primary}, {', '.join(fallbacks)})")
         out.append(v)
     return out
 
 
 def embed_one(text: str, model_override: Optional[str] = None) -> List[float]:
     return embed([text], model_override=model_override)[0]
+
+
+# ==================== WARM-UP ====================
+
+def warmup(model_override: Optional[str] = None, embed_model: Optional[str] = None) -> Dict[str, float]:
+    """
+    Крошечная генерация и эмбеддинг, чтобы первый реальный запрос не платил за загрузку
+    модели в Ollama, импорт/configure SDK и установку соединений. Возвращает ms по шагам;
+    ошибки пробрасываются — решает вызывающий (см. prewarm).
+    """
+    backend = _pick_backend(DEFAULT_BACKEND)
+    out: Dict[str, float] = {}
+    t = time.perf_counter()
+    if backend == "ollama":
+        # пустой prompt в /api/generate только загружает модель в память (и продлевает keep_alive)
+        r = requests.post(
+            f"{OLLAMA_BASE_URL}/api/generate",
+            json={"model": model_override or OLLAMA_MODEL, "prompt": "", "stream": False, **_keep_alive()},
+            timeout=_HTTP_TIMEOUT,
+        )
+        r.raise_for_status()
+    else:
+        chat([{"role": "user", "content": "ping"}], temperature=0.0, model_override=model_override)
+    out[f"chat:{backend}:{model_override or 'default'}"] = round((time.perf_counter() - t) * 1000, 1)
+
+    t = time.perf_counter()
+    embed(["warm-up"], model_override=embed_model)
+    out[f"embed:{EMBED_BACKEND}:{embed_model or 'default'}"] = round((time.perf_counter() - t) * 1000, 1)
+    return out
@@ -0,0 +1,132 @@
+# app/local_embed.py
+"""
+Встроенный эмбеддер без сети (EMBED_BACKEND=local): хэшированные n-граммы + фиксированная случайная проекция.
+- признаки: слова, пары соседних слов и символьные 3–5-граммы (с границами слов),
+  хэш -> одна из BUCKETS корзин; вес корзины — log(1 + частота);
+- проекция: корзина -> строка ±1 длины LOCAL_EMBED_DIM (int8, генерируется splitmix64 из номера
+  корзины, поэтому одинакова во всех процессах и версиях numpy), вектор текста — взвешенная сумма строк;
+- батч чанков обрабатывается целиком: символьные n-граммы считаются одним проходом numpy
+  по склеенному тексту всего батча, суммирование — через np.add.reduceat.
+Качество ниже нейронных моделей, зато запрос эмбеддится за доли миллисекунды в процессе, без Ollama/API:
+годится как быстрый первый этап или как единственный бэкенд для gem, где важна задержка.
+"""
+from __future__ import annotations
+import os
+import re
+import threading
+import zlib
+from typing import List, Optional
+
+import numpy as np
+
+DIM = int(os.getenv("LOCAL_EMBED_DIM", "256"))
+BUCKETS = 1 << 16
+MODEL = f"hashed-ngrams-v1-{DIM}"  # идентичность для kbarchive: другой DIM — несовместимые векторы
+CHAR_NGRAMS = (3, 4, 5)
+_BLOCK = 1 << 15  # строк признаков на один reduceat: ограничивает временную матрицу (_BLOCK x DIM)
+_WORD_RE = re.compile(r"\w+")
+_SEP = "\x00"
+_P = np.uint64(1099511628211)  # множитель полиномиального хэша окна (FNV prime)
+_SALT_WORD, _SALT_BIGRAM, _SALT_CHAR = np.uint64(0x9E37), np.uint64(0x7F4A), np.uint64(0x5851)
+_W_WORD, _W_BIGRAM, _W_CHAR = 1.0, 0.7, 0.35
+
+_proj: Optional[np.ndarray] = None
+_proj_lock = threading.Lock()
+
+
+def _mix(x: np.ndarray) -> np.ndarray:
+    # splitmix64: переполнение uint64 в numpy — ожидаемое поведение
+    with np.errstate(over="ignore"):
+        x = x + np.uint64(0x9E3779B97F4A7C15)
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return x ^ (x >> np.uint64(31))
+
+
+def _projection() -> np.ndarray:
+    """(BUCKETS, DIM) int8 из ±1; строится один раз на процесс (~BUCKETS*DIM байт)."""
+    global _proj
+    if _proj is None:
+        with _proj_lock:
+            if _proj is None:
+                proj = np.empty((BUCKETS, DIM), dtype=np.int8)
+                step = 4096  # по частям: uint64-промежуточные для всей матрицы заняли бы сотни МБ
+                for s in range(0, BUCKETS, step):
+                    cell = np.arange(s * DIM, (s + step) * DIM, dtype=np.uint64).reshape(step, DIM)
+                    proj[s:s + step] = np.where(_mix(cell) >> np.uint64(63), 1, -1)
+                _proj = proj
+    return _proj
+
+
+def _char_features(texts: List[str]):
+    """(строка батча, хэш) для всех символьных n-грамм батча одним проходом."""
+    joined = _SEP.join(texts)
+    codes = np.frombuffer(joined.encode("utf-32-le"), dtype="<u4").astype(np.uint64)
+    lens = np.fromiter((len(t) for t in texts), dtype=np.int64, count=len(texts))
+    # номер текста для каждой позиции склейки; у разделителей -1, так что окна через них отбрасываются
+    owner = np.repeat(np.arange(len(texts)), lens + 1)[:len(codes)]
+    owner[np.cumsum(lens + 1)[:-1] - 1] = -1
+    rows, hashes = [], []
+    with np.errstate(over="ignore"):
+        for n in CHAR_NGRAMS:
+            m = len(codes) - n + 1
+            if m <= 0:
+                continue
+            h = codes[:m].copy()
+            for i in range(1, n):
+                h = h * _P + codes[i:i + m]
+            # окно не должно залезать на соседний текст
+            ok = owner[:m] == owner[n - 1:n - 1 + m]
+            rows.append(owner[:m][ok])
+            hashes.append(h[ok] ^ (_SALT_CHAR + np.uint64(n)))
+    if not rows:
+        return np.zeros(0, np.int64), np.zeros(0, np.uint64)
+    return np.concatenate(rows), np.concatenate(hashes)
+
+
+def _word_features(words: List[List[str]]):
+    rows, hashes, w = [], [], []
+    for r, ws in enumerate(words):
+        if not ws:
+            continue
+        h = np.fromiter((zlib.crc32(x.encode("utf-8")) for x in ws), dtype=np.uint64, count=len(ws))
+        rows.append(np.full(len(h), r))
+        hashes.append(h ^ (_SALT_WORD << np.uint64(32)))
+        w.append(np.full(len(h), _W_WORD, dtype=np.float32))
+        if len(h) > 1:
+            with np.errstate(over="ignore"):
+                rows.append(np.full(len(h) - 1, r))
+                hashes.append((h[:-1] * _P + h[1:]) ^ (_SALT_BIGRAM << np.uint64(32)))
+            w.append(np.full(len(h) - 1, _W_BIGRAM, dtype=np.float32))
+    if not rows:
+        return np.zeros(0, np.int64), np.zeros(0, np.uint64), np.zeros(0, np.float32)
+    return np.concatenate(rows), np.concatenate(hashes), np.concatenate(w)
+
+
+def embed(texts: List[str]) -> np.ndarray:
+    """(len(texts), DIM) float32, L2-нормированные; пустой текст — нулевой вектор."""
+    n = len(texts)
+    out = np.zeros((n, DIM), dtype=np.float32)
+    if n == 0:
+        return out
+    words = [_WORD_RE.findall(t.lower()) for t in texts]
+    # символьные n-граммы по нормализованному тексту: " слово слово " — с границами слов
+    cr, ch = _char_features([f" {' '.join(ws)} " if ws else "" for ws in words])
+    wr, wh, ww = _word_features(words)
+    rows = np.concatenate([wr, cr]).astype(np.int64)
+    buckets = (_mix(np.concatenate([wh, ch])) % np.uint64(BUCKETS)).astype(np.int64)
+    weights = np.concatenate([ww, np.full(len(ch), _W_CHAR, dtype=np.float32)])
+    if rows.size == 0:
+        return out
+
+    # одна запись на (строка, корзина), log-сглаживание частот; unique сортирует по строке
+    keys, inv = np.unique(rows * BUCKETS + buckets, return_inverse=True)
+    tf = np.log1p(np.bincount(inv.ravel(), weights=weights)).astype(np.float32)
+    key_rows, key_buckets = keys // BUCKETS, keys % BUCKETS
+    proj = _projection()
+    for s in range(0, len(keys), _BLOCK):
+        r, b, w = key_rows[s:s + _BLOCK], key_buckets[s:s + _BLOCK], tf[s:s + _BLOCK]
+        starts = np.flatnonzero(np.r_[True, r[1:] != r[:-1]])
+        out[r[starts]] += np.add.reduceat(proj[b].astype(np.float32) * w[:, None], starts, axis=0)
+    norms = np.linalg.norm(out, axis=1, keepdims=True)
+    return out / np.where(norms > 0, norms, 1.0)
@@ -1,32 +1,77 @@
 # app/main.py
-from fastapi import FastAPI, HTTPException, UploadFile, File
-from typing import Any, List, Optional
-from pathlib import Path
-import re
-
-from .models import Gem, GemCreate, GemUpdate, ChatRequest, ChatResponse, Message
-from . import store
-from .tools import list_tools, run_tool
-from .llm import chat as llm_chat
-from . import kb
-from fastapi.responses import HTMLResponse
-
-app = FastAPI(title="Gems Agent API", version="0.2.0")
-
-TOOLS_INSTRUCTION = (
-    "You have access to the following tools: {tools}.\n"
-    "When you want to call a tool, reply with ONLY this JSON (no extra text):\n"
-    "{{\"tool\":\"<tool_name>\",\"input\":\"<text>\"}}\n"
-    "After the tool result is provided, produce a concise final answer for the user.\n"
-)
+from . import startup
+with startup.track_imports():  # разбивка времени импортов при старте воркера
+    from contextlib import asynccontextmanager
+    from fastapi import FastAPI, HTTPException, UploadFile, File, Form, Request, Query, Depends, Header
+    from fastapi import WebSocket, WebSocketDisconnect
+    from typing import Iterator, List, Optional
+    from pathlib import Path
+    import asyncio
+    import codecs
+    import json
+    import os
+    import queue
+    import secrets
+    import tempfile
+    import threading
+    from pydantic import ValidationError
+
+    from .models import Gem, GemCreate, GemUpdate, ChatRequest, ChatResponse, Message, KBFilter, SummarizeRequest
+    from . import store
+    from .tools import list_tools
+    from . import kb, kbarchive, bulk, qcache, routing, summarize, sync, agent, batch, prewarm, stats, tracing, profiler, httpcache
+    from fastapi.responses import HTMLResponse, StreamingResponse, JSONResponse, PlainTextResponse
+    from fastapi.middleware.gzip import GZipMiddleware
+    from starlette.concurrency import run_in_threadpool
+    from starlette.requests import ClientDisconnect
+    try:
+        from brotli_asgi import BrotliMiddleware  # необязательно: br для браузеров, gzip — фолбэк
+    except ImportError:
+        BrotliMiddleware = None
+    try:
+        from starlette.middleware.gzip import DEFAULT_EXCLUDED_CONTENT_TYPES
+        _GZIP_OPTS = {"exclude_content_types": (*DEFAULT_EXCLUDED_CONTENT_TYPES, "application/x-ndjson", "application/x-tar")}
+    except ImportError:  # старый starlette: исключений по типу нет
+        _GZIP_OPTS = {}
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    startup.finish()
+    startup.log_report()
+    prewarm.start()  # в фоне: /health вернёт 200 только после прогрева
+    if profiler.DEBUG_TOKEN:
+        profiler.monitor.start()
+    sync.syncer.start()  # только если задан KB_SYNC_ROOT
+    yield
+    sync.syncer.stop()
+    bulk.shutdown()
+    profiler.monitor.stop()
+    stats.flush()
+
+app = FastAPI(title="Gems Agent API", version="0.2.0", lifespan=lifespan)
+app.add_middleware(tracing.TracingMiddleware)  # Server-Timing, X-Request-ID, JSON-лог спанов
+# сжатие ответов от 1 КБ; NDJSON-стримы не сжимаем, иначе строки копятся в буфере компрессора
+if BrotliMiddleware is not None:
+    app.add_middleware(BrotliMiddleware, minimum_size=1024, gzip_fallback=True, excluded_handlers=[r"^/chat/batch", r"/kb/export$", r"/archive$"])
+else:
+    app.add_middleware(GZipMiddleware, minimum_size=1024, **_GZIP_OPTS)
 
 @app.get("/health")
 def health():
+    if not prewarm.is_ready():
+        return JSONResponse(status_code=503, content={"status": "warming", "tools": list_tools()})
     return {"status": "ok", "tools": list_tools()}
 
+@app.get("/health/startup")
+def health_startup():
+    return {**startup.report(), "prewarm": prewarm.report()}
+
 # ---------- Templates ----------
 @app.get("/templates")
-def get_templates():
+def get_templates(request: Request):
+    return httpcache.respond(request, _TEMPLATES)
+
+def _templates():
     return {
         "templates": [
             {
@@ -128,37 +173,128 @@ Always be thorough in your analysis, explain your reasoning clearly, and provide
         ]
     }
 
+_TEMPLATES = httpcache.Cached(httpcache.dumps(_templates()))
+
 # ---------- Gems CRUD ----------
+_gems_memo = httpcache.Memo(size=256)
+_GEM_FIELDS = set(Gem.model_fields)
+
 @app.get("/gems")
-def list_gems():
-    return [g.model_dump() for g in store.load_all()]
+def list_gems(
+    request: Request,
+    limit: Optional[int] = Query(None, ge=1, le=500),
+    cursor: Optional[str] = None,
+    q: Optional[str] = Query(None, max_length=100),
+    tool: Optional[str] = None,
+    fields: Optional[str] = Query(None, description="например id,name"),
+):
+    """
+    Без параметров — все gem (как раньше). С limit/cursor/q/tool — страница, отсортированная по имени;
+    курсор следующей страницы — в заголовке X-Next-Cursor, всего совпадений — в X-Total-Count.
+    """
+    proj = None
+    if fields:
+        proj = {f.strip() for f in fields.split(",") if f.strip()}
+        if proj - _GEM_FIELDS:
+            raise HTTPException(400, f"Unknown fields: {', '.join(sorted(proj - _GEM_FIELDS))}")
+
+    def _dump(gems):
+        return httpcache.dumps([g.model_dump(include=proj) for g in gems])
+
+    if limit is None and cursor is None and not q and not tool:
+        # тело собирается один раз на поколение gems.json, повторный GET с If-None-Match — 304
+        etag, gems = store.snapshot()
+        key = (etag, fields)
+        body = _gems_memo.get(key, lambda: httpcache.Cached(_dump(gems), etag=None if fields else etag))
+        return httpcache.respond(request, body)
+
+    try:
+        page = store.search(q=q, tool=tool, cursor=cursor, limit=limit or 50)
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+    headers = {"X-Total-Count": str(page["total"])}
+    if page["next_cursor"]:
+        headers["X-Next-Cursor"] = page["next_cursor"]
+    key = (page["etag"], fields, q, tool, cursor, limit)
+    body = _gems_memo.get(key, lambda: httpcache.Cached(_dump(page["gems"])))
+    return httpcache.respond(request, body, headers=headers)
 
 @app.get("/gems/{gem_id}")
-def get_gem(gem_id: str):
+def get_gem(gem_id: str, request: Request):
     gem = store.get_gem(gem_id)
     if not gem:
         raise HTTPException(404, "Gem not found")
-    return gem.model_dump()
+    etag = f"{store.gem_hash(gem)}-v{gem.version}"
+    return httpcache.respond(request, httpcache.Cached(httpcache.dumps(gem.model_dump()), etag=etag))
+
+def _check_source_dir(source_dir: Optional[str]) -> None:
+    if source_dir:
+        try:
+            sync.resolve_dir(source_dir)
+        except ValueError as e:
+            raise HTTPException(400, str(e))
 
 @app.post("/gems")
 def create_gem(body: GemCreate):
+    _check_source_dir(body.source_dir)
     new = Gem(
         id=store.new_id(),
         name=body.name,
         system_prompt=body.system_prompt,
         tools=body.tools or [],
         temperature=body.temperature or 0.2,
-        model=body.model
+        model=body.model,
+        chunk_tokens=body.chunk_tokens,
+        chunk_overlap=body.chunk_overlap,
+        context_tokens=body.context_tokens,
+        min_score=body.min_score,
+        quantization=body.quantization,
+        projection=body.projection,
+        projection_dim=body.projection_dim,
+        source_dir=body.source_dir or None,
+        routing=body.routing,
+        small_model=body.small_model or None,
     )
     store.add_gem(new)
     return new.model_dump()
 
+# настройки формата индекса KB: действуют при записи в пустой индекс, существующий — только пересборкой
+_INDEX_FIELDS = ("quantization", "projection", "projection_dim")
+
+def _index_settings(gem: Gem) -> dict:
+    return {k: getattr(gem, k) for k in _INDEX_FIELDS}
+
 @app.put("/gems/{gem_id}")
-def update_gem(gem_id: str, patch: GemUpdate):
+def update_gem(gem_id: str, patch: GemUpdate, reindex: bool = False):
+    """
+    Смена формата индекса (quantization, projection, projection_dim) при непустой KB — 409, если не передан reindex=true:
+    тогда KB пересобирается из сохранённых файлов с новыми настройками (все чанки эмбеддятся заново).
+    """
+    _check_source_dir(patch.source_dir)
+    gem = store.get_gem(gem_id)
+    if not gem:
+        raise HTTPException(404, "Gem not found")
+    try:
+        # патч проверяется вместе с текущими полями: chunk_overlap=500 при chunk_tokens=400 у gem — 422, а не 500
+        Gem(**{**gem.model_dump(), **patch.model_dump(exclude_none=True)})
+    except ValidationError as e:
+        raise HTTPException(422, "; ".join(err["msg"] for err in e.errors()))
+    changed = [k for k in _INDEX_FIELDS if getattr(patch, k) is not None and getattr(patch, k) != getattr(gem, k)]
+    # пересборка нужна, только если индекс уже хранится иначе, чем просят новые настройки
+    drift = kb.settings_drift(gem_id, {**_index_settings(gem), **{k: getattr(patch, k) for k in changed}}) if changed else {}
+    rebuild = bool(drift)
+    if rebuild and not reindex:
+        raise HTTPException(409, f"KB index already exists; changing {', '.join(drift)} requires ?reindex=true")
     updated = store.update_gem(gem_id, patch.model_dump())
     if not updated:
         raise HTTPException(404, "Gem not found")
-    return updated.model_dump()
+    out = updated.model_dump()
+    if rebuild:
+        out["reindexed"] = kb.rebuild(
+            gem_id, quantization=updated.quantization,
+            projection=updated.projection, projection_dim=updated.projection_dim,
+        )
+    return out
 
 @app.delete("/gems/{gem_id}")
 def remove_gem(gem_id: str):
@@ -169,8 +305,9 @@ def remove_gem(gem_id: str):
 
 # ---------- KB/Files ----------
 @app.post("/gems/{gem_id}/files")
-async def upload_files(gem_id: str, files: List[UploadFile] = File(...)):
-    gem = store.get_gem(gem_id)
+async def upload_files(gem_id: str, files: List[UploadFile] = File(...), tags: str = Form("")):
+    with tracing.span("gem"):
+        gem = store.get_gem(gem_id)
     if not gem:
         raise HTTPException(404, "Gem not found")
 
@@ -190,12 +327,21 @@ async def upload_files(gem_id: str, files: List[UploadFile] = File(...)):
                 continue  # Пропускаем пустые файлы
                 
             p.write_bytes(content)
-        tmp_paths.append(p)
+            tmp_paths.append(p)
 
         if not tmp_paths:
             raise HTTPException(400, "No valid files to process")
 
-        info = kb.ingest_files(gem_id, tmp_paths)
+        # парсинг, эмбеддинги и запись индекса — в пуле потоков, event loop не блокируем
+        info = await run_in_threadpool(
+            kb.ingest_files, gem_id, tmp_paths,
+            chunk_tokens=gem.chunk_tokens,
+            chunk_overlap=gem.chunk_overlap,
+            quantization=gem.quantization,
+            projection=gem.projection,
+            projection_dim=gem.projection_dim,
+            tags=[t.strip() for t in tags.split(",") if t.strip()],
+        )
 
         # если kb_search ещё не в инструментах — добавим
         if "kb_search" not in (gem.tools or []):
@@ -220,68 +366,370 @@ def list_agent_files(gem_id: str):
         raise HTTPException(404, "Gem not found")
     return {"files": kb.list_files(gem_id)}
 
+@app.delete("/gems/{gem_id}/files/{name}")
+def delete_agent_file(gem_id: str, name: str):
+    gem = store.get_gem(gem_id)
+    if not gem:
+        raise HTTPException(404, "Gem not found")
+    info = kb.delete_file(
+        gem_id, name, quantization=gem.quantization,
+        projection=gem.projection, projection_dim=gem.projection_dim,
+    )
+    if info is None:
+        raise HTTPException(404, "File not found")
+    return info
+
 @app.get("/gems/{gem_id}/kb/status")
 def kb_status(gem_id: str):
-    return kb.status(gem_id)
+    """configured — настройки gem, drift — поля, где индекс хранится в другом формате (нужен reindex)."""
+    gem = store.get_gem(gem_id)
+    out = kb.status(gem_id)
+    if gem:
+        out["configured"] = _index_settings(gem)
+        out["drift"] = kb.settings_drift(gem_id, out["configured"])
+    return out
+
+@app.get("/gems/{gem_id}/kb/quant_report")
+def kb_quant_report(gem_id: str, k: int = 10):
+    gem = store.get_gem(gem_id)
+    if not gem:
+        raise HTTPException(404, "Gem not found")
+    return {**kb.quant_report(gem_id, k=k), "configured": gem.quantization}
+
+@app.get("/gems/{gem_id}/kb/projection_report")
+def kb_projection_report(gem_id: str, k: int = 10, dims: str = "64,128,256,384,512"):
+    if not store.get_gem(gem_id):
+        raise HTTPException(404, "Gem not found")
+    try:
+        dim_list = [int(d) for d in dims.split(",") if d.strip()]
+    except ValueError:
+        raise HTTPException(400, "dims must be comma-separated integers")
+    return kb.projection_report(gem_id, dims=dim_list, k=k)
+
+@app.get("/kb/cache")
+def kb_cache_stats():
+    """Попадания/промахи кэшей эмбеддингов запросов, результатов поиска (см. qcache) и map-reduce выжимок."""
+    return {**qcache.stats(), "summaries": summarize.cache.stats()}
+
+@app.delete("/kb/cache")
+def kb_cache_clear():
+    qcache.clear()
+    summarize.cache.clear()
+    return {"cleared": True}
+
+@app.post("/gems/{gem_id}/summarize")
+def kb_summarize(gem_id: str, body: SummarizeRequest):
+    """Пересказ документа целиком или ответ на вопрос по нему: map-reduce по всем чанкам (см. summarize)."""
+    gem = store.get_gem(gem_id)
+    if not gem:
+        raise HTTPException(404, "Gem not found")
+    try:
+        return summarize.run(gem, source=body.source, question=body.question, max_words=body.max_words)
+    except KeyError:
+        raise HTTPException(404, f"Document not found: {body.source}")
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+
+@app.get("/routing/stats")
+def routing_stats(gem_id: Optional[str] = None):
+    """Решения маршрутизатора и задержка LLM по маршрутам small/large (см. routing)."""
+    return routing.stats(gem_id)
+
+@app.delete("/routing/stats")
+def routing_stats_reset():
+    routing.reset()
+    return {"cleared": True}
+
+@app.get("/gems/{gem_id}/sync")
+def kb_sync_status(gem_id: str):
+    if not store.get_gem(gem_id):
+        raise HTTPException(404, "Gem not found")
+    return sync.syncer.status(gem_id)
+
+@app.post("/gems/{gem_id}/sync")
+def kb_sync_now(gem_id: str):
+    """Внеочередной проход синхронизации каталога gem; ответ — отчёт о дельте."""
+    gem = store.get_gem(gem_id)
+    if not gem:
+        raise HTTPException(404, "Gem not found")
+    try:
+        return sync.syncer.run_once(gem)
+    except sync.SyncBusy as e:
+        raise HTTPException(409, str(e))
+    except (ValueError, FileNotFoundError) as e:
+        raise HTTPException(400, str(e))
+
+@app.get("/gems/{gem_id}/kb/export")
+def kb_export(gem_id: str, files: bool = True):
+    """Снапшот KB одним tar-потоком (см. kbarchive); files=false — без исходных файлов."""
+    if not store.get_gem(gem_id):
+        raise HTTPException(404, "Gem not found")
+    try:
+        meta, body = kbarchive.open_export(gem_id, include_files=files)
+    except FileNotFoundError as e:
+        raise HTTPException(404, str(e))
+    return StreamingResponse(body, media_type="application/x-tar", headers={
+        "Content-Disposition": f'attachment; filename="{gem_id}-kb-{meta["generation"]}.tar"',
+        "X-KB-Generation": str(meta["generation"]),
+    })
+
+@app.post("/gems/{gem_id}/kb/import")
+async def kb_import(gem_id: str, request: Request, force: bool = False):
+    """
+    Тело запроса — архив из /kb/export (tar или tar.gz). Сначала спулим его во временный файл,
+    распаковка и проверка идут в пуле потоков. force=true — принять векторы другой модели эмбеддингов.
+    """
+    gem = store.get_gem(gem_id)
+    if not gem:
+        raise HTTPException(404, "Gem not found")
+    with tempfile.TemporaryFile() as tmp:
+        async for chunk in request.stream():
+            tmp.write(chunk)
+        tmp.seek(0)
+        try:
+            info = await run_in_threadpool(kbarchive.import_archive, gem_id, tmp, force)
+        except kbarchive.EmbeddingMismatch as e:
+            raise HTTPException(409, str(e))
+        except ValueError as e:
+            raise HTTPException(400, str(e))
+    if "kb_search" not in (gem.tools or []):
+        store.update_gem(gem_id, {"tools": (gem.tools or []) + ["kb_search"]})
+    return info
+
+@app.post("/gems/{gem_id}/archive")
+async def kb_archive_upload(gem_id: str, request: Request, tags: str = ""):
+    """
+    Тело — zip или tar(.gz/.bz2/.xz) с документами. Ответ — NDJSON-поток событий по каждому члену (см. bulk);
+    весь архив индексируется одной сессией, новое поколение KB публикуется в конце.
+    """
+    gem = store.get_gem(gem_id)
+    if not gem:
+        raise HTTPException(404, "Gem not found")
+    # zip читается с конца (central directory), поэтому тело спулим в один временный файл; члены — из него в память
+    tmp = tempfile.TemporaryFile()
+    try:
+        async for chunk in request.stream():
+            tmp.write(chunk)
+        tmp.seek(0)
+        members = await run_in_threadpool(bulk.open_archive, tmp)
+    except ValueError as e:
+        tmp.close()
+        raise HTTPException(400, str(e))
+    except BaseException:
+        tmp.close()
+        raise
+    events = bulk.ingest_archive(gem, members, [t.strip() for t in tags.split(",") if t.strip()], on_close=tmp.close)
+    return StreamingResponse(
+        (json.dumps(ev, ensure_ascii=False) + "\n" for ev in events),
+        media_type="application/x-ndjson",
+    )
 
 # ---------- Chat ----------
 @app.post("/chat", response_model=ChatResponse)
 def chat(body: ChatRequest):
-    gem = store.get_gem(body.gem_id)
+    with tracing.span("gem"):
+        gem = store.get_gem(body.gem_id)
     if not gem:
         raise HTTPException(404, "Gem not found")
 
-    # 1) system + инструменты
-    sys = gem.system_prompt
-    if body.tools_mode == "auto" and gem.tools:
-        sys += "\n\n" + TOOLS_INSTRUCTION.format(tools=', '.join(gem.tools))
-
-    convo = [{"role": "system", "content": sys}]
-    for m in body.messages:
-        convo.append({"role": m.role, "content": m.content})
-
-    # 2) RAG-контекст на основе запроса пользователя
-    last_user = next((m.content for m in reversed(body.messages) if m.role == "user"), "")
-    if last_user and kb.has_index(gem.id):
-        snips = kb.query(gem.id, last_user, k=4)
-        ctx = kb.build_context(snips)
-        if ctx:
-            # даём как system, чтобы LLM опирался на факты
-            convo.append({"role": "system", "content": ctx})
-
-    # 3) первый ход модели
-    first = llm_chat(convo, temperature=gem.temperature, model_override=gem.model)
-
-    # 4) авто-вызов инструмента по JSON {"tool":"...","input":"..."}
-    used_tool: Optional[str] = None
-    tool_input: Optional[str] = None
-    if body.tools_mode == "auto" and gem.tools:
-        # ищем JSON с экранированными кавычками (часто так отвечает LLM)
-        tool_match = re.search(
-            r'\{\s*\\"tool\\"\s*:\s*\\"([^\\"]+)\\"\s*,\s*\\"input\\"\s*:\s*\\"([\s\S]*?)\\"\s*\}',
-            first
-        )
-        if tool_match:
-            tname = tool_match.group(1).strip()
-            tinp = tool_match.group(2).strip()
-            if tname in gem.tools:
-                used_tool = tname
-                tool_input = tinp
-                tool_result = run_tool(tname, tinp, gem_id=gem.id)
+    return agent.run_chat(body, gem)
 
-                # feed back: что сказал ассистент и что вернул инструмент
-                convo.append({"role": "assistant", "content": first})
-                convo.append({"role": "tool", "content": f"Tool {tname} result:\n{tool_result}"})
+class _LineFeed:
+    """
+    Строки тела запроса по мере прихода — для синхронного run_batch, который идёт в пуле потоков
+    StreamingResponse. Очередь ограничена: медленный батч притормаживает чтение тела, а не копит его в памяти.
+    """
 
-                final = llm_chat(convo, temperature=gem.temperature, model_override=gem.model)
-                return ChatResponse(content=final, used_tool=used_tool, tool_input=tool_input)
+    def __init__(self, request: Request, size: int = 64):
+        self._chunks = request.stream().__aiter__()
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self._tail = ""
+        self._q: "queue.Queue[Optional[List[str]]]" = queue.Queue(size)
+        self._closed = threading.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    async def _next_lines(self) -> Optional[List[str]]:
+        """Полные строки из следующего куска тела; None — тело кончилось."""
+        try:
+            chunk = await self._chunks.__anext__()
+        except StopAsyncIteration:
+            if self._tail is None:
+                return None
+            rest, self._tail = self._tail + self._decoder.decode(b"", final=True), None
+            return [rest]
+        lines = (self._tail + self._decoder.decode(chunk)).split("\n")
+        self._tail = lines.pop()
+        return lines
+
+    async def _put(self, item: Optional[List[str]]) -> None:
+        while not self._closed.is_set():
+            try:
+                self._q.put_nowait(item)
+                return
+            except queue.Full:
+                await asyncio.sleep(0.01)
+
+    async def start(self) -> bool:
+        """Читает тело до первой непустой строки и запускает подкачку остального; False — тело пустое."""
+        while True:
+            lines = await self._next_lines()
+            if lines is None:
+                return False
+            if lines:
+                await self._put(lines)
+            if any(line.strip() for line in lines):
+                self._task = asyncio.create_task(self._pump())
+                return True
+
+    async def _pump(self) -> None:
+        try:
+            while (lines := await self._next_lines()) is not None:
+                if lines:
+                    await self._put(lines)
+        except ClientDisconnect:
+            pass
+        finally:
+            await self._put(None)
+
+    def close(self) -> None:
+        self._closed.set()
+
+    def __iter__(self) -> Iterator[str]:
+        while True:
+            lines = self._q.get()
+            if lines is None:
+                return
+            yield from lines
+
+@app.post("/chat/batch")
+async def chat_batch(request: Request, concurrency: int = Query(batch.BATCH_CONCURRENCY, ge=1, le=64)):
+    """Тело — JSONL с ChatRequest; ответ — JSONL в порядке завершения. Работа начинается до конца загрузки тела."""
+    feed = _LineFeed(request)
+    if not await feed.start():
+        raise HTTPException(400, "Empty batch")
+
+    def body():
+        rows = batch.run_batch(batch.parse_jsonl(feed), concurrency)
+        try:
+            for r in rows:
+                yield json.dumps(r, ensure_ascii=False) + "\n"
+        finally:
+            # клиент ушёл: run_batch отменяет очередь, подкачка тела останавливается
+            feed.close()
+            rows.close()
+
+    return StreamingResponse(body(), media_type="application/x-ndjson")
+
+# ---------- WebSocket-чат ----------
+WS_HISTORY_MESSAGES = int(os.getenv("WS_HISTORY_MESSAGES", "40"))
+
+@app.websocket("/ws/chat/{gem_id}")
+async def ws_chat(ws: WebSocket, gem_id: str):
+    """
+    История диалога живёт на сервере, пока открыт сокет. Клиент шлёт:
+      {"type": "message", "content": "...", "tools_mode": "auto", "filters": {...}}
+      {"type": "cancel"} — прервать текущую генерацию; {"type": "reset"} — очистить историю.
+    Сервер стримит события agent.stream_chat: context, token, tool_call, tool_result, done/cancelled, error.
+    """
+    gem = store.get_gem(gem_id)
+    if not gem:
+        await ws.close(code=4404, reason="Gem not found")
+        return
+    await ws.accept()
+    loop = asyncio.get_running_loop()
+    history: List[Message] = []
+    turn: Optional[asyncio.Task] = None
+    cancel = threading.Event()
+    epoch = 0  # растёт на reset: ответ хода, начатого до сброса, в новую историю не попадает
+
+    async def _run_turn(tools_mode: str, filters: Optional[dict], cancel: threading.Event) -> None:
+        started = epoch
+        q: asyncio.Queue = asyncio.Queue()
+        cur = store.get_gem(gem_id) or gem  # правки gem подхватываются со следующего хода
+        messages = list(history)
+
+        def work():
+            try:
+                for ev in agent.stream_chat(messages, cur, tools_mode, filters, cancel):
+                    loop.call_soon_threadsafe(q.put_nowait, ev)
+            except Exception as e:
+                loop.call_soon_threadsafe(q.put_nowait, {"type": "error", "error": str(e)})
+            finally:
+                loop.call_soon_threadsafe(q.put_nowait, None)
+
+        fut = loop.run_in_executor(None, work)
+        while (ev := await q.get()) is not None:
+            if ev["type"] in ("done", "cancelled") and ev.get("content") and epoch == started:
+                history.append(Message(role="assistant", content=ev["content"]))
+            await ws.send_json(ev)
+        await fut
 
-    # 5) без инструмента — сразу отдаём ответ
-    return ChatResponse(content=first, used_tool=used_tool, tool_input=tool_input)
+    try:
+        while True:
+            msg = await ws.receive_json()
+            kind = msg.get("type", "message")
+            if kind == "cancel":
+                cancel.set()
+            elif kind == "reset":
+                if turn and not turn.done():
+                    cancel.set()
+                epoch += 1
+                history.clear()
+                await ws.send_json({"type": "reset"})
+            elif kind == "message":
+                if turn and not turn.done():
+                    await ws.send_json({"type": "error", "error": "Generation in progress; send cancel first"})
+                    continue
+                content = str(msg.get("content") or "").strip()
+                if not content:
+                    await ws.send_json({"type": "error", "error": "Empty message"})
+                    continue
+                try:
+                    filters = KBFilter.model_validate(msg["filters"]).model_dump() if msg.get("filters") else None
+                except ValidationError as e:
+                    await ws.send_json({"type": "error", "error": f"Invalid filters: {e}"})
+                    continue
+                tools_mode = "off" if msg.get("tools_mode") == "off" else "auto"
+                history.append(Message(role="user", content=content))
+                del history[:-WS_HISTORY_MESSAGES]
+                cancel = threading.Event()
+                turn = asyncio.create_task(_run_turn(tools_mode, filters, cancel))
+            else:
+                await ws.send_json({"type": "error", "error": f"Unknown message type: {kind}"})
+    except WebSocketDisconnect:
+        pass
+    finally:
+        # клиент ушёл — обрываем генерацию, чтобы модель не работала впустую
+        cancel.set()
+        if turn and not turn.done():
+            turn.cancel()
+
+# ---------- Debug (только с заголовком X-Debug-Token = DEBUG_TOKEN) ----------
+def _debug_guard(x_debug_token: Optional[str] = Header(None)):
+    if not profiler.DEBUG_TOKEN:
+        raise HTTPException(404, "Not Found")
+    if not x_debug_token or not secrets.compare_digest(x_debug_token, profiler.DEBUG_TOKEN):
+        raise HTTPException(403, "Invalid debug token")
+
+@app.get("/debug/profile", response_class=PlainTextResponse, dependencies=[Depends(_debug_guard)])
+def debug_profile(
+    seconds: float = Query(10.0, gt=0, le=profiler.MAX_PROFILE_S),
+    hz: int = Query(100, ge=1, le=1000),
+    idle: bool = False,
+):
+    """CPU-профиль воркера в формате collapsed stacks (flamegraph.pl, speedscope)."""
+    out = profiler.sample(seconds, hz, idle)
+    if out is None:
+        raise HTTPException(409, "Profile already in progress")
+    return PlainTextResponse(out, headers={"Content-Disposition": 'attachment; filename="profile.collapsed"'})
+
+@app.get("/debug/loop", dependencies=[Depends(_debug_guard)])
+async def debug_loop():
+    """Лаг event loop, загрузка пула потоков и стеки вызовов, блокировавших цикл."""
+    return {**profiler.monitor.report(), "threadpool": profiler.threadpool()}
 
 # --------- (необязательно) простая страница конструктора ---------
-@app.get("/manage", response_class=HTMLResponse)
-def manage():
+def _manage_html() -> str:
     return """
 <!doctype html><html><head>
 <meta charset="utf-8"/><meta name="viewport" content="width=device-width, initial-scale=1"/>
@@ -825,7 +1273,50 @@ async function uploadFiles() {
 }
 
 // Test agent functionality
+// Чат через WebSocket: история на сервере, токены стримятся, повторное нажатие — Stop
+let chatWs = null, chatWsAgent = null, chatBusy = false;
+
+function setChatBusy(busy) {
+  chatBusy = busy;
+  const btn = document.getElementById('sendTest');
+  btn.textContent = busy ? 'Stop' : 'Send';
+  if (busy) btn.disabled = false;
+}
+
+function chatSocket(agentId) {
+  if (chatWs && chatWsAgent === agentId && chatWs.readyState <= 1) return chatWs;
+  if (chatWs) chatWs.close();
+  const proto = location.protocol === 'https:' ? 'wss' : 'ws';
+  chatWs = new WebSocket(`${proto}://${location.host}${API}/ws/chat/${agentId}`);
+  chatWsAgent = agentId;
+  chatWs.onmessage = (e) => onChatEvent(JSON.parse(e.data));
+  chatWs.onclose = () => { chatWs = null; setChatBusy(false); };
+  return chatWs;
+}
+
+function onChatEvent(ev) {
+  const out = document.getElementById('testContent');
+  if (ev.type === 'token') {
+    out.append(ev.text);
+  } else if (ev.type === 'tool_call') {
+    const note = document.createElement('div');
+    note.className = 'my-3 p-2 bg-blue-50 rounded text-sm';
+    note.textContent = `Used tool: ${ev.tool} — input: ${ev.input}`;
+    out.append(note);
+  } else if (ev.type === 'done' || ev.type === 'cancelled') {
+    if (ev.type === 'cancelled') out.append(' [stopped]');
+    setChatBusy(false);
+  } else if (ev.type === 'error') {
+    showNotification('upOut', `Error: ${ev.error}`, 'error');
+    setChatBusy(false);
+  }
+}
+
 async function testAgent() {
+  if (chatBusy) {
+    if (chatWs) chatWs.send(JSON.stringify({ type: 'cancel' }));
+    return;
+  }
   const agentId = document.getElementById('testAgent').value;
   const message = document.getElementById('testMessage').value.trim();
   
@@ -835,34 +1326,14 @@ async function testAgent() {
   }
   
   try {
-    const response = await fetch(API + "/chat", {
-      method: "POST",
-      headers: { "Content-Type": "application/json" },
-      body: JSON.stringify({
-        gem_id: agentId,
-        messages: [{ role: "user", content: message }],
-        tools_mode: "auto"
-      })
-    });
-    
-    if (response.ok) {
-      const result = await response.json();
-      document.getElementById('testContent').textContent = result.content;
-      document.getElementById('testResponse').classList.remove('hidden');
-      
-      if (result.used_tool) {
-        document.getElementById('testContent').innerHTML += `
-          <div class="mt-3 p-2 bg-blue-50 rounded text-sm">
-            <strong>Used tool:</strong> ${result.used_tool}<br>
-            <strong>Input:</strong> ${result.tool_input}
-          </div>
-        `;
-      }
-    } else {
-      const error = await response.text();
-      showNotification('upOut', `Error: ${error}`, 'error');
-    }
+    const ws = chatSocket(agentId);
+    const send = () => ws.send(JSON.stringify({ type: 'message', content: message, tools_mode: 'auto' }));
+    document.getElementById('testContent').textContent = '';
+    document.getElementById('testResponse').classList.remove('hidden');
+    setChatBusy(true);
+    if (ws.readyState === WebSocket.OPEN) send(); else ws.addEventListener('open', send, { once: true });
   } catch (error) {
+    setChatBusy(false);
     showNotification('upOut', `Error: ${error.message}`, 'error');
   }
 }
@@ -883,11 +1354,11 @@ document.addEventListener('DOMContentLoaded', () => {
   
   // Test message input
   document.getElementById('testMessage').addEventListener('input', (e) => {
-    document.getElementById('sendTest').disabled = !e.target.value.trim() || !document.getElementById('testAgent').value;
+    document.getElementById('sendTest').disabled = !chatBusy && (!e.target.value.trim() || !document.getElementById('testAgent').value);
   });
   
   document.getElementById('testAgent').addEventListener('change', () => {
-    document.getElementById('sendTest').disabled = !document.getElementById('testMessage').value.trim() || !document.getElementById('testAgent').value;
+    document.getElementById('sendTest').disabled = !chatBusy && (!document.getElementById('testMessage').value.trim() || !document.getElementById('testAgent').value);
   });
   
   // Setup file upload
@@ -901,3 +1372,9 @@ document.addEventListener('DOMContentLoaded', () => {
 </script>
 </body></html>
     """
+
+_MANAGE = httpcache.Cached(_manage_html().encode("utf-8"), media_type="text/html; charset=utf-8")
+
+@app.get("/manage", response_class=HTMLResponse)
+def manage(request: Request):
+    return httpcache.respond(request, _MANAGE)
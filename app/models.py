@@ -1,8 +1,15 @@
+from datetime import datetime
 from typing import List, Literal, Optional
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, field_validator, model_validator
 
 Role = Literal["system", "user", "assistant", "tool"]
 
+def _check_chunking(model):
+    # перекрытие не меньше чанка — нарезка не продвигается; в GemUpdate проверяем, если заданы оба поля
+    if model.chunk_tokens is not None and model.chunk_overlap is not None and model.chunk_overlap >= model.chunk_tokens:
+        raise ValueError("chunk_overlap must be less than chunk_tokens")
+    return model
+
 class Message(BaseModel):
     role: Role
     content: str
@@ -14,6 +21,27 @@ class Gem(BaseModel):
     tools: List[str] = Field(default_factory=list)
     temperature: float = 0.2
     model: Optional[str] = None  # override default model if set
+    chunk_tokens: int = Field(400, gt=0)   # размер чанка KB в оценочных токенах
+    chunk_overlap: int = Field(60, ge=0)   # перекрытие соседних чанков, токены (< chunk_tokens)
+    context_tokens: int = 1200   # бюджет KB-контекста в промпте, токены
+    min_score: float = 0.0       # отсечка сниппетов по косинусу
+    quantization: Literal["none", "int8", "binary", "binary_f16"] = "none"  # формат индекса KB
+    projection: Literal["none", "pca", "truncate"] = "none"  # понижение размерности векторов KB
+    projection_dim: int = Field(256, gt=0)
+    source_dir: Optional[str] = None  # каталог внутри KB_SYNC_ROOT, синхронизируется в KB (см. sync)
+    routing: Literal["off", "auto"] = "off"  # auto — простые ходы в малую модель (см. routing)
+    small_model: Optional[str] = None        # малая модель; None — ROUTE_SMALL_MODEL / по бэкенду
+    version: int = 1             # растёт на каждом update_gem
+
+    @field_validator("small_model")
+    @classmethod
+    def blank_small_model(cls, v):
+        # "" из PUT — сброс на модель по умолчанию (None в патче означает "не менять")
+        return v or None
+
+    @model_validator(mode="after")
+    def check_chunking(self):
+        return _check_chunking(self)
 
 class GemCreate(BaseModel):
     name: str
@@ -21,6 +49,20 @@ class GemCreate(BaseModel):
     tools: List[str] = Field(default_factory=list)
     temperature: float = 0.2
     model: Optional[str] = None
+    chunk_tokens: int = Field(400, gt=0)
+    chunk_overlap: int = Field(60, ge=0)
+    context_tokens: int = 1200
+    min_score: float = 0.0
+    quantization: Literal["none", "int8", "binary", "binary_f16"] = "none"
+    projection: Literal["none", "pca", "truncate"] = "none"
+    projection_dim: int = Field(256, gt=0)
+    source_dir: Optional[str] = None
+    routing: Literal["off", "auto"] = "off"
+    small_model: Optional[str] = None
+
+    @model_validator(mode="after")
+    def check_chunking(self):
+        return _check_chunking(self)
 
 class GemUpdate(BaseModel):
     name: Optional[str] = None
@@ -28,11 +70,37 @@ class GemUpdate(BaseModel):
     tools: Optional[List[str]] = None
     temperature: Optional[float] = None
     model: Optional[str] = None
+    chunk_tokens: Optional[int] = Field(None, gt=0)
+    chunk_overlap: Optional[int] = Field(None, ge=0)
+    context_tokens: Optional[int] = None
+    min_score: Optional[float] = None
+    quantization: Optional[Literal["none", "int8", "binary", "binary_f16"]] = None
+    projection: Optional[Literal["none", "pca", "truncate"]] = None
+    projection_dim: Optional[int] = Field(None, gt=0)
+    source_dir: Optional[str] = None  # "" — отвязать каталог
+    routing: Optional[Literal["off", "auto"]] = None
+    small_model: Optional[str] = None  # "" — сбросить на ROUTE_SMALL_MODEL / по бэкенду
+
+    @model_validator(mode="after")
+    def check_chunking(self):
+        return _check_chunking(self)
+
+class KBFilter(BaseModel):
+    sources: Optional[List[str]] = None        # имена файлов (OR)
+    tags: Optional[List[str]] = None           # теги, заданные при загрузке (OR)
+    uploaded_from: Optional[datetime] = None
+    uploaded_to: Optional[datetime] = None
 
 class ChatRequest(BaseModel):
     gem_id: str
     messages: List[Message]
     tools_mode: Literal["off", "auto"] = "auto"
+    filters: Optional[KBFilter] = None  # ограничить RAG-поиск частью KB
+
+class SummarizeRequest(BaseModel):
+    source: Optional[str] = None     # файл KB; None — все документы gem
+    question: Optional[str] = None   # вопрос к документу целиком; None — пересказ
+    max_words: int = 300             # длина итогового пересказа
 
 class ChatResponse(BaseModel):
     content: str
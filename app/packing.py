@@ -0,0 +1,97 @@
+# app/packing.py
+"""
+Упаковка контекста между kb.query и build_context:
+- MMR: релевантность к запросу минус похожесть на уже выбранное;
+- соседние/перекрывающиеся чанки одного источника склеиваются в один сниппет;
+- набираем до бюджета токенов, а не фиксированные k.
+"""
+from __future__ import annotations
+from typing import Dict, List, TYPE_CHECKING
+
+from .chunker import estimate_tokens
+
+DEFAULT_CONTEXT_TOKENS = 1200
+DEFAULT_MIN_SCORE = 0.0
+MMR_LAMBDA = 0.7
+FETCH_K = 20
+
+if TYPE_CHECKING:
+    import numpy as np
+
+
+def mmr(sims: np.ndarray, vecs: np.ndarray, lambda_mult: float = MMR_LAMBDA, k: int = FETCH_K) -> List[int]:
+    """
+    sims — косинус кандидатов к запросу, vecs — их L2-нормированные векторы.
+    Возвращает индексы кандидатов в порядке выбора.
+    """
+    import numpy as np
+    n = len(sims)
+    if n == 0:
+        return []
+    k = min(k, n)
+    chosen: List[int] = [int(np.argmax(sims))]
+    # максимальная похожесть каждого кандидата на уже выбранные
+    max_red = vecs @ vecs[chosen[0]]
+    left = np.ones(n, dtype=bool)
+    left[chosen[0]] = False
+    while len(chosen) < k:
+        score = lambda_mult * sims - (1.0 - lambda_mult) * max_red
+        score[~left] = -np.inf
+        j = int(np.argmax(score))
+        chosen.append(j)
+        left[j] = False
+        max_red = np.maximum(max_red, vecs @ vecs[j])
+    return chosen
+
+
+def _stitch(a: str, b: str) -> str:
+    # b начинается с хвоста a (перекрытие чанкера) — склеиваем без дублей
+    for k in range(min(len(a), len(b)), 7, -1):
+        if a.endswith(b[:k]):
+            return a + b[k:]
+    return a + "\n\n" + b
+
+
+def _group_text(parts: Dict[int, str]) -> str:
+    order = sorted(parts)
+    text = parts[order[0]]
+    for prev, i in zip(order, order[1:]):
+        text = _stitch(text, parts[i]) if i == prev + 1 else text + "\n\n…\n\n" + parts[i]
+    return text
+
+
+def pack(cands: List[Dict], budget_tokens: int = DEFAULT_CONTEXT_TOKENS) -> List[Dict]:
+    """
+    cands — сниппеты {"text","source","i","score"} в порядке MMR.
+    Соседние чанки (i±1) одного источника сливаются в одну группу.
+    """
+    groups: List[Dict] = []
+    used = 0
+    for c in cands:
+        g = next(
+            (g for g in groups
+             if g["source"] == c["source"] and c.get("i") is not None
+             and any(j is not None and abs(c["i"] - j) <= 1 for j in g["parts"])),
+            None,
+        )
+        if g is not None:
+            parts = dict(g["parts"])
+            parts[c["i"]] = c["text"]
+            text = _group_text(parts)
+            delta = estimate_tokens(text) - g["tokens"]
+            if used + delta > budget_tokens:
+                continue
+            g.update(parts=parts, text=text, tokens=g["tokens"] + delta, score=max(g["score"], c["score"]))
+            used += delta
+            continue
+        t = estimate_tokens(c["text"])
+        if used + t > budget_tokens:
+            continue
+        groups.append({
+            "source": c["source"], "score": c["score"], "text": c["text"],
+            "tokens": t, "parts": {c.get("i"): c["text"]},
+        })
+        used += t
+
+    groups.sort(key=lambda g: -g["score"])
+    return [{"text": g["text"], "source": g["source"], "score": g["score"]} for g in groups]
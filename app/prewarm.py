@@ -0,0 +1,86 @@
+# app/prewarm.py
+"""
+Прогрев воркера после старта, чтобы p99 сразу после деплоя был как в установившемся режиме.
+- models: крошечная генерация + эмбеддинг на модель по умолчанию и модели горячих gem (с routing=auto — и малые)
+  (Ollama загружает модель и держит её OLLAMA_KEEP_ALIVE, Gemini/OpenAI — SDK и соединения);
+- indexes: индексы PREWARM_GEMS самых используемых gem (см. stats) поднимаются в кэш и page cache.
+Пока прогрев идёт, /health отвечает 503 — балансировщик не шлёт трафик на холодный воркер.
+
+PREWARM=models,indexes (по умолчанию) | models | indexes | off
+PREWARM_GEMS=5, PREWARM_MODELS=модель1,модель2 (дополнительно к модели по умолчанию)
+"""
+from __future__ import annotations
+import logging
+import os
+import threading
+import time
+from typing import Dict, List, Optional
+
+from . import stats, store, kb, llm, compiled
+
+log = logging.getLogger("uvicorn.error")
+
+PREWARM = {p.strip() for p in os.getenv("PREWARM", "models,indexes").lower().split(",") if p.strip()} - {"off", "0", "none"}
+PREWARM_GEMS = int(os.getenv("PREWARM_GEMS", "5"))
+PREWARM_MODELS = [m.strip() for m in os.getenv("PREWARM_MODELS", "").split(",") if m.strip()]
+
+_ready = threading.Event()
+_report: Dict = {"steps": {}, "errors": [], "ms": None}
+
+
+def is_ready() -> bool:
+    return _ready.is_set()
+
+
+def report() -> Dict:
+    return {"ready": is_ready(), "phases": sorted(PREWARM), **_report}
+
+
+def _step(name: str, fn) -> None:
+    t = time.perf_counter()
+    try:
+        res = fn()
+        if isinstance(res, dict):
+            _report["steps"].update(res)
+        else:
+            _report["steps"][name] = round((time.perf_counter() - t) * 1000, 1)
+    except Exception as e:
+        # прогрев не должен валить воркер: ошибка уходит в отчёт, готовность всё равно выставляется
+        _report["errors"].append(f"{name}: {e}")
+
+
+def run(gem_ids: Optional[List[str]] = None) -> Dict:
+    """Синхронный прогрев; lifespan запускает его в потоке."""
+    t0 = time.perf_counter()
+    try:
+        gems = {g.id: g for g in store.load_all()}
+        hot = [g for g in (gem_ids if gem_ids is not None else stats.top(PREWARM_GEMS)) if g in gems]
+        if "models" in PREWARM:
+            models: List[Optional[str]] = [None, *PREWARM_MODELS]
+            models += [gems[g].model for g in hot if gems[g].model]
+            models += [compiled.get(gems[g]).small_model for g in hot if gems[g].routing == "auto"]
+            for m in dict.fromkeys(models):
+                _step(f"model:{m or 'default'}", lambda m=m: llm.warmup(model_override=m))
+        if "indexes" in PREWARM:
+            for g in hot:
+                _step(f"index:{g}", lambda g=g: kb.preload(g, warm=True))
+    except Exception as e:
+        _report["errors"].append(str(e))
+    finally:
+        _report["ms"] = round((time.perf_counter() - t0) * 1000, 1)
+        _ready.set()
+    log.info(
+        "Prewarm: done in %.1f ms; %d steps, %d errors",
+        _report["ms"], len(_report["steps"]), len(_report["errors"]),
+    )
+    return report()
+
+
+def start() -> Optional[threading.Thread]:
+    """Запускает прогрев в фоне; без фаз — воркер готов сразу."""
+    if not PREWARM:
+        _ready.set()
+        return None
+    th = threading.Thread(target=run, name="prewarm", daemon=True)
+    th.start()
+    return th
@@ -0,0 +1,152 @@
+# app/profiler.py
+"""
+Диагностика живого воркера без перезапуска (эндпоинты /debug/*, закрыты DEBUG_TOKEN).
+- sample(seconds, hz): сэмплирующий CPU-профиль по sys._current_frames() всех потоков,
+  результат — collapsed stacks ("a;b;c N"), понятные flamegraph.pl / speedscope;
+- LoopMonitor: лаг event loop (тик asyncio.sleep против часов) и сторожевой поток,
+  который снимает стек потока цикла, если тот не отвечает дольше LOOP_BLOCK_MS;
+- threadpool(): загрузка пула anyio, в котором крутятся sync-хэндлеры.
+"""
+from __future__ import annotations
+import asyncio
+import collections
+import os
+import sys
+import threading
+import time
+import traceback
+from typing import Deque, Dict, List, Optional
+
+DEBUG_TOKEN = os.getenv("DEBUG_TOKEN", "")  # пусто — /debug/* выключены (404)
+LOOP_BLOCK_MS = float(os.getenv("LOOP_BLOCK_MS", "200"))
+LOOP_TICK_S = 0.05
+MAX_PROFILE_S = 60.0
+
+# листья стеков «спящих» потоков: при idle=False такие сэмплы не учитываются
+_IDLE_LEAVES = {
+    ("threading.py", "wait"), ("threading.py", "_wait_for_tstate_lock"), ("queue.py", "get"),
+    ("selectors.py", "select"), ("thread.py", "_worker"), ("socket.py", "accept"),
+}
+
+_profile_lock = threading.Lock()
+
+
+def _frame_label(f) -> str:
+    code = f.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{f.f_lineno})"
+
+
+def _stack(frame) -> List[str]:
+    out: List[str] = []
+    while frame is not None:
+        out.append(_frame_label(frame))
+        frame = frame.f_back
+    out.reverse()
+    return out
+
+
+def _is_idle(frame) -> bool:
+    return (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name) in _IDLE_LEAVES
+
+
+def sample(seconds: float = 10.0, hz: int = 100, idle: bool = False) -> Optional[str]:
+    """Collapsed stacks за seconds секунд; None — профиль уже снимается другим запросом."""
+    if not _profile_lock.acquire(blocking=False):
+        return None
+    try:
+        seconds = max(0.1, min(float(seconds), MAX_PROFILE_S))
+        interval = 1.0 / max(1, min(int(hz), 1000))
+        me = threading.get_ident()
+        counts: Dict[str, int] = collections.Counter()
+        end = time.perf_counter() + seconds
+        while time.perf_counter() < end:
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for tid, frame in sys._current_frames().items():
+                if tid == me or (not idle and _is_idle(frame)):
+                    continue
+                counts[";".join([names.get(tid, f"thread-{tid}"), *_stack(frame)])] += 1
+            time.sleep(interval)
+        return "".join(f"{stack} {n}\n" for stack, n in sorted(counts.items(), key=lambda kv: -kv[1]))
+    finally:
+        _profile_lock.release()
+
+
+class LoopMonitor:
+    """Лаг event loop и стеки блокировок; один экземпляр на воркер, стартует из lifespan."""
+
+    def __init__(self, block_ms: float = LOOP_BLOCK_MS, history: int = 1200):
+        self.block_ms = block_ms
+        self.lags: Deque[float] = collections.deque(maxlen=history)
+        self.blocks: Deque[Dict] = collections.deque(maxlen=20)
+        self._beat = time.perf_counter()
+        self._loop_tid: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stop = threading.Event()
+
+    async def _tick(self) -> None:
+        while True:
+            t = time.perf_counter()
+            await asyncio.sleep(LOOP_TICK_S)
+            now = time.perf_counter()
+            self.lags.append((now - t - LOOP_TICK_S) * 1000)
+            self._beat = now
+
+    def _watch(self) -> None:
+        # отдельный поток: пока цикл заблокирован, _beat не двигается — снимаем его стек один раз за эпизод
+        reported = 0.0
+        while not self._stop.wait(self.block_ms / 2000):
+            beat = self._beat
+            stalled = (time.perf_counter() - beat) * 1000
+            if stalled < self.block_ms or beat == reported:
+                continue
+            frame = sys._current_frames().get(self._loop_tid)
+            if frame is None:
+                continue
+            reported = beat
+            self.blocks.append({
+                "at": time.time(),
+                "stalled_ms": round(stalled, 1),
+                "stack": "".join(traceback.format_stack(frame)),
+            })
+
+    def start(self) -> None:
+        if self._task is not None:
+            return
+        self._loop_tid = threading.get_ident()
+        self._beat = time.perf_counter()
+        self._task = asyncio.get_running_loop().create_task(self._tick())
+        threading.Thread(target=self._watch, name="loop-watchdog", daemon=True).start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._task is not None:
+            self._task.cancel()
+
+    def report(self) -> Dict:
+        lags = sorted(self.lags)
+
+        def pct(p: float) -> float:
+            return round(lags[min(len(lags) - 1, int(p * len(lags)))], 2) if lags else 0.0
+
+        return {
+            "lag_ms": {"p50": pct(0.5), "p99": pct(0.99), "max": round(lags[-1], 2) if lags else 0.0,
+                       "samples": len(lags)},
+            "block_threshold_ms": self.block_ms,
+            "blocked": list(self.blocks),
+        }
+
+
+def threadpool() -> Dict:
+    """Загрузка пула потоков anyio (sync-эндпоинты, iterate_in_threadpool). Вызывать из event loop."""
+    import anyio.to_thread
+    lim = anyio.to_thread.current_default_thread_limiter()
+    st = lim.statistics()
+    return {
+        "total": lim.total_tokens,
+        "busy": st.borrowed_tokens,
+        "waiting": st.tasks_waiting,
+        "saturated": st.borrowed_tokens >= lim.total_tokens,
+    }
+
+
+monitor = LoopMonitor()
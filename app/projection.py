@@ -0,0 +1,124 @@
+# app/projection.py
+"""
+Понижение размерности векторов KB (настройка gem: projection + projection_dim).
+- none:     векторы хранятся во всю ширину бэкенда (768 / 1536 ...);
+- pca:      проекция на главные компоненты, обученная на векторах самой gem;
+- truncate: префикс первых projection_dim координат (для Matryoshka-моделей:
+            nomic-embed-text v1.5, text-embedding-3-*).
+Параметры проекции хранятся массивами рядом с индексом (proj_mean/proj_w или proj_trunc)
+и применяются одинаково к сохраняемым векторам и к запросам. Скоринг и память
+уменьшаются пропорционально projection_dim / исходная ширина.
+"""
+from __future__ import annotations
+import os
+import time
+from typing import Dict, List, Optional, Sequence
+import numpy as np
+
+from .quant import normalize
+
+KINDS = ("none", "pca", "truncate")
+KEYS = ("proj_mean", "proj_w", "proj_trunc")
+PCA_MIN_ROWS = int(os.getenv("KB_PCA_MIN_ROWS", "512"))  # меньше строк — PCA откладывается, храним полную ширину
+PCA_FIT_ROWS = 20000  # выборка для ковариации: PCA на всём индексе точнее не становится
+
+
+def params(arrays: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+    """Массивы проекции из набора массивов индекса ({} — проекции нет)."""
+    return {k: arrays[k] for k in KEYS if k in arrays}
+
+
+def kind_of(arrays: Dict[str, np.ndarray]) -> str:
+    if "proj_w" in arrays:
+        return "pca"
+    if "proj_trunc" in arrays:
+        return "truncate"
+    return "none"
+
+
+def out_dim(arrays: Dict[str, np.ndarray]) -> Optional[int]:
+    if "proj_w" in arrays:
+        return int(arrays["proj_w"].shape[1])
+    if "proj_trunc" in arrays:
+        return int(arrays["proj_trunc"])
+    return None
+
+
+def ready(kind: str, dim: int, n_rows: int, width: int) -> bool:
+    """Можно ли уже обучить проекцию: есть что сжимать и (для pca) хватает строк."""
+    if kind == "none" or dim >= width:
+        return False
+    return kind == "truncate" or n_rows >= max(PCA_MIN_ROWS, dim)
+
+
+def fit(vecs: np.ndarray, kind: str, dim: int, seed: int = 0) -> Dict[str, np.ndarray]:
+    if kind not in KINDS:
+        raise ValueError(f"Unknown projection: {kind}")
+    if kind == "none":
+        return {}
+    if kind == "truncate":
+        return {"proj_trunc": np.array(dim)}
+    # PCA через собственные векторы ковариации d x d: дешевле SVD матрицы n x d при n >> d
+    x = normalize(vecs)
+    if len(x) > PCA_FIT_ROWS:
+        x = x[np.random.default_rng(seed).choice(len(x), PCA_FIT_ROWS, replace=False)]
+    mean = x.mean(axis=0)
+    xc = x - mean
+    cov = (xc.T @ xc) / max(1, len(xc) - 1)
+    _, vectors = np.linalg.eigh(cov)  # по возрастанию собственных значений
+    w = vectors[:, ::-1][:, :dim]
+    return {"proj_mean": mean.astype(np.float32), "proj_w": np.ascontiguousarray(w, dtype=np.float32)}
+
+
+def apply(arrays: Dict[str, np.ndarray], vecs: np.ndarray) -> np.ndarray:
+    """Проецирует (n, d) или (d,); без параметров проекции — как есть. Нормировка — в quant."""
+    if "proj_w" in arrays:
+        return (normalize(vecs) - arrays["proj_mean"]) @ arrays["proj_w"]
+    if "proj_trunc" in arrays:
+        return np.asarray(vecs, dtype=np.float32)[..., :int(arrays["proj_trunc"])]
+    return vecs
+
+
+def report(
+    vecs: np.ndarray,
+    dims: Sequence[int] = (64, 128, 256, 384, 512),
+    k: int = 10,
+    n_queries: int = 100,
+    seed: int = 0,
+) -> List[Dict]:
+    """
+    Recall@k каждой проекции относительно точного поиска по полной ширине vecs,
+    память на вектор и время запроса. Запросы — строки индекса с небольшим шумом, как в quant.report.
+    """
+    base = normalize(vecs)
+    n, d = base.shape
+    if n == 0:
+        return []
+    rng = np.random.default_rng(seed)
+    qidx = rng.choice(n, size=min(n_queries, n), replace=False)
+    queries = normalize(base[qidx] + rng.normal(0, 0.05, size=(len(qidx), d)).astype(np.float32))
+    k = min(k, n)
+    exact = [set(np.argsort(-(base @ q))[:k].tolist()) for q in queries]
+
+    out = []
+    for kind in ("truncate", "pca"):
+        for dim in sorted({int(x) for x in dims if 0 < int(x) < d}):
+            p = fit(base, kind, dim, seed=seed)
+            stored = normalize(apply(p, base))
+            t0 = time.perf_counter()
+            hits = 0
+            for q, truth in zip(queries, exact):
+                top = np.argsort(-(stored @ normalize(apply(p, q))))[:k]
+                hits += len(truth.intersection(top.tolist()))
+            dt = (time.perf_counter() - t0) / len(queries)
+            out.append({
+                "projection": kind,
+                "dim": dim,
+                "bytes_per_vector": dim * 4,
+                "size_vs_full": round(dim / d, 4),
+                f"recall@{k}": round(hits / (k * len(queries)), 4),
+                "query_ms": round(dt * 1000, 3),
+                # PCA на малой выборке переобучается под неё: в индексе откладывается до KB_PCA_MIN_ROWS строк
+                "fit_deferred": kind == "pca" and not ready(kind, dim, n, d),
+            })
+    return out
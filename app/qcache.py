@@ -0,0 +1,118 @@
+# app/qcache.py
+"""
+Кэши перед kb.query / kb.retrieve, чтобы повторный вопрос (популярный или ретрай из UI) не ходил в сеть.
+- embeddings: (бэкенд, модель эмбеддингов, sha256 текста) -> вектор запроса;
+- results:    (gem, версия индекса, sha256 текста, параметры, фильтры) -> готовые сниппеты.
+Версия индекса — номер поколения (или подписи файлов плоского формата), поэтому любая запись
+в KB gem делает старые ключи недостижимыми; они вытесняются LRU или истекают по TTL.
+
+KB_QCACHE_EMBEDDINGS=4096, KB_QCACHE_RESULTS=2048 — размеры (0 — кэш выключен),
+KB_QCACHE_TTL=3600 — время жизни записи, секунды.
+"""
+from __future__ import annotations
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional
+
+from . import store
+
+KB_QCACHE_EMBEDDINGS = int(os.getenv("KB_QCACHE_EMBEDDINGS", "4096"))
+KB_QCACHE_RESULTS = int(os.getenv("KB_QCACHE_RESULTS", "2048"))
+KB_QCACHE_TTL = float(os.getenv("KB_QCACHE_TTL", "3600"))
+
+_MISSING = object()
+
+
+class TTLCache:
+    """LRU с ограничением по числу записей и времени жизни; потокобезопасный, со счётчиками."""
+
+    def __init__(self, size: int, ttl: float):
+        self.size = size
+        self.ttl = ttl
+        self._items: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = self.expired = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None:
+                if item[0] >= time.monotonic():
+                    self._items.move_to_end(key)
+                    self.hits += 1
+                    return item[1]
+                del self._items[key]
+                self.expired += 1
+            self.misses += 1
+            return default
+
+    def put(self, key: Hashable, value: Any) -> None:
+        if self.size <= 0:
+            return
+        with self._lock:
+            self._items[key] = (time.monotonic() + self.ttl, value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_build(self, key: Hashable, build: Callable[[], Any]) -> Any:
+        # build вне блокировки: параллельный промах по тому же ключу посчитает дважды, но не заблокирует других
+        val = self.get(key, _MISSING)
+        if val is _MISSING:
+            val = build()
+            self.put(key, val)
+        return val
+
+    def drop(self, pred: Callable[[Hashable], bool]) -> int:
+        with self._lock:
+            keys = [k for k in self._items if pred(k)]
+            for k in keys:
+                del self._items[k]
+        return len(keys)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._items.clear()
+
+    def stats(self) -> Dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._items), "max_size": self.size, "ttl_s": self.ttl,
+            "hits": self.hits, "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            "evictions": self.evictions, "expired": self.expired,
+        }
+
+
+embeddings = TTLCache(KB_QCACHE_EMBEDDINGS, KB_QCACHE_TTL)
+results = TTLCache(KB_QCACHE_RESULTS, KB_QCACHE_TTL)
+
+
+def text_key(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def filters_key(filters: Optional[Dict]) -> str:
+    return json.dumps(filters, sort_keys=True, default=str) if filters else ""
+
+
+def forget_gem(gem_id: str) -> int:
+    """Сбросить результаты gem: новое поколение индекса, правка или удаление gem."""
+    return results.drop(lambda k: k[0] == gem_id)
+
+
+def stats() -> Dict:
+    return {"embeddings": embeddings.stats(), "results": results.stats()}
+
+
+def clear() -> None:
+    embeddings.clear()
+    results.clear()
+
+
+store.on_change(forget_gem)
@@ -0,0 +1,223 @@
+# app/quant.py
+"""
+Квантованные варианты векторного индекса KB.
+- none:       float32 (векторы L2-нормированы при записи)
+- int8:       скалярная квантизация с масштабом на строку (~4x меньше float32): каждая строка
+              кодируется своим max|x|, так что дописанные позже пачки не обрезаются масштабом первой;
+              старые индексы с масштабом на измерение (q8_scale) читаются и переводятся в q8_row при записи
+- binary:     знаковые биты + Hamming, 32x меньше float32
+- binary_f16: binary-префильтр по Hamming + пересчёт шорт-листа по float16
+Каждый массив варианта — отдельный .npy в поколении индекса data/<gem>/idx/<gen>/ (читается mmap'ом);
+плоский index.npz старых индексов читается так же, float64 "vecs" до квантизации — как none (см. upgrade).
+"""
+from __future__ import annotations
+import os
+import time
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+
+KINDS = ("none", "int8", "binary", "binary_f16")
+SHORTLIST = int(os.getenv("KB_SHORTLIST", "200"))
+
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def normalize(vecs: np.ndarray) -> np.ndarray:
+    vecs = np.asarray(vecs, dtype=np.float32)
+    if vecs.ndim == 1:
+        return vecs / (np.linalg.norm(vecs) + 1e-8)
+    return vecs / (np.linalg.norm(vecs, axis=1, keepdims=True) + 1e-8)
+
+
+def encode(vecs: np.ndarray, kind: str = "none") -> Dict[str, np.ndarray]:
+    """Нормирует и кодирует матрицу (n, d) в набор массивов индекса (имя -> .npy)."""
+    if kind not in KINDS:
+        raise ValueError(f"Unknown quantization: {kind}")
+    v = normalize(vecs)
+    if kind == "none":
+        return {"vecs": v}
+    if kind == "int8":
+        scale = np.abs(v).max(axis=1) / 127.0 if v.size else np.ones(len(v), np.float32)
+        scale = np.where(scale > 0, scale, 1.0).astype(np.float32)
+        return {"q8": np.round(v / scale[:, None]).clip(-127, 127).astype(np.int8), "q8_row": scale}
+    out = {"bits": np.packbits(v > 0, axis=1), "dim": np.array(v.shape[1])}
+    if kind == "binary_f16":
+        out["f16"] = v.astype(np.float16)
+    return out
+
+
+def encode_like(arrays: Dict[str, np.ndarray], vecs: np.ndarray) -> Dict[str, np.ndarray]:
+    """Кодирует новые векторы в формате существующего индекса (масштаб int8 — свой у каждой строки)."""
+    return encode(vecs, kind_of(arrays))
+
+
+def upgrade(arrays: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+    # индексы до квантизации: float64 без нормировки
+    v = arrays.get("vecs")
+    if v is not None and v.dtype != np.float32 and v.size:
+        arrays = {**arrays, "vecs": normalize(v)}
+    # int8 с масштабом на измерение: перекодируем по строкам, иначе к нему не дописать новые строки
+    if "q8_scale" in arrays:
+        rest = {k: a for k, a in arrays.items() if k not in ("q8", "q8_scale")}
+        arrays = {**rest, **encode(decode(arrays, np.arange(size(arrays))), "int8")}
+    return arrays
+
+
+def kind_of(arrays: Dict[str, np.ndarray]) -> str:
+    if "q8" in arrays:
+        return "int8"
+    if "bits" in arrays:
+        return "binary_f16" if "f16" in arrays else "binary"
+    return "none"
+
+
+def size(arrays: Dict[str, np.ndarray]) -> int:
+    """Число строк индекса."""
+    for key in ("vecs", "q8", "bits"):
+        if key in arrays:
+            return 0 if arrays[key].size == 0 else int(arrays[key].shape[0])
+    return 0
+
+
+def nbytes(arrays: Dict[str, np.ndarray]) -> int:
+    return int(sum(a.nbytes for a in arrays.values()))
+
+
+def _hamming(bits: np.ndarray, qbits: np.ndarray) -> np.ndarray:
+    x = np.bitwise_xor(bits, qbits)
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(x).sum(axis=1, dtype=np.int32)
+    return _POPCOUNT[x].sum(axis=1, dtype=np.int32)
+
+
+_ROW_KEYS = ("vecs", "q8", "q8_row", "bits", "f16", "mh")  # mh — MinHash-сигнатуры строк (dedup)
+_SCORE_KEYS = {"none": ("vecs",), "int8": ("q8", "q8_row"), "binary": ("bits",), "binary_f16": ("bits", "f16")}
+
+
+def take(
+    arrays: Dict[str, np.ndarray], rows: np.ndarray, keys: Optional[Tuple[str, ...]] = None,
+) -> Dict[str, np.ndarray]:
+    """
+    Подматрица индекса по строкам (служебные массивы — как есть).
+    keys — копировать только эти построчные массивы (скорингу не нужны mh и т.п.); None — все.
+    """
+    return {
+        k: (v[rows] if k in _ROW_KEYS else v) for k, v in arrays.items()
+        if keys is None or k in keys or k not in _ROW_KEYS
+    }
+
+
+def concat(a: Dict[str, np.ndarray], b: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+    """Строки b дописываются к a; форматы должны совпадать."""
+    if kind_of(a) != kind_of(b):
+        raise ValueError(f"Index format mismatch: {kind_of(a)} vs {kind_of(b)}")
+    return {k: (np.concatenate([v, b[k]]) if k in _ROW_KEYS else v) for k, v in a.items()}
+
+
+def score(
+    arrays: Dict[str, np.ndarray],
+    qv: np.ndarray,
+    shortlist: int = SHORTLIST,
+    rows: Optional[np.ndarray] = None,
+    dead: Optional[np.ndarray] = None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Косинусы запроса к строкам индекса: (rows, sims).
+    Для none/int8 — все строки; для binary* — только шорт-лист по Hamming.
+    rows — ограничить скоринг этими строками (фильтры по метаданным): копируются только массивы скоринга.
+    dead — строки-надгробия: скоринг идёт по массивам как есть (mmap), они лишь исключаются из ответа.
+    """
+    kind = kind_of(arrays)
+    if rows is not None:
+        sub_rows, sims = score(take(arrays, rows, _SCORE_KEYS[kind]), qv, shortlist)
+        return rows[sub_rows], sims
+    q = normalize(qv)
+    if dead is not None and len(dead) and kind in ("none", "int8"):
+        all_rows, sims = score(arrays, q, shortlist)
+        keep = np.ones(len(sims), dtype=bool)
+        keep[dead] = False
+        return all_rows[keep], sims[keep]
+    if kind == "none":
+        v = arrays["vecs"]
+        return np.arange(len(v)), (v @ q.astype(v.dtype)).astype(np.float32)
+    if kind == "int8":
+        # масштаб строки — множитель её косинуса: sims = (codes @ q) * row_scale;
+        # у старых индексов масштаб на измерение переносим в запрос: sims = codes @ (q * scale)
+        row_scale = arrays.get("q8_row")
+        qs = q if row_scale is not None else q * arrays["q8_scale"]
+        codes = arrays["q8"]
+        sims = np.empty(len(codes), dtype=np.float32)
+        step = 2048  # блоки помещаются в кэш, без копии всей матрицы во float
+        for s in range(0, len(codes), step):
+            sims[s:s + step] = codes[s:s + step].astype(np.float32) @ qs
+        if row_scale is not None:
+            sims *= row_scale
+        return np.arange(len(codes)), sims
+
+    bits = arrays["bits"]
+    dim = int(arrays["dim"])
+    ham = _hamming(bits, np.packbits(q > 0))
+    if dead is not None and len(dead):
+        ham[dead] = dim + 1  # дальше любой живой строки; в шорт-лист попадают, только если живых не хватает
+    n = min(max(1, shortlist), len(bits))
+    rows = np.argpartition(ham, n - 1)[:n] if n < len(bits) else np.arange(len(bits))
+    if dead is not None and len(dead):
+        rows = rows[ham[rows] <= dim]
+    if kind == "binary_f16":
+        sims = arrays["f16"][rows].astype(np.float32) @ q
+    else:
+        # оценка косинуса по доле несовпавших знаков
+        sims = np.cos(np.pi * ham[rows] / dim).astype(np.float32)
+    return rows, sims
+
+
+def decode(arrays: Dict[str, np.ndarray], rows: np.ndarray) -> np.ndarray:
+    """Приближённые нормированные float32-векторы выбранных строк (для MMR и отчётов)."""
+    kind = kind_of(arrays)
+    if kind == "none":
+        return np.asarray(arrays["vecs"][rows], dtype=np.float32)
+    if kind == "int8":
+        scale = arrays["q8_row"][rows][:, None] if "q8_row" in arrays else arrays["q8_scale"]
+        return normalize(arrays["q8"][rows].astype(np.float32) * scale)
+    if kind == "binary_f16":
+        return normalize(arrays["f16"][rows].astype(np.float32))
+    dim = int(arrays["dim"])
+    signs = np.unpackbits(arrays["bits"][rows], axis=1)[:, :dim].astype(np.float32) * 2 - 1
+    return normalize(signs)
+
+
+def report(vecs: np.ndarray, k: int = 10, n_queries: int = 100, seed: int = 0) -> List[Dict]:
+    """
+    Точность/память по всем вариантам относительно точного float32-поиска.
+    Запросы — случайная выборка строк индекса с небольшим шумом.
+    """
+    base = normalize(vecs)
+    n, d = base.shape
+    if n == 0:
+        return []
+    rng = np.random.default_rng(seed)
+    qidx = rng.choice(n, size=min(n_queries, n), replace=False)
+    queries = normalize(base[qidx] + rng.normal(0, 0.05, size=(len(qidx), d)).astype(np.float32))
+    k = min(k, n)
+    exact = [set(np.argsort(-(base @ q))[:k].tolist()) for q in queries]
+
+    out = []
+    for kind in KINDS:
+        arrays = encode(base, kind)
+        t0 = time.perf_counter()
+        hits = 0
+        for q, truth in zip(queries, exact):
+            rows, sims = score(arrays, q, shortlist=max(SHORTLIST, k))
+            top = rows[np.argsort(-sims)[:k]]
+            hits += len(truth.intersection(top.tolist()))
+        dt = (time.perf_counter() - t0) / len(queries)
+        total = nbytes(arrays)
+        out.append({
+            "quantization": kind,
+            "bytes": total,
+            "bytes_per_vector": round(total / n, 2),
+            "compression_vs_float64": round(n * d * 8 / max(1, total), 2),
+            f"recall@{k}": round(hits / (k * len(queries)), 4),
+            "query_ms": round(dt * 1000, 3),
+        })
+    return out
@@ -0,0 +1,181 @@
+# app/routing.py
+"""
+Маршрутизация хода чата между быстрой малой моделью и основной моделью gem (настройка gem: routing).
+- routing="off" (по умолчанию) — всё идёт в gem.model, как раньше;
+- routing="auto" — дешёвый классификатор без LLM оценивает сложность хода и отправляет простые
+  ("Ответь одним словом: OK", приветствия, короткие вопросы без контекста) в small_model,
+  а длинные, многошаговые, с кодом, с найденными сниппетами KB или с инструментами — в большую модель;
+- пустой ответ малой модели или битый JSON вызова инструмента — повтор на большой (эскалация).
+Решения и задержка LLM по маршрутам копятся в памяти процесса: GET /routing/stats.
+
+Малая модель: gem.small_model, иначе ROUTE_SMALL_MODEL, иначе по бэкенду
+(OLLAMA_SMALL_MODEL=llama3.2:1b, OPENAI_SMALL_MODEL=gpt-4o-mini, GEMINI_SMALL_MODEL=gemini-2.0-flash-lite).
+ROUTE_THRESHOLD=1.0 — балл сложности, с которого ход уходит в большую модель.
+"""
+from __future__ import annotations
+import os
+import re
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Deque, Dict, List, Optional, Tuple
+
+from .chunker import estimate_tokens
+from .models import Gem
+
+ROUTE_THRESHOLD = float(os.getenv("ROUTE_THRESHOLD", "1.0"))
+ROUTE_SMALL_MODEL = os.getenv("ROUTE_SMALL_MODEL", "")
+ROUTE_SMALL_TOKENS = int(os.getenv("ROUTE_SMALL_TOKENS", "60"))  # длиннее — балл растёт
+ROUTE_SAMPLES = int(os.getenv("ROUTE_SAMPLES", "1000"))           # последних задержек на маршрут для перцентилей
+_SMALL_DEFAULTS = {
+    "ollama": os.getenv("OLLAMA_SMALL_MODEL", "llama3.2:1b"),
+    "openai": os.getenv("OPENAI_SMALL_MODEL", "gpt-4o-mini"),
+    "gemini": os.getenv("GEMINI_SMALL_MODEL", "gemini-2.0-flash-lite"),
+}
+
+SMALL, LARGE = "small", "large"
+
+# признаки сложного хода: рассуждение, сравнение, код, многошаговые задачи
+_HARD_RE = re.compile(
+    r"\b(почему|объясни|сравни|проанализируй|анализ|докажи|пошагов|обоснуй|оптимизируй|спроектируй|"
+    r"напиши\s+(код|функцию|скрипт|класс|программу)|рефактор|отладь|реализуй|"
+    r"why|explain|compare|analy[sz]e|prove|step[- ]by[- ]step|implement|refactor|debug|design|optimi[sz]e|"
+    r"write\s+(a\s+)?(code|function|script|class|program))",
+    re.IGNORECASE,
+)
+# признаки тривиального хода: короткий ответ по формату, приветствие, подтверждение
+_EASY_RE = re.compile(
+    r"(одним\s+словом|да\s+или\s+нет|коротко|кратко|^\s*(привет|здравствуй\w*|спасибо|ок|ok|да|нет)\b|"
+    r"one\s+word|yes\s+or\s+no|^\s*(hi|hello|hey|thanks|thank\s+you|ok|yes|no)\b)",
+    re.IGNORECASE,
+)
+_CODE_RE = re.compile(r"```|^\s{4,}\S|\b(def|class|function|SELECT|import)\b.*[:({]", re.MULTILINE)
+
+
+@dataclass(frozen=True)
+class Decision:
+    route: str                    # small | large
+    model: Optional[str]          # None — модель по умолчанию бэкенда
+    score: float
+    reasons: Tuple[str, ...]
+
+
+def small_model(gem: Gem, backend: str) -> Optional[str]:
+    """Малая модель gem; None — маршрутизация выключена или малой модели для бэкенда нет."""
+    if gem.routing != "auto":
+        return None
+    return gem.small_model or ROUTE_SMALL_MODEL or _SMALL_DEFAULTS.get(backend) or None
+
+
+def complexity(text: str, n_snippets: int = 0, tools: bool = False, turns: int = 1) -> Tuple[float, Tuple[str, ...]]:
+    """Балл сложности хода и его слагаемые (для метрик и отладки)."""
+    parts: List[Tuple[str, float]] = []
+    tokens = estimate_tokens(text)
+    if tokens > ROUTE_SMALL_TOKENS:
+        parts.append(("length", min(2.0, tokens / ROUTE_SMALL_TOKENS - 1 + 0.5)))
+    if _HARD_RE.search(text):
+        parts.append(("reasoning", 1.0))
+    if _CODE_RE.search(text):
+        parts.append(("code", 1.0))
+    if text.count("?") > 1:
+        parts.append(("multi_question", 0.5))
+    if n_snippets:
+        # ответ по найденным сниппетам — синтез из контекста, малой модели это даётся хуже
+        parts.append(("retrieval", 0.5 + 0.25 * min(n_snippets, 4)))
+    if tools:
+        parts.append(("tools", 0.5))  # протокол вызова инструмента малые модели нарушают чаще
+    if turns > 6:
+        parts.append(("history", 0.5))
+    if _EASY_RE.search(text):
+        parts.append(("easy_format", -1.0))
+    score = max(0.0, sum(w for _, w in parts))
+    return round(score, 3), tuple(name for name, _ in parts)
+
+
+def decide(
+    gem: Gem, backend: str, model: str, text: str, n_snippets: int = 0, tools: bool = False, turns: int = 1,
+) -> Decision:
+    small = small_model(gem, backend)
+    if small is None or small == model:
+        return Decision(LARGE, model, 0.0, ("off",))
+    score, reasons = complexity(text, n_snippets, tools, turns)
+    if score >= ROUTE_THRESHOLD:
+        return Decision(LARGE, model, score, reasons)
+    return Decision(SMALL, small, score, reasons)
+
+
+def needs_escalation(text: str, tools: bool, tool_called: bool) -> bool:
+    """Ответ малой модели, который не стоит отдавать: пустой или недоделанный вызов инструмента."""
+    stripped = text.strip()
+    return not stripped or (tools and not tool_called and stripped.startswith("{"))
+
+
+# ---------- метрики ----------
+
+class _Route:
+    __slots__ = ("count", "escalated", "ms")
+
+    def __init__(self):
+        self.count = 0
+        self.escalated = 0
+        self.ms: Deque[float] = deque(maxlen=ROUTE_SAMPLES)
+
+    def report(self) -> Dict:
+        ms = sorted(self.ms)
+
+        def pct(p: float) -> Optional[float]:
+            return round(ms[min(len(ms) - 1, int(p * len(ms)))], 1) if ms else None
+        return {
+            "count": self.count, "escalated": self.escalated,
+            "p50_ms": pct(0.5), "p95_ms": pct(0.95),
+            "mean_ms": round(sum(ms) / len(ms), 1) if ms else None,
+        }
+
+
+_lock = threading.Lock()
+_routes: Dict[Tuple[str, str], _Route] = {}  # (gem_id | "*", route) -> счётчики
+
+
+def record(gem_id: str, route: str, ms: float, escalated: bool = False) -> None:
+    """Ход завершён: route — где ответили (после эскалации — large), ms — время LLM-вызовов хода."""
+    with _lock:
+        for key in ((gem_id, route), ("*", route)):
+            r = _routes.get(key)
+            if r is None:
+                r = _routes[key] = _Route()
+            r.count += 1
+            r.escalated += escalated
+            r.ms.append(ms)
+
+
+class Timer:
+    """Суммарное время LLM-вызовов хода (без retrieval и инструментов)."""
+
+    def __init__(self):
+        self.ms = 0.0
+        self._t = 0.0
+
+    def __enter__(self):
+        self._t = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.ms += (time.perf_counter() - self._t) * 1000
+
+
+def stats(gem_id: Optional[str] = None) -> Dict:
+    with _lock:
+        items = list(_routes.items())
+    out: Dict[str, Dict] = {}
+    for (gid, route), r in items:
+        if gem_id is None or gid == gem_id:
+            out.setdefault("total" if gid == "*" else gid, {})[route] = r.report()
+    if gem_id is not None:
+        return out.get(gem_id, {})
+    return out
+
+
+def reset() -> None:
+    with _lock:
+        _routes.clear()
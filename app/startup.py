@@ -0,0 +1,105 @@
+# app/startup.py
+"""
+Время старта воркера.
+- with track_imports(): на время блока меряет импорты верхнего уровня (как -X importtime, но в процессе),
+  при выходе возвращает исходный builtins.__import__.
+- lazy(name): импорт тяжёлой зависимости при первом использовании, время первой загрузки тоже учитывается.
+- report()/log_report(): разбивка по импортам, логируется при старте.
+"""
+from __future__ import annotations
+import builtins
+import importlib
+import importlib.util
+import logging
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional
+
+log = logging.getLogger("uvicorn.error")
+
+_T0 = time.perf_counter()
+_orig_import = builtins.__import__
+_depth = 0
+_tracking = False
+_ready_at: Optional[float] = None
+
+_boot_imports: Dict[str, float] = {}  # модуль -> ms (только внешние импорты, без вложенных)
+_lazy_imports: Dict[str, float] = {}  # модуль -> ms первой ленивой загрузки
+_lazy_lock = threading.Lock()
+
+
+def _timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+    global _depth
+    if level == 0 and name in sys.modules:
+        return _orig_import(name, globals, locals, fromlist, level)
+    _depth += 1
+    t = time.perf_counter()
+    try:
+        return _orig_import(name, globals, locals, fromlist, level)
+    finally:
+        _depth -= 1
+        if _depth == 0:
+            key = _key(name, globals, fromlist, level)
+            _boot_imports[key] = _boot_imports.get(key, 0.0) + (time.perf_counter() - t) * 1000
+
+
+def _key(name, globals, fromlist, level) -> str:
+    if not level:
+        return name
+    base = importlib.util.resolve_name("." * level + name, (globals or {}).get("__package__") or "")
+    if not name and fromlist:
+        return ", ".join(f"{base}.{x}" for x in fromlist)
+    return base
+
+
+@contextmanager
+def track_imports() -> Iterator[None]:
+    """Перехват импортов только внутри блока: процесс после старта работает с исходным __import__."""
+    global _tracking, _orig_import
+    if _tracking:  # вложенный блок — перехват уже стоит
+        yield
+        return
+    _orig_import = builtins.__import__
+    builtins.__import__ = _timed_import
+    _tracking = True
+    try:
+        yield
+    finally:
+        builtins.__import__ = _orig_import
+        _tracking = False
+
+
+def finish() -> None:
+    """Фиксирует момент готовности приложения."""
+    global _ready_at
+    if _ready_at is None:
+        _ready_at = time.perf_counter()
+
+
+def lazy(name: str) -> Any:
+    """importlib.import_module с учётом времени первой загрузки."""
+    mod = sys.modules.get(name)
+    if mod is not None:
+        return mod
+    with _lazy_lock:
+        t = time.perf_counter()
+        mod = importlib.import_module(name)
+        _lazy_imports.setdefault(name, (time.perf_counter() - t) * 1000)
+    return mod
+
+
+def report(top: int = 15) -> Dict:
+    boot = sorted(((k, v) for k, v in _boot_imports.items() if v >= 0.1), key=lambda kv: -kv[1])
+    return {
+        "boot_ms": round(((_ready_at or time.perf_counter()) - _T0) * 1000, 1),
+        "imports_ms": {k: round(v, 1) for k, v in boot[:top]},
+        "lazy_imports_ms": {k: round(v, 1) for k, v in _lazy_imports.items()},
+    }
+
+
+def log_report() -> None:
+    r = report()
+    parts = ", ".join(f"{k}={v}ms" for k, v in r["imports_ms"].items())
+    log.info("Startup: ready in %.1f ms; imports: %s", r["boot_ms"], parts or "-")
@@ -0,0 +1,78 @@
+# app/stats.py
+"""
+Счётчики использования gem (чаты) — для прогрева самых используемых индексов при старте.
+- record(gem_id): инкремент в памяти процесса, сброс на диск не чаще раза в STATS_FLUSH_S секунд;
+- flush(): слияние дельт воркера с data/usage.json под flock (несколько воркеров пишут один файл);
+- top(n): самые используемые gem по сохранённым счётчикам + несброшенным дельтам.
+"""
+from __future__ import annotations
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - Windows
+    fcntl = None
+
+PATH = Path(__file__).resolve().parent.parent / "data" / "usage.json"
+STATS_FLUSH_S = float(os.getenv("STATS_FLUSH_S", "30"))
+
+_lock = threading.Lock()
+_pending: Dict[str, int] = {}
+_last_flush = time.monotonic()
+
+
+def _read() -> Dict[str, Dict]:
+    try:
+        data = json.loads(PATH.read_text(encoding="utf-8"))
+        return data if isinstance(data, dict) else {}
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def record(gem_id: str) -> None:
+    with _lock:
+        _pending[gem_id] = _pending.get(gem_id, 0) + 1
+        due = time.monotonic() - _last_flush >= STATS_FLUSH_S
+    if due:
+        flush()
+
+
+def flush() -> None:
+    global _last_flush
+    with _lock:
+        delta = dict(_pending)
+        _pending.clear()
+        _last_flush = time.monotonic()
+    if not delta:
+        return
+    PATH.parent.mkdir(parents=True, exist_ok=True)
+    with open(PATH.with_name(PATH.name + ".lock"), "a+b") as lk:
+        if fcntl is not None:
+            fcntl.flock(lk.fileno(), fcntl.LOCK_EX)
+        data = _read()
+        now = time.time()
+        for gem_id, n in delta.items():
+            row = data.setdefault(gem_id, {"chats": 0})
+            row["chats"] = row.get("chats", 0) + n
+            row["last"] = now
+        tmp = PATH.with_name(PATH.name + ".tmp")
+        tmp.write_text(json.dumps(data, ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp, PATH)
+
+
+def usage() -> Dict[str, int]:
+    counts = {k: int(v.get("chats", 0)) for k, v in _read().items()}
+    with _lock:
+        for gem_id, n in _pending.items():
+            counts[gem_id] = counts.get(gem_id, 0) + n
+    return counts
+
+
+def top(n: int) -> List[str]:
+    counts = usage()
+    return sorted(counts, key=lambda g: -counts[g])[:max(0, n)]
@@ -1,9 +1,41 @@
-import json, os, uuid
-from typing import List
+import base64, bisect, hashlib, json, os, threading, uuid
+from typing import Callable, Dict, List, Optional, Set, Tuple
 from .models import Gem
 
 DATA_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), "data", "gems.json")
 
+# gems.json перечитываем только при смене mtime/size (в т.ч. после записи другим воркером)
+_cache: Dict = {"sig": None, "etag": "", "gems": [], "by_id": {}, "hashes": {}}
+_cache_lock = threading.Lock()
+_listeners: List[Callable[[str], None]] = []
+
+def on_change(fn: Callable[[str], None]) -> None:
+    """fn(gem_id) вызывается после update_gem/delete_gem (сброс производных кэшей)."""
+    _listeners.append(fn)
+
+def _notify(gem_id: str) -> None:
+    for fn in _listeners:
+        fn(gem_id)
+
+def content_hash(gem: Gem) -> str:
+    """Хэш содержимого конфига gem (без version) — ключ для скомпилированных промптов и т.п."""
+    data = json.dumps(gem.model_dump(exclude={"version"}), sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()[:16]
+
+def gem_hash(gem: Gem) -> str:
+    # для объектов из кэша хэш уже посчитан при загрузке файла
+    h = _cache["hashes"].get(gem.id)
+    if h is not None and h[0] is gem:
+        return h[1]
+    return content_hash(gem)
+
+def _sig() -> Optional[Tuple[int, int, int]]:
+    try:
+        st = os.stat(DATA_PATH)
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+    except FileNotFoundError:
+        return None
+
 def _ensure_file():
     os.makedirs(os.path.dirname(DATA_PATH), exist_ok=True)
     needs_seed = False
@@ -58,15 +90,170 @@ def _ensure_file():
         with open(DATA_PATH, "w", encoding="utf-8") as f:
             json.dump(seed, f, ensure_ascii=False, indent=2)
 
+def _loaded() -> Dict:
+    # снимок целиком подменяется новым dict — читатели не видят его наполовину обновлённым
+    global _cache
+    sig = _sig()
+    if sig is not None and sig == _cache["sig"]:
+        return _cache
+    with _cache_lock:
+        _ensure_file()
+        sig = _sig()
+        if sig != _cache["sig"]:
+            with open(DATA_PATH, "rb") as f:
+                raw = f.read()
+            gems = [Gem(**x) for x in json.loads(raw)]
+            hashes = {g.id: (g, content_hash(g)) for g in gems}
+            _index.sync(_cache["hashes"], hashes)
+            _cache = {
+                "sig": sig, "etag": hashlib.sha256(raw).hexdigest()[:16],
+                "gems": gems, "by_id": {g.id: g for g in gems}, "hashes": hashes,
+            }
+    return _cache
+
+# ---------- индекс для постраничного списка и поиска ----------
+
+class _GemIndex:
+    """
+    Порядок (name.lower(), id) для курсоров + n-граммы имени (1..3) и имена инструментов для поиска.
+    Обновляется по разнице хэшей gem при перечитывании файла, а не пересобирается целиком.
+    """
+
+    def __init__(self) -> None:
+        self.order: List[Tuple[str, str]] = []
+        self.keys: Dict[str, Tuple[str, str]] = {}
+        self.grams: Dict[str, Set[str]] = {}
+        self.tools: Dict[str, Set[str]] = {}
+
+    @staticmethod
+    def _grams(name: str) -> Set[str]:
+        return {name[i:i + n] for n in (1, 2, 3) for i in range(len(name) - n + 1)}
+
+    def add(self, gem: Gem) -> None:
+        key = (gem.name.lower(), gem.id)
+        self.keys[gem.id] = key
+        bisect.insort(self.order, key)
+        for g in self._grams(key[0]):
+            self.grams.setdefault(g, set()).add(gem.id)
+        for t in gem.tools:
+            self.tools.setdefault(t.lower(), set()).add(gem.id)
+
+    def remove(self, gem: Gem) -> None:
+        key = self.keys.pop(gem.id, None)
+        if key is None:
+            return
+        i = bisect.bisect_left(self.order, key)
+        if i < len(self.order) and self.order[i] == key:
+            del self.order[i]
+        for g in self._grams(key[0]):
+            ids = self.grams.get(g)
+            if ids is not None:
+                ids.discard(gem.id)
+                if not ids:
+                    del self.grams[g]
+        for t in gem.tools:
+            ids = self.tools.get(t.lower())
+            if ids is not None:
+                ids.discard(gem.id)
+                if not ids:
+                    del self.tools[t.lower()]
+
+    def sync(self, old: Dict[str, Tuple[Gem, str]], new: Dict[str, Tuple[Gem, str]]) -> None:
+        for gem_id, (g, h) in old.items():
+            if gem_id not in new or new[gem_id][1] != h:
+                self.remove(g)
+        for gem_id, (g, h) in new.items():
+            if gem_id not in old or old[gem_id][1] != h:
+                self.add(g)
+
+    def match(self, q: str) -> Set[str]:
+        """id gem, у которых q — подстрока имени или имени одного из инструментов."""
+        q = q.lower()
+        if len(q) <= 3:
+            ids = set(self.grams.get(q, ()))
+        else:
+            grams = [self.grams.get(q[i:i + 3], set()) for i in range(len(q) - 2)]
+            ids = {i for i in min(grams, key=len) if q in self.keys[i][0]} if all(grams) else set()
+        for t, tids in self.tools.items():
+            if q in t:
+                ids |= tids
+        return ids
+
+    def page(self, after: Optional[Tuple[str, str]], limit: int, ids: Optional[Set[str]]):
+        """(ключи страницы, есть ли ещё). Без фильтра — O(log n + limit)."""
+        start = bisect.bisect_right(self.order, after) if after else 0
+        if ids is None:
+            keys = self.order[start:start + limit + 1]
+        elif len(ids) * 8 < len(self.order) - start:
+            # мало совпадений — сортируем только их
+            keys = sorted(k for k in (self.keys[i] for i in ids) if after is None or k > after)[:limit + 1]
+        else:
+            keys = []
+            for k in self.order[start:]:
+                if k[1] in ids:
+                    keys.append(k)
+                    if len(keys) > limit:
+                        break
+        return keys[:limit], len(keys) > limit
+
+
+_index = _GemIndex()
+
+def _encode_cursor(key: Tuple[str, str]) -> str:
+    return base64.urlsafe_b64encode(json.dumps(list(key), ensure_ascii=False).encode("utf-8")).decode("ascii").rstrip("=")
+
+def _decode_cursor(cursor: str) -> Tuple[str, str]:
+    try:
+        name, gem_id = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        return str(name), str(gem_id)
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+def search(
+    q: Optional[str] = None,
+    tool: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = 50,
+) -> Dict:
+    """
+    Страница gem по имени (без учёта регистра): {"etag", "gems", "next_cursor", "total"}.
+    q — подстрока имени или инструмента, tool — точное имя инструмента; курсор непрозрачный.
+    """
+    after = _decode_cursor(cursor) if cursor else None
+    c = _loaded()
+    with _cache_lock:
+        ids: Optional[Set[str]] = None
+        if q:
+            ids = _index.match(q)
+        if tool:
+            tids = _index.tools.get(tool.lower(), set())
+            ids = set(tids) if ids is None else ids & tids
+        keys, more = _index.page(after, limit, ids)
+        total = len(_index.order) if ids is None else len(ids)
+    gems = [c["by_id"][k[1]] for k in keys if k[1] in c["by_id"]]
+    return {
+        "etag": c["etag"], "gems": gems, "total": total,
+        "next_cursor": _encode_cursor(keys[-1]) if more and keys else None,
+    }
+
+def generation() -> str:
+    """Поколение хранилища — хэш gems.json; одинаково во всех воркерах, годится для ETag."""
+    return _loaded()["etag"]
+
+def snapshot() -> Tuple[str, List[Gem]]:
+    """(поколение, gems) из одного и того же чтения файла."""
+    c = _loaded()
+    return c["etag"], list(c["gems"])
+
 def load_all() -> List[Gem]:
-    _ensure_file()
-    with open(DATA_PATH, "r", encoding="utf-8") as f:
-        data = json.load(f)
-    return [Gem(**x) for x in data]
+    # модели общие с кэшем: их не меняют, а заменяют (см. update_gem)
+    return list(_loaded()["gems"])
 
 def save_all(gems: List[Gem]) -> None:
-    with open(DATA_PATH, "w", encoding="utf-8") as f:
+    tmp = DATA_PATH + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
         json.dump([g.model_dump() for g in gems], f, ensure_ascii=False, indent=2)
+    os.replace(tmp, DATA_PATH)
 
 def add_gem(gem: Gem) -> Gem:
     gems = load_all()
@@ -81,11 +268,13 @@ def update_gem(gem_id: str, patch: dict) -> Gem | None:
         if g.id == gem_id:
             data = g.model_dump()
             data.update({k: v for k, v in patch.items() if v is not None})
+            data["version"] = g.version + 1
             updated = Gem(**data)
             gems[i] = updated
             break
     if updated:
         save_all(gems)
+        _notify(gem_id)
     return updated
 
 def delete_gem(gem_id: str) -> bool:
@@ -94,13 +283,11 @@ def delete_gem(gem_id: str) -> bool:
     if len(new_gems) == len(gems):
         return False
     save_all(new_gems)
+    _notify(gem_id)
     return True
 
 def get_gem(gem_id: str) -> Gem | None:
-    for g in load_all():
-        if g.id == gem_id:
-            return g
-    return None
+    return _loaded()["by_id"].get(gem_id)
 
 def new_id() -> str:
     return str(uuid.uuid4())
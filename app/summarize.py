@@ -0,0 +1,169 @@
+# app/summarize.py
+"""
+Задачи по документу целиком (POST /gems/{id}/summarize, инструмент doc_summary): пересказ или ответ на вопрос
+по всем чанкам файла, а не по top-k сниппетам.
+- map:    каждый чанк — отдельный LLM-вызов (выжимка или "что здесь относится к вопросу"),
+          до SUMMARY_CONCURRENCY вызовов параллельно; результат кэшируется по хэшу чанка,
+          так что повторный пересказ или другой вопрос к тому же файлу ходит в LLM только за новым;
+- reduce: выжимки подряд склеиваются в группы до SUMMARY_REDUCE_TOKENS и сворачиваются параллельно,
+          уровень за уровнем, пока всё не поместится в один финальный вызов.
+Время ~ число чанков / SUMMARY_CONCURRENCY + log(число чанков) уровней reduce.
+Map идёт в малую модель gem, если включена маршрутизация (см. routing), reduce — в модель gem.
+
+SUMMARY_CONCURRENCY=4, SUMMARY_REDUCE_TOKENS=3000, SUMMARY_MAX_CHUNKS=5000,
+SUMMARY_CACHE=20000 записей, SUMMARY_CACHE_TTL=604800 секунд.
+"""
+from __future__ import annotations
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from . import compiled, kb, llm, tracing
+from .chunker import estimate_tokens
+from .models import Gem
+from .qcache import TTLCache, text_key
+
+SUMMARY_CONCURRENCY = int(os.getenv("SUMMARY_CONCURRENCY", "4"))
+SUMMARY_REDUCE_TOKENS = int(os.getenv("SUMMARY_REDUCE_TOKENS", "3000"))
+SUMMARY_MAX_CHUNKS = int(os.getenv("SUMMARY_MAX_CHUNKS", "5000"))
+PROMPT_VERSION = 1  # меняется вместе с промптами — старые записи кэша становятся недостижимыми
+
+cache = TTLCache(int(os.getenv("SUMMARY_CACHE", "20000")), float(os.getenv("SUMMARY_CACHE_TTL", "604800")))
+
+_NONE = "NONE"
+
+_MAP_SUMMARY = (
+    "You summarize one excerpt of a longer document. Write a dense summary of the excerpt in a few sentences: "
+    "keep facts, numbers, names, definitions and conclusions; no introductions. Answer in the language of the excerpt."
+)
+_MAP_QUESTION = (
+    "You read one excerpt of a longer document to help answer a question. Extract everything in the excerpt "
+    "that is relevant to the question (facts, numbers, quotes) as short notes. "
+    f"If nothing is relevant, reply with exactly {_NONE}.\n\nQuestion: {{question}}"
+)
+_REDUCE_SUMMARY = (
+    "Below are consecutive partial summaries of one document. Merge them into a single coherent summary "
+    "that keeps the important facts and the order of the document. No introductions."
+)
+_REDUCE_QUESTION = (
+    "Below are notes extracted from consecutive parts of a document for the question. Merge them into "
+    "one set of notes, dropping repetitions, keeping every relevant fact.\n\nQuestion: {question}"
+)
+_FINAL_SUMMARY = (
+    "Below are summaries of consecutive parts of {what}. Write the final summary of the whole text "
+    "in at most {max_words} words: main topic, key points and conclusions."
+)
+_FINAL_QUESTION = (
+    "Below are notes extracted from {what}. Answer the question using only these notes; "
+    "if they do not contain the answer, say so.\n\nQuestion: {question}"
+)
+
+
+def _call(system: str, text: str, model: Optional[str], backend: str, temperature: float) -> str:
+    convo = [{"role": "system", "content": system}, {"role": "user", "content": text}]
+    return llm.chat(convo, temperature=temperature, model_override=model, backend=backend).strip()
+
+
+def _cached_call(kind: str, key: str, system: str, text: str, model: Optional[str], backend: str,
+                 temperature: float) -> Tuple[str, bool]:
+    """(ответ, из кэша?); ключ — хэш входа, промпт и модель: другой вопрос или модель — другая запись."""
+    ck = (kind, PROMPT_VERSION, backend, model, text_key(system), key)
+    hit = cache.get(ck)
+    if hit is not None:
+        return hit, True
+    out = _call(system, text, model, backend, temperature)
+    cache.put(ck, out)
+    return out, False
+
+
+def _collect(futs, stats: Dict) -> List[str]:
+    out = []
+    for f in futs:
+        text, hit = f.result()
+        stats["cache_hits" if hit else "llm_calls"] += 1
+        out.append(text)
+    return out
+
+
+def _groups(parts: List[str], budget: int) -> List[List[str]]:
+    """Подряд идущие части в группы до budget токенов (минимум две части в группе, иначе reduce не сходится)."""
+    groups: List[List[str]] = [[]]
+    used = 0
+    for p in parts:
+        t = estimate_tokens(p)
+        if groups[-1] and used + t > budget and len(groups[-1]) > 1:
+            groups.append([])
+            used = 0
+        groups[-1].append(p)
+        used += t
+    return groups
+
+
+def run(
+    gem: Gem,
+    source: Optional[str] = None,
+    question: Optional[str] = None,
+    max_words: int = 300,
+    concurrency: int = SUMMARY_CONCURRENCY,
+) -> Dict:
+    """
+    Map-reduce по чанкам файла source (None — вся KB gem). question — ответ на вопрос вместо пересказа.
+    KeyError — файла нет в KB, ValueError — документ больше SUMMARY_MAX_CHUNKS чанков.
+    """
+    t0 = time.perf_counter()
+    cg = compiled.get(gem)
+    map_model = cg.small_model or cg.model
+    question = (question or "").strip() or None
+    what = f'the document "{source}"' if source else "the knowledge base documents"
+    stats = {"llm_calls": 0, "cache_hits": 0}
+
+    chunks = kb.document_chunks(gem.id, source)
+    if not chunks:
+        return {"source": source, "question": question, "content": "", "chunks": 0, "levels": 0, **stats, "ms": 0.0}
+    if len(chunks) > SUMMARY_MAX_CHUNKS:
+        raise ValueError(f"Document has {len(chunks)} chunks, limit is {SUMMARY_MAX_CHUNKS}")
+
+    map_sys = _MAP_QUESTION.format(question=question) if question else _MAP_SUMMARY
+    reduce_sys = _REDUCE_QUESTION.format(question=question) if question else _REDUCE_SUMMARY
+
+    with ThreadPoolExecutor(max(1, min(concurrency, len(chunks))), thread_name_prefix="summarize") as pool:
+        with tracing.span("summarize_map", chunks=len(chunks), model=map_model):
+            futs = [
+                pool.submit(tracing.bind(_cached_call), "map", c["hash"], map_sys, c["text"],
+                            map_model, cg.backend, 0.0)
+                for c in chunks
+            ]
+            parts = _collect(futs, stats)
+        if question:
+            parts = [p for p in parts if p and p.strip().upper().rstrip(".") != _NONE]
+
+        # reduce уровнями: каждый уровень — параллельные свёртки соседних групп
+        levels = 0
+        while len(parts) > 1 and sum(estimate_tokens(p) for p in parts) > SUMMARY_REDUCE_TOKENS:
+            groups = _groups(parts, SUMMARY_REDUCE_TOKENS)
+            levels += 1
+            with tracing.span("summarize_reduce", level=levels, groups=len(groups)):
+                futs = [
+                    pool.submit(tracing.bind(_cached_call), "reduce", text_key("\n\n".join(g)), reduce_sys,
+                                "\n\n---\n\n".join(g), cg.model, cg.backend, 0.0)
+                    for g in groups
+                ]
+                parts = _collect(futs, stats)
+
+    final_sys = (
+        _FINAL_QUESTION.format(what=what, question=question) if question
+        else _FINAL_SUMMARY.format(what=what, max_words=int(max_words))
+    )
+    body = "\n\n---\n\n".join(parts)
+    with tracing.span("summarize_final"):
+        if question and not parts:
+            content = "The document does not contain information relevant to the question."
+        else:
+            content, hit = _cached_call("final", text_key(body), final_sys, body, cg.model, cg.backend, gem.temperature)
+            stats["cache_hits" if hit else "llm_calls"] += 1
+    return {
+        "source": source, "question": question, "content": content,
+        "chunks": len(chunks), "levels": levels, **stats,
+        "ms": round((time.perf_counter() - t0) * 1000, 1),
+    }
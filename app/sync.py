@@ -0,0 +1,337 @@
+# app/sync.py
+"""
+Синхронизация KB gem с каталогом на диске (поле gem source_dir, путь внутри KB_SYNC_ROOT).
+- манифест data/<gem>/sync.json: относительный путь -> size, mtime_ns, sha256 и имя файла в KB;
+- проход: stat всех файлов; при совпавших size+mtime файл не читается, при изменившихся — читается
+  и хэшируется, и только реально изменённое содержимое уходит в kb.ingest_docs;
+  пропавшие файлы снимаются из KB в том же поколении (remove=...);
+- фоновый поток: раз в KB_SYNC_INTERVAL секунд, а с установленным watchdog — ещё и по событиям
+  inotify/FSEvents (с дебаунсом KB_SYNC_DEBOUNCE), чтобы ежедневное обновление стоило только дельту;
+- троттлинг: чтение не быстрее KB_SYNC_MBPS, пачки по KB_SYNC_BATCH файлов с паузой KB_SYNC_PAUSE
+  между ними — запись в KB берёт блокировку gem ненадолго, живые запросы не голодают;
+- несколько воркеров uvicorn: gem синхронизирует тот, кто взял flock на data/<gem>/sync.lock.
+
+KB_SYNC_ROOT пуст — привязка каталогов выключена (source_dir нельзя задать).
+"""
+from __future__ import annotations
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - Windows
+    fcntl = None
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:  # необязательно: без watchdog — только периодический проход
+    FileSystemEventHandler = object
+    Observer = None
+
+from . import kb, store
+from .models import Gem
+
+log = logging.getLogger("uvicorn.error")
+
+KB_SYNC_ROOT = os.getenv("KB_SYNC_ROOT", "")
+KB_SYNC_INTERVAL = float(os.getenv("KB_SYNC_INTERVAL", "300"))
+KB_SYNC_DEBOUNCE = float(os.getenv("KB_SYNC_DEBOUNCE", "2"))
+KB_SYNC_BATCH = int(os.getenv("KB_SYNC_BATCH", "16"))
+KB_SYNC_BATCH_MB = float(os.getenv("KB_SYNC_BATCH_MB", "32"))
+KB_SYNC_PAUSE = float(os.getenv("KB_SYNC_PAUSE", "0.5"))
+KB_SYNC_MBPS = float(os.getenv("KB_SYNC_MBPS", "50"))
+KB_SYNC_EXT = {
+    e.strip().lower() for e in os.getenv("KB_SYNC_EXT", kb.DOC_EXT).split(",")
+    if e.strip()
+}
+MANIFEST = "sync.json"
+
+
+class SyncBusy(RuntimeError):
+    """gem уже синхронизирует другой поток или воркер."""
+
+
+# ---------- каталоги и манифест ----------
+
+def resolve_dir(source_dir: str) -> Path:
+    """Абсолютный путь каталога gem; только внутри KB_SYNC_ROOT. ValueError — путь недопустим."""
+    if not KB_SYNC_ROOT:
+        raise ValueError("Directory sync is disabled: KB_SYNC_ROOT is not set")
+    root = Path(KB_SYNC_ROOT).resolve()
+    path = (root / source_dir).resolve()
+    if path != root and root not in path.parents:
+        raise ValueError(f"source_dir must be inside KB_SYNC_ROOT: {source_dir}")
+    return path
+
+
+def _manifest_path(gem_id: str) -> Path:
+    return kb.BASE / gem_id / MANIFEST
+
+
+def _read_manifest(gem_id: str) -> Dict[str, Dict]:
+    try:
+        return json.loads(_manifest_path(gem_id).read_text(encoding="utf-8")).get("files", {})
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def _write_manifest(gem_id: str, source: Path, files: Dict[str, Dict]) -> None:
+    path = _manifest_path(gem_id)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_text(json.dumps({"dir": str(source), "files": files}, ensure_ascii=False), encoding="utf-8")
+    os.replace(tmp, path)
+
+
+@contextmanager
+def _gem_lock(gem_id: str) -> Iterator[None]:
+    path = kb.BASE / gem_id / "sync.lock"
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "a+b") as fh:
+        if fcntl is not None:
+            try:
+                fcntl.flock(fh.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                raise SyncBusy(f"Gem {gem_id} is already syncing")
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(fh.fileno(), fcntl.LOCK_UN)
+
+
+def _scan(root: Path) -> Iterator[Tuple[str, Path, os.stat_result]]:
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(d for d in dirnames if not d.startswith("."))
+        for fn in sorted(filenames):
+            if fn.startswith(".") or Path(fn).suffix.lower() not in KB_SYNC_EXT:
+                continue
+            p = Path(dirpath) / fn
+            try:
+                st = p.stat()
+            except FileNotFoundError:  # удалили во время обхода
+                continue
+            yield p.relative_to(root).as_posix(), p, st
+
+
+class _Throttle:
+    """Ограничение скорости чтения: спим, если опережаем KB_SYNC_MBPS."""
+
+    def __init__(self, mbps: float):
+        self.rate = mbps * 1024 * 1024
+        self.t0 = time.monotonic()
+        self.read = 0
+
+    def __call__(self, nbytes: int) -> None:
+        if self.rate <= 0:
+            return
+        self.read += nbytes
+        ahead = self.read / self.rate - (time.monotonic() - self.t0)
+        if ahead > 0:
+            time.sleep(ahead)
+
+
+# ---------- проход синхронизации ----------
+
+def sync_gem(gem: Gem) -> Dict:
+    """
+    Один проход для gem: дельта каталога -> KB. Манифест сохраняется после каждой пачки,
+    так что прерванный проход продолжится с места остановки. SyncBusy — gem уже синхронизируется.
+    """
+    if not gem.source_dir:
+        raise ValueError("Gem has no source_dir")
+    root = resolve_dir(gem.source_dir)
+    if not root.is_dir():
+        raise FileNotFoundError(f"Source directory not found: {gem.source_dir}")
+    t0 = time.perf_counter()
+    report = {"scanned": 0, "unchanged": 0, "touched": 0, "ingested": [], "retired": [], "batches": 0}
+    with _gem_lock(gem.id):
+        old = _read_manifest(gem.id)
+        files: Dict[str, Dict] = {}
+        throttle = _Throttle(KB_SYNC_MBPS)
+        batch: List[Tuple[str, bytes, Dict]] = []
+        batch_bytes = 0
+
+        def flush(remove: List[str]) -> None:
+            nonlocal batch, batch_bytes
+            if not batch and not remove:
+                return
+            if report["batches"]:
+                time.sleep(KB_SYNC_PAUSE)  # окно для живых запросов между записями
+            info = kb.ingest_docs(
+                gem.id, [(e["name"], data) for _, data, e in batch],
+                chunk_tokens=gem.chunk_tokens, chunk_overlap=gem.chunk_overlap,
+                quantization=gem.quantization, projection=gem.projection, projection_dim=gem.projection_dim,
+                remove=remove,
+            )
+            for rel, _, entry in batch:
+                files[rel] = entry
+            report["ingested"] += [rel for rel, _, _ in batch]
+            report["retired"] += info.get("retired", [])
+            report["batches"] += 1
+            batch, batch_bytes = [], 0
+            _write_manifest(gem.id, root, {**old, **files})
+
+        for rel, path, st in _scan(root):
+            report["scanned"] += 1
+            prev = old.get(rel)
+            if prev and prev["size"] == st.st_size and prev["mtime_ns"] == st.st_mtime_ns:
+                files[rel] = prev
+                report["unchanged"] += 1
+                continue
+            try:
+                data = path.read_bytes()
+            except FileNotFoundError:
+                continue
+            throttle(len(data))
+            entry = {
+                "size": len(data), "mtime_ns": st.st_mtime_ns,
+                "sha256": hashlib.sha256(data).hexdigest(), "name": kb.flat_name(rel),
+            }
+            if prev and prev["sha256"] == entry["sha256"]:
+                files[rel] = entry  # touch без изменений: только обновляем mtime в манифесте
+                report["touched"] += 1
+                continue
+            batch.append((rel, data, entry))
+            batch_bytes += len(data)
+            if len(batch) >= KB_SYNC_BATCH or batch_bytes >= KB_SYNC_BATCH_MB * 1024 * 1024:
+                flush([])
+
+        pending = {rel for rel, _, _ in batch}
+        gone = [rel for rel in old if rel not in files and rel not in pending]
+        flush([old[rel]["name"] for rel in gone])
+        _write_manifest(gem.id, root, files)
+    if report["ingested"] and "kb_search" not in (gem.tools or []):
+        store.update_gem(gem.id, {"tools": (gem.tools or []) + ["kb_search"]})
+    report["ms"] = round((time.perf_counter() - t0) * 1000, 1)
+    return report
+
+
+# ---------- фоновый синхронизатор ----------
+
+class _Handler(FileSystemEventHandler):
+    def __init__(self, syncer: "Syncer", gem_id: str):
+        self.syncer = syncer
+        self.gem_id = gem_id
+
+    def on_any_event(self, event) -> None:
+        self.syncer.mark_dirty(self.gem_id)
+
+
+class Syncer:
+    """Один поток на воркер: проходит привязанные gem по расписанию и по событиям файловой системы."""
+
+    def __init__(self):
+        self.reports: Dict[str, Dict] = {}
+        self.changes: Dict[str, Dict] = {}  # последний проход, который что-то поменял в KB
+        self._dirty: Dict[str, float] = {}
+        self._last: Dict[str, float] = {}
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._observer = None
+        self._watches: Dict[str, Tuple[str, object]] = {}  # gem_id -> (каталог, watch)
+
+    def mark_dirty(self, gem_id: str) -> None:
+        self._dirty.setdefault(gem_id, time.monotonic())
+        self._wake.set()
+
+    def _on_gem_change(self, gem_id: str) -> None:
+        # правка gem могла привязать/сменить каталог — пересмотрим наблюдение и пройдём сразу
+        self._last.pop(gem_id, None)
+        self._wake.set()
+
+    def start(self) -> None:
+        if not KB_SYNC_ROOT or self._thread is not None:
+            return
+        if Observer is not None:
+            self._observer = Observer()
+            self._observer.daemon = True
+            self._observer.start()
+        store.on_change(self._on_gem_change)
+        self._thread = threading.Thread(target=self._run, name="kb-sync", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._wake.set()
+        if self._observer is not None:
+            self._observer.stop()
+
+    def run_once(self, gem: Gem) -> Dict:
+        try:
+            report = sync_gem(gem)
+            self.reports[gem.id] = {"at": time.time(), "ok": True, **report}
+            if report["ingested"] or report["retired"]:
+                self.changes[gem.id] = self.reports[gem.id]
+        except SyncBusy:
+            raise
+        except Exception as e:
+            self.reports[gem.id] = {"at": time.time(), "ok": False, "error": str(e)}
+            raise
+        finally:
+            self._last[gem.id] = time.monotonic()
+            self._dirty.pop(gem.id, None)
+        return self.reports[gem.id]
+
+    def _watch(self, gems: List[Gem]) -> None:
+        if self._observer is None:
+            return
+        want = {}
+        for g in gems:
+            try:
+                want[g.id] = str(resolve_dir(g.source_dir))
+            except ValueError:
+                continue
+        for gid, (path, watch) in list(self._watches.items()):
+            if want.get(gid) != path:
+                self._observer.unschedule(watch)
+                del self._watches[gid]
+        for gid, path in want.items():
+            if gid not in self._watches and os.path.isdir(path):
+                self._watches[gid] = (path, self._observer.schedule(_Handler(self, gid), path, recursive=True))
+
+    def _due(self, gem_id: str, now: float) -> bool:
+        dirty = self._dirty.get(gem_id)
+        if dirty is not None and now - dirty >= KB_SYNC_DEBOUNCE:
+            return True
+        last = self._last.get(gem_id)
+        return last is None or now - last >= KB_SYNC_INTERVAL
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            self._wake.clear()
+            gems = [g for g in store.load_all() if g.source_dir]
+            self._watch(gems)
+            for g in gems:
+                if self._stop.is_set():
+                    return
+                if not self._due(g.id, time.monotonic()):
+                    continue
+                try:
+                    self.run_once(g)
+                except SyncBusy:
+                    self._last[g.id] = time.monotonic()  # синхронизирует другой воркер
+                except Exception as e:
+                    log.warning("KB sync of gem %s failed: %s", g.id, e)
+            # спим до ближайшего срока: периодического прохода или дебаунса события
+            self._wake.wait(KB_SYNC_DEBOUNCE if self._dirty else min(KB_SYNC_INTERVAL, 60.0))
+
+    def status(self, gem_id: str) -> Dict:
+        return {
+            "enabled": bool(KB_SYNC_ROOT),
+            "watching": gem_id in self._watches,
+            "tracked_files": len(_read_manifest(gem_id)),
+            "last": self.reports.get(gem_id),
+            "last_change": self.changes.get(gem_id),
+        }
+
+
+syncer = Syncer()
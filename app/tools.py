@@ -1,6 +1,6 @@
-from typing import List
+from typing import List, Optional
 import ast, operator as op
-from duckduckgo_search import DDGS
+from . import startup, kb, store
 
 # Calculator (safe eval)
 _ALLOWED = {
@@ -37,6 +37,8 @@ def calculator(expr: str) -> str:
 #  Web search (DuckDuckGo)
 def web_search(query: str, max_results: int = 5) -> str:
     try:
+        # duckduckgo_search тянет много зависимостей — импортируем при первом поиске
+        DDGS = startup.lazy("duckduckgo_search").DDGS
         results = []
         with DDGS() as ddgs:
             for r in ddgs.text(query, max_results=max_results):
@@ -47,17 +49,55 @@ def web_search(query: str, max_results: int = 5) -> str:
     except Exception as e:
         return f"Search error: {e}"
 
+#  Knowledge base search (по KB текущей gem)
+def kb_search(query: str, gem_id: Optional[str] = None, k: int = 4) -> str:
+    if not gem_id:
+        return "KB search error: no gem context"
+    try:
+        snips = kb.query(gem_id, query, k=k)
+    except Exception as e:
+        return f"KB search error: {e}"
+    if not snips:
+        return "No results."
+    return "\n\n".join(f"[{i}] (src: {s['source']}) {s['text']}" for i, s in enumerate(snips, 1))
+
+#  Задачи по документу целиком (map-reduce по всем чанкам, см. summarize)
+def doc_summary(query: str, gem_id: Optional[str] = None) -> str:
+    """input: "<файл>" — пересказ файла, "<файл> | <вопрос>" — ответ по всему файлу, пусто — пересказ всей KB."""
+    if not gem_id:
+        return "Doc summary error: no gem context"
+    source, _, question = (query or "").partition("|")
+    source = source.strip() or None
+    if source and source not in kb.list_files(gem_id):
+        # вход — не имя файла: это вопрос ко всей KB
+        source, question = None, query
+    try:
+        gem = store.get_gem(gem_id)
+        res = startup.lazy(f"{__package__}.summarize").run(gem, source=source, question=question)
+    except KeyError as e:
+        return f"Doc summary error: unknown document {e}"
+    except Exception as e:
+        return f"Doc summary error: {e}"
+    return res["content"] or "No documents."
+
 # Registry
 TOOLS = {
     "calculator": calculator,
     "web_search": web_search,
+    "kb_search": kb_search,
+    "doc_summary": doc_summary,
 }
 
+# инструменты, которым нужен контекст gem (gem_id)
+_GEM_TOOLS = {"kb_search", "doc_summary"}
+
 def list_tools() -> List[str]:
     return sorted(TOOLS.keys())
 
-def run_tool(name: str, tool_input: str) -> str:
+def run_tool(name: str, tool_input: str, gem_id: Optional[str] = None) -> str:
     func = TOOLS.get(name)
     if not func:
         return f"Unknown tool: {name}"
+    if name in _GEM_TOOLS:
+        return func(tool_input, gem_id=gem_id)
     return func(tool_input)
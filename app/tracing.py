@@ -0,0 +1,237 @@
+# app/tracing.py
+"""
+Лёгкие спаны по стадиям запроса — чтобы понять, где именно застрял конкретный медленный чат.
+- span(name, **attrs): контекстный менеджер; вне запроса ничего не делает;
+- TracingMiddleware: trace на HTTP-запрос (request id из X-Request-ID или новый),
+  заголовки Server-Timing и X-Request-ID, JSON-лог со всеми спанами;
+- OTLP: если задан OTEL_EXPORTER_OTLP_ENDPOINT (например http://127.0.0.1:4318),
+  спаны уходят в коллектор по OTLP/HTTP JSON из фонового потока, без SDK OpenTelemetry.
+
+TRACE_LOG=1 — JSON-лог по каждому запросу; TRACE_LOG_MIN_MS — логировать только запросы не быстрее порога.
+"""
+from __future__ import annotations
+import contextvars
+import json
+import logging
+import os
+import queue
+import secrets
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional
+
+log = logging.getLogger("uvicorn.error")
+
+TRACE_LOG = os.getenv("TRACE_LOG", "1") not in ("0", "false", "off")
+TRACE_LOG_MIN_MS = float(os.getenv("TRACE_LOG_MIN_MS", "0"))
+OTLP_ENDPOINT = os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT", "").rstrip("/")
+SERVICE_NAME = os.getenv("OTEL_SERVICE_NAME", "gems-agent")
+
+
+class Trace:
+    def __init__(self, request_id: str, trace_id: Optional[str] = None, parent_id: Optional[str] = None):
+        self.request_id = request_id
+        self.trace_id = trace_id or secrets.token_hex(16)
+        self.root_id = secrets.token_hex(8)
+        self.parent_id = parent_id  # span вызывающего сервиса из traceparent
+        self.t0 = time.perf_counter()
+        self.wall0 = time.time_ns()
+        self.spans: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()  # спаны пишут и потоки пула
+
+    def add(self, span: Dict[str, Any]) -> None:
+        with self._lock:
+            self.spans.append(span)
+
+    def elapsed_ms(self) -> float:
+        return (time.perf_counter() - self.t0) * 1000
+
+    def server_timing(self) -> str:
+        """Одна запись на имя стадии: суммарная длительность и число вызовов."""
+        agg: Dict[str, List[float]] = {}
+        with self._lock:
+            for s in self.spans:
+                a = agg.setdefault(s["name"], [0.0, 0])
+                a[0] += s["dur_ms"]
+                a[1] += 1
+        parts = [
+            f'{name};dur={dur:.1f}' + (f';desc="{n}x"' if n > 1 else "")
+            for name, (dur, n) in agg.items()
+        ]
+        parts.append(f"total;dur={self.elapsed_ms():.1f}")
+        return ", ".join(parts)
+
+
+_current: contextvars.ContextVar[Optional[Trace]] = contextvars.ContextVar("trace", default=None)
+_parent: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("trace_parent", default=None)
+
+
+def current() -> Optional[Trace]:
+    return _current.get()
+
+
+@contextmanager
+def span(name: str, **attrs: Any) -> Iterator[Dict[str, Any]]:
+    """
+    Замер стадии. Возвращает dict атрибутов — в него можно дописать результат (например, n строк).
+    Вложенность — через contextvar, так что в OTLP спаны образуют дерево.
+    """
+    tr = _current.get()
+    if tr is None:
+        yield attrs
+        return
+    sid = secrets.token_hex(8)
+    parent = _parent.get() or tr.root_id
+    token = _parent.set(sid)
+    start = time.perf_counter()
+    try:
+        yield attrs
+    except BaseException as e:
+        attrs["error"] = type(e).__name__
+        raise
+    finally:
+        _parent.reset(token)
+        tr.add({
+            "name": name, "id": sid, "parent": parent,
+            "start_ms": round((start - tr.t0) * 1000, 2),
+            "dur_ms": round((time.perf_counter() - start) * 1000, 2),
+            "attrs": attrs,
+        })
+
+
+def bind(fn):
+    """Оборачивает fn для запуска в другом потоке (ThreadPoolExecutor) с текущим trace."""
+    ctx = contextvars.copy_context()
+    return lambda *a, **kw: ctx.run(fn, *a, **kw)
+
+
+def _parse_traceparent(value: str):
+    # W3C: 00-<trace_id 32hex>-<parent_id 16hex>-<flags>
+    parts = value.split("-")
+    if len(parts) == 4 and len(parts[1]) == 32 and len(parts[2]) == 16:
+        return parts[1], parts[2]
+    return None, None
+
+
+class TracingMiddleware:
+    """ASGI-middleware: trace на запрос; чистый ASGI, чтобы заголовки добавлялись и к стримам."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        headers = {k.decode("latin-1").lower(): v.decode("latin-1") for k, v in scope.get("headers", [])}
+        rid = headers.get("x-request-id") or secrets.token_hex(8)
+        trace_id, parent_id = _parse_traceparent(headers.get("traceparent", ""))
+        tr = Trace(rid, trace_id, parent_id)
+        token = _current.set(tr)
+        status = {"code": 500}
+
+        async def _send(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+                # у стримов Server-Timing содержит стадии до первого байта; полный список — в логе
+                message = {**message, "headers": [
+                    *message.get("headers", []),
+                    (b"x-request-id", rid.encode("latin-1")),
+                    (b"server-timing", tr.server_timing().encode("latin-1")),
+                ]}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, _send)
+        finally:
+            _current.reset(token)
+            _finish(tr, scope, status["code"])
+
+
+def _finish(tr: Trace, scope, status: int) -> None:
+    total = tr.elapsed_ms()
+    route = scope.get("route")
+    path = getattr(route, "path", None) or scope.get("path", "")
+    if TRACE_LOG and total >= TRACE_LOG_MIN_MS:
+        log.info(json.dumps({
+            "event": "request", "request_id": tr.request_id, "trace_id": tr.trace_id,
+            "method": scope.get("method"), "path": scope.get("path"), "route": path,
+            "status": status, "dur_ms": round(total, 2), "spans": tr.spans,
+        }, ensure_ascii=False, default=str))
+    if OTLP_ENDPOINT:
+        try:
+            _exporter().put_nowait((tr, f'{scope.get("method")} {path}', status, total))
+        except queue.Full:
+            pass
+
+
+# ---------- OTLP/HTTP JSON ----------
+
+def _attr(k: str, v: Any) -> Dict:
+    if isinstance(v, bool):
+        return {"key": k, "value": {"boolValue": v}}
+    if isinstance(v, int):
+        return {"key": k, "value": {"intValue": str(v)}}
+    if isinstance(v, float):
+        return {"key": k, "value": {"doubleValue": v}}
+    return {"key": k, "value": {"stringValue": str(v)}}
+
+
+def _otlp_spans(tr: Trace, name: str, status: int, total_ms: float) -> List[Dict]:
+    def ns(ms: float) -> str:
+        return str(tr.wall0 + int(ms * 1e6))
+
+    root = {
+        "traceId": tr.trace_id, "spanId": tr.root_id, "name": name, "kind": 2,
+        "startTimeUnixNano": ns(0), "endTimeUnixNano": ns(total_ms),
+        "attributes": [_attr("http.status_code", status), _attr("request.id", tr.request_id)],
+    }
+    if tr.parent_id:
+        root["parentSpanId"] = tr.parent_id
+    out = [root]
+    for s in tr.spans:
+        sp = {
+            "traceId": tr.trace_id, "spanId": s["id"], "parentSpanId": s["parent"], "name": s["name"], "kind": 1,
+            "startTimeUnixNano": ns(s["start_ms"]), "endTimeUnixNano": ns(s["start_ms"] + s["dur_ms"]),
+            "attributes": [_attr(k, v) for k, v in s["attrs"].items()],
+        }
+        if "error" in s["attrs"]:
+            sp["status"] = {"code": 2}
+        out.append(sp)
+    return out
+
+
+_queue: Optional["queue.Queue"] = None
+_queue_lock = threading.Lock()
+
+
+def _exporter() -> "queue.Queue":
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = queue.Queue(maxsize=1000)
+            threading.Thread(target=_export_loop, args=(_queue,), name="otlp-export", daemon=True).start()
+    return _queue
+
+
+def _export_loop(q: "queue.Queue") -> None:
+    import requests
+    url = f"{OTLP_ENDPOINT}/v1/traces"
+    while True:
+        batch = [q.get()]
+        while len(batch) < 64:
+            try:
+                batch.append(q.get_nowait())
+            except queue.Empty:
+                break
+        body = {"resourceSpans": [{
+            "resource": {"attributes": [_attr("service.name", SERVICE_NAME)]},
+            "scopeSpans": [{"scope": {"name": "app.tracing"}, "spans": [
+                sp for item in batch for sp in _otlp_spans(*item)
+            ]}],
+        }]}
+        try:
+            requests.post(url, json=body, timeout=5)
+        except Exception as e:
+            # коллектор недоступен — теряем батч, на запросы это не влияет
+            log.debug("OTLP export failed: %s", e)
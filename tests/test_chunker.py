@@ -0,0 +1,81 @@
+import re
+
+from app.chunker import chunk_text, estimate_tokens, iter_chunks
+
+
+def _sentences(n):
+    return [f"Sentence number {i} talks about topic {i % 7} briefly." for i in range(n)]
+
+
+def _sentence_ids(chunk):
+    return [int(x) for x in re.findall(r"Sentence number (\d+)", chunk)]
+
+
+def test_estimate_tokens():
+    assert estimate_tokens("") == 0
+    assert estimate_tokens("abcd" * 10) == 10
+    assert estimate_tokens("привет") == 3  # не-ASCII — ~2 символа на токен
+
+
+def test_chunks_fit_budget():
+    text = "\n\n".join(" ".join(_sentences(40)[i:i + 4]) for i in range(0, 40, 4))
+    for max_tokens in (30, 60, 200):
+        chunks = list(iter_chunks([text], max_tokens, 10))
+        assert chunks
+        assert all(estimate_tokens(c) <= max_tokens for c in chunks)
+
+
+def test_long_sentence_split_by_words():
+    text = " ".join(f"word{i}" for i in range(500))
+    chunks = chunk_text(text, 50, 0)
+    assert all(estimate_tokens(c) <= 50 for c in chunks)
+    assert " ".join(chunks).split() == text.split()
+
+
+def test_overlap_repeats_tail_sentences():
+    chunks = list(iter_chunks([" ".join(_sentences(60))], 60, 20))
+    assert len(chunks) > 3
+    for prev, nxt in zip(chunks, chunks[1:]):
+        a, b = _sentence_ids(prev), _sentence_ids(nxt)
+        # следующий чанк начинается с хвоста предыдущего и продолжает нумерацию без пропусков
+        assert b[0] == a[-1]
+        assert b == list(range(b[0], b[0] + len(b)))
+    assert _sentence_ids(chunks[-1])[-1] == 59
+
+
+def test_no_overlap():
+    chunks = list(iter_chunks([" ".join(_sentences(60))], 60, 0))
+    ids = [i for c in chunks for i in _sentence_ids(c)]
+    assert ids == list(range(60))
+
+
+def test_heading_opens_chunk():
+    chunks = chunk_text("# Title\n\nBody text here.\n\n# Second\n\nMore body.", 100, 20)
+    assert chunks == ["# Title\n\nBody text here.", "# Second\n\nMore body."]
+
+
+def test_streams_pages():
+    pages = iter(["First page text.", "", "Second page text."])
+    assert chunk_text("First page text.\n\nSecond page text.") == list(iter_chunks(pages))
+
+
+def test_numbered_list_is_content():
+    items = "\n\n".join(f"{i}. Step number {i} do this" for i in range(1, 400))
+    for text in (items, items + "\n\nFinal paragraph text."):
+        chunks = chunk_text(text, 400, 60)
+        assert all(estimate_tokens(c) <= 400 for c in chunks)
+        ids = {int(x) for c in chunks for x in re.findall(r"Step number (\d+)", c)}
+        assert ids == set(range(1, 400))
+    assert chunks[-1].endswith("Final paragraph text.")
+
+
+def test_long_heading_run_is_flushed():
+    text = "\n\n".join(f"SECTION {i}" for i in range(200))
+    chunks = chunk_text(text, 100, 20)
+    assert [int(x) for c in chunks for x in re.findall(r"SECTION (\d+)", c)] == list(range(200))
+    assert all(estimate_tokens(c) <= 100 for c in chunks)
+
+
+def test_trailing_heading_kept():
+    assert chunk_text("Intro text.\n\nSUMMARY") == ["Intro text.", "SUMMARY"]
+    assert chunk_text("2.1 Overview\n\nBody.") == ["2.1 Overview\n\nBody."]
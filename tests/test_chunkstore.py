@@ -0,0 +1,49 @@
+import pytest
+
+from app import chunkstore
+
+CHUNKS = [
+    {"text": "Первый чанк про кириллицу.", "source": "a.txt", "i": 0},
+    {"text": "Second chunk.", "source": "a.txt", "i": 1, "dups": {"b.txt": [0]}},
+    {"text": "", "source": "empty.md", "i": 0},
+    {"text": "Third file 🙂", "source": "c.pdf", "i": 7, "tags": ["x"], "uploaded_at": "2025-01-01T00:00:00"},
+]
+
+
+def test_round_trip(tmp_path):
+    path = tmp_path / "chunks.bin"
+    assert chunkstore.write(path, iter(CHUNKS)) == len(CHUNKS)
+    assert chunkstore.count(path) == len(CHUNKS)
+    cs = chunkstore.ChunkStore(path)
+    assert len(cs) == len(CHUNKS)
+    assert list(cs) == CHUNKS
+    assert cs[-1] == CHUNKS[-1]
+    assert cs.text(0) == CHUNKS[0]["text"]
+    assert cs.source(3) == "c.pdf"
+    assert cs.sources == ["a.txt", "empty.md", "c.pdf"]  # имена источников интернированы
+    with pytest.raises(IndexError):
+        cs[len(CHUNKS)]
+
+
+def test_empty_store(tmp_path):
+    path = tmp_path / "chunks.bin"
+    chunkstore.write(path, [])
+    assert chunkstore.count(path) == 0
+    assert list(chunkstore.ChunkStore(path)) == []
+
+
+def test_rewrite_is_atomic(tmp_path):
+    path = tmp_path / "chunks.bin"
+    chunkstore.write(path, CHUNKS)
+    chunkstore.write(path, CHUNKS[:1])
+    assert list(chunkstore.ChunkStore(path)) == CHUNKS[:1]
+    assert [p.name for p in tmp_path.iterdir()] == ["chunks.bin"]
+
+
+def test_rejects_foreign_file(tmp_path):
+    path = tmp_path / "meta.json"
+    path.write_bytes(b"[" + b" " * 64 + b"]")
+    with pytest.raises(ValueError):
+        chunkstore.count(path)
+    with pytest.raises(ValueError):
+        chunkstore.ChunkStore(path)
@@ -0,0 +1,55 @@
+import numpy as np
+
+from app import dedup
+
+WORDS = ("alpha beta gamma delta epsilon zeta eta theta iota kappa lambda mu nu xi omicron pi rho sigma tau "
+         "upsilon phi chi psi omega").split()
+
+
+def _text(seed, n=120):
+    rng = np.random.default_rng(seed)
+    return " ".join(rng.choice(WORDS, n))
+
+
+def _jaccard(a, b):
+    sa, sb = set(dedup._shingles(a).tolist()), set(dedup._shingles(b).tolist())
+    return len(sa & sb) / len(sa | sb)
+
+
+def test_signature_deterministic():
+    s = dedup.signature("The quick brown fox jumps over the lazy dog")
+    assert s.dtype == np.uint32 and s.shape == (dedup.NUM_PERM,)
+    assert np.array_equal(s, dedup.signature("the QUICK brown fox, jumps over the lazy dog!"))
+    assert dedup.signatures([]).shape == (0, dedup.NUM_PERM)
+
+
+def test_similarity_estimates_jaccard():
+    a = _text(1)
+    words = a.split()
+    b = " ".join(words[:100] + _text(2, 20).split())
+    est = dedup.similarity(dedup.signature(a), dedup.signature(b))
+    assert abs(est - _jaccard(a, b)) < 0.1
+    assert dedup.similarity(dedup.signature(a), dedup.signature(a)) == 1.0
+
+
+def test_lsh_finds_near_duplicate():
+    texts = [_text(i) for i in range(50)]
+    index = dedup.LSHIndex()
+    for row, sig in enumerate(dedup.signatures(texts)):
+        index.add(row, sig)
+    # одно слово заменено — почти дубликат строки 7
+    words = texts[7].split()
+    words[60] = "different"
+    assert index.find(dedup.signature(" ".join(words)), threshold=0.85) == 7
+    assert index.find(dedup.signature(_text(999)), threshold=0.85) is None
+
+
+def test_lsh_skips_removed_rows():
+    index = dedup.LSHIndex()
+    sig = dedup.signature(_text(5))
+    index.add(0, sig)
+    index.add(1, sig)
+    index.remove([0, 1])
+    assert index.find(sig) is None
+    index.add(2, sig)
+    assert index.find(sig) == 2
@@ -0,0 +1,105 @@
+import uuid
+
+import numpy as np
+import pytest
+
+from app import dedup, kb, llm, qcache, quant, summarize
+from app.models import Gem
+
+WORDS = ("river mountain forest city harbor engine silver garden window market lantern bridge "
+         "castle meadow signal planet copper violin orchard canyon").split()
+
+
+def _para(seed):
+    rng = np.random.default_rng(seed)
+    return " ".join(rng.choice(WORDS, 40)).capitalize() + "."
+
+
+P = [_para(i) for i in range(6)]
+OPTS = {"chunk_tokens": 90, "chunk_overlap": 0}  # один абзац — один чанк
+
+
+@pytest.fixture
+def gem_id(tmp_path, monkeypatch):
+    # локальный эмбеддер: без сети, детерминированный
+    monkeypatch.setattr(llm, "EMBED_BACKEND", "local")
+    monkeypatch.setattr(kb, "BASE", tmp_path)
+    monkeypatch.setattr(dedup, "DEDUP_MODE", "link")
+    qcache.clear()
+    return f"test-{uuid.uuid4().hex[:8]}"
+
+
+def _doc(*paras):
+    return "\n\n".join(paras).encode("utf-8")
+
+
+def _sources(gem_id, q, filters=None, k=10):
+    return [s["text"] for s in kb.query(gem_id, q, k=k, filters=filters)]
+
+
+def test_link_duplicates_found_by_source_and_tag(gem_id):
+    kb.ingest_docs(gem_id, [("a.txt", _doc(P[0], P[1], P[2]))], tags=["alpha"], **OPTS)
+    info = kb.ingest_docs(gem_id, [("b.txt", _doc(P[0], P[3], P[1]))], tags=["beta"], **OPTS)
+    assert info["dedup"]["linked"] == 2 and info["added"] == 1
+
+    # 2/3 файла b — дубликаты строк a: фильтр по b находит все три чанка
+    assert sorted(_sources(gem_id, P[0], {"sources": ["b.txt"]})) == sorted([P[0], P[1], P[3]])
+    assert sorted(_sources(gem_id, P[0], {"tags": ["beta"]})) == sorted([P[0], P[1], P[3]])
+    assert sorted(_sources(gem_id, P[0], {"sources": ["a.txt"]})) == sorted(P[:3])
+    # без фильтра дубликаты не размножаются
+    assert sorted(_sources(gem_id, P[0])) == sorted(P[:4])
+
+    chunks = kb.document_chunks(gem_id, "b.txt")
+    assert [(c["i"], c["text"]) for c in chunks] == [(0, P[0]), (1, P[3]), (2, P[1])]
+    assert len(kb.document_chunks(gem_id)) == 4
+
+
+def test_fully_linked_file_is_summarized(gem_id, monkeypatch):
+    kb.ingest_docs(gem_id, [("a.txt", _doc(P[0], P[1], P[2]))], **OPTS)
+    kb.ingest_docs(gem_id, [("copy.txt", _doc(P[0], P[1], P[2]))], **OPTS)
+    assert kb.status(gem_id)["chunks"] == 3
+    assert [c["text"] for c in kb.document_chunks(gem_id, "copy.txt")] == P[:3]
+
+    seen = []
+
+    def fake_call(system, text, model, backend, temperature):
+        seen.append(text)
+        return f"summary of {len(text)} chars"
+
+    monkeypatch.setattr(summarize, "_call", fake_call)
+    summarize.cache.clear()
+    out = summarize.run(Gem(id=gem_id, name="kb"), source="copy.txt")
+    assert out["chunks"] == 3 and out["content"].startswith("summary of")
+    assert sorted(seen[:3]) == sorted(P[:3])  # map — по каждому чанку файла (параллельно)
+
+
+def test_links_survive_original_delete_and_compaction(gem_id):
+    kb.ingest_docs(gem_id, [("a.txt", _doc(P[0], P[1], P[2], P[4], P[5]))], **OPTS)
+    kb.ingest_docs(gem_id, [("b.txt", _doc(P[0], P[3]))], **OPTS)
+    info = kb.delete_file(gem_id, "a.txt")
+    assert info["reingested"] == ["b.txt"] and info["compacted"]
+    assert [c["text"] for c in kb.document_chunks(gem_id, "b.txt")] == [P[0], P[3]]
+    assert sorted(_sources(gem_id, P[0], {"sources": ["b.txt"]})) == sorted([P[0], P[3]])
+
+
+@pytest.mark.parametrize("quantization", ["none", "int8", "binary", "binary_f16"])
+def test_search_after_delete_before_compaction(gem_id, monkeypatch, quantization):
+    monkeypatch.setattr(kb, "KB_COMPACT_RATIO", 0.9)
+    kb.ingest_docs(
+        gem_id, [("a.txt", _doc(P[0], P[1], P[2])), ("b.txt", _doc(P[3], P[4], P[5]))],
+        quantization=quantization, **OPTS,
+    )
+    info = kb.delete_file(gem_id, "a.txt")
+    assert info["removed"] == 3 and not info["compacted"]
+    st = kb.status(gem_id)
+    assert st["chunks"] == 3 and st["tombstones"] == 3
+    # без фильтра массивы поколения не копируются: надгробия только маскируются
+    take, copies = quant.take, []
+    monkeypatch.setattr(quant, "take", lambda *a, **kw: copies.append(kw.get("keys")) or take(*a, **kw))
+    assert sorted(_sources(gem_id, P[3])) == sorted(P[3:]) and copies == []
+    # удалённые строки не возвращаются ни без фильтра, ни с фильтром
+    for filters in (None, {"sources": ["a.txt", "b.txt"]}):
+        got = _sources(gem_id, P[0], filters)
+        assert sorted(got) == sorted(P[3:])
+    assert kb.query(gem_id, P[0], filters={"sources": ["a.txt"]}) == []
+    assert kb.query(gem_id, P[3], k=1)[0]["text"] == P[3]
@@ -0,0 +1,20 @@
+import pytest
+
+from app import llm
+
+
+@pytest.mark.parametrize("backend, expected", [
+    ("ollama", "ollama"),
+    ("OLLAMA-typo", "ollama"),
+    ("", "ollama"),
+])
+def test_unknown_embed_backend_falls_back_to_ollama(monkeypatch, backend, expected):
+    monkeypatch.setattr(llm, "EMBED_BACKEND", backend)
+    assert llm.embed_identity() == {"backend": expected, "model": llm.OLLAMA_EMBED_MODEL}
+
+
+def test_local_embed_identity(monkeypatch):
+    from app import local_embed
+    monkeypatch.setattr(llm, "EMBED_BACKEND", "local")
+    assert llm.embed_identity() == {"backend": "local", "model": local_embed.MODEL}
+    assert len(llm.embed(["привет"])[0]) == local_embed.DIM
@@ -0,0 +1,50 @@
+import subprocess
+import sys
+from pathlib import Path
+
+import numpy as np
+
+from app import local_embed
+
+TEXTS = [
+    "Как настроить квантизацию индекса базы знаний?",
+    "The quick brown fox jumps over the lazy dog.",
+    "",
+    "a",
+]
+
+
+def test_shape_and_norm():
+    v = local_embed.embed(TEXTS)
+    assert v.shape == (len(TEXTS), local_embed.DIM) and v.dtype == np.float32
+    np.testing.assert_allclose(np.linalg.norm(v[[0, 1, 3]], axis=1), 1.0, atol=1e-5)
+    assert not v[2].any()  # пустой текст — нулевой вектор
+    assert local_embed.embed([]).shape == (0, local_embed.DIM)
+
+
+def test_deterministic_and_batch_independent():
+    batch = local_embed.embed(TEXTS)
+    assert np.array_equal(batch, local_embed.embed(TEXTS))
+    # соседи по батчу не влияют на вектор текста
+    for i, t in enumerate(TEXTS):
+        np.testing.assert_allclose(local_embed.embed([t])[0], batch[i], atol=1e-6)
+
+
+def test_same_vectors_in_another_process():
+    code = (
+        "from app import local_embed; import sys; "
+        f"sys.stdout.write(local_embed.embed([{TEXTS[0]!r}])[0].tobytes().hex())"
+    )
+    out = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True,
+                         cwd=Path(__file__).resolve().parents[1]).stdout
+    other = np.frombuffer(bytes.fromhex(out), dtype=np.float32)
+    np.testing.assert_allclose(other, local_embed.embed([TEXTS[0]])[0], atol=1e-6)
+
+
+def test_similar_texts_closer():
+    q, near, far = local_embed.embed([
+        "how to configure index quantization",
+        "configure quantization of the index",
+        "recipe for chocolate cake with berries",
+    ])
+    assert q @ near > q @ far + 0.2
@@ -0,0 +1,56 @@
+import numpy as np
+
+from app.chunker import estimate_tokens
+from app.packing import _stitch, mmr, pack
+
+
+def _unit(rows):
+    v = np.asarray(rows, dtype=np.float32)
+    return v / np.linalg.norm(v, axis=1, keepdims=True)
+
+
+def test_mmr_prefers_diverse_candidates():
+    vecs = _unit([[1, 0, 0], [0.99, 0.14, 0], [0, 1, 0]])
+    sims = np.array([0.9, 0.89, 0.6], dtype=np.float32)
+    # второй кандидат почти копия первого — после лучшего выбирается непохожий третий
+    assert mmr(sims, vecs, lambda_mult=0.5, k=3) == [0, 2, 1]
+    # lambda=1 — чистая релевантность
+    assert mmr(sims, vecs, lambda_mult=1.0, k=3) == [0, 1, 2]
+
+
+def test_mmr_limits_and_empty():
+    vecs = _unit(np.eye(4))
+    sims = np.array([0.1, 0.4, 0.3, 0.2], dtype=np.float32)
+    assert mmr(sims, vecs, k=2) == [1, 2]
+    assert sorted(mmr(sims, vecs, k=10)) == [0, 1, 2, 3]
+    assert mmr(np.zeros(0), np.zeros((0, 4))) == []
+
+
+def test_stitch_merges_overlap():
+    a = "First sentence here. Shared tail sentence."
+    b = "Shared tail sentence. Next chunk text."
+    assert _stitch(a, b) == "First sentence here. Shared tail sentence. Next chunk text."
+
+
+def test_stitch_without_overlap():
+    assert _stitch("alpha beta gamma", "delta epsilon") == "alpha beta gamma\n\ndelta epsilon"
+    # совпадение короче 8 символов не считается перекрытием
+    assert _stitch("ends with abc", "abc starts") == "ends with abc\n\nabc starts"
+
+
+def test_pack_merges_neighbours_and_respects_budget():
+    cands = [
+        {"text": "Intro part. Overlap sentence.", "source": "a.txt", "i": 0, "score": 0.9},
+        {"text": "Other file text.", "source": "b.txt", "i": 5, "score": 0.8},
+        {"text": "Overlap sentence. Continuation.", "source": "a.txt", "i": 1, "score": 0.7},
+        {"text": "Far chunk of a.", "source": "a.txt", "i": 9, "score": 0.6},
+    ]
+    out = pack(cands, budget_tokens=1000)
+    assert [g["source"] for g in out] == ["a.txt", "b.txt", "a.txt"]
+    assert out[0]["text"] == "Intro part. Overlap sentence. Continuation."
+    assert out[0]["score"] == 0.9
+
+    budget = estimate_tokens(cands[0]["text"]) + estimate_tokens(cands[1]["text"])
+    small = pack(cands, budget_tokens=budget)
+    assert sum(estimate_tokens(g["text"]) for g in small) <= budget
+    assert [g["text"] for g in small] == [cands[0]["text"], cands[1]["text"]]
@@ -0,0 +1,77 @@
+import pytest
+
+from app import qcache
+from app.qcache import TTLCache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(qcache.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_lru_eviction(clock):
+    c = TTLCache(2, 60)
+    c.put("a", 1)
+    c.put("b", 2)
+    assert c.get("a") == 1  # "a" свежее "b"
+    c.put("c", 3)
+    assert c.get("b") is None
+    assert (c.get("a"), c.get("c")) == (1, 3)
+    s = c.stats()
+    assert (s["size"], s["evictions"], s["hits"], s["misses"]) == (2, 1, 3, 1)
+
+
+def test_ttl_expiry(clock):
+    c = TTLCache(10, 5)
+    c.put("k", "v")
+    clock[0] += 5
+    assert c.get("k") == "v"
+    clock[0] += 0.1
+    assert c.get("k", "gone") == "gone"
+    assert c.stats()["expired"] == 1 and c.stats()["size"] == 0
+    # повторная запись продлевает жизнь
+    c.put("k", "v2")
+    clock[0] += 4
+    c.put("k", "v3")
+    clock[0] += 4
+    assert c.get("k") == "v3"
+
+
+def test_get_or_build(clock):
+    c = TTLCache(10, 60)
+    calls = []
+
+    def build():
+        calls.append(1)
+        return None  # None тоже кэшируется: промах отличается от значения
+
+    assert c.get_or_build("k", build) is None
+    assert c.get_or_build("k", build) is None
+    assert len(calls) == 1
+
+
+def test_disabled_and_drop(clock):
+    off = TTLCache(0, 60)
+    off.put("k", 1)
+    assert off.get("k") is None
+    c = TTLCache(10, 60)
+    for key in (("g1", 1), ("g1", 2), ("g2", 1)):
+        c.put(key, key)
+    assert c.drop(lambda k: k[0] == "g1") == 2
+    assert c.get(("g2", 1)) == ("g2", 1) and c.stats()["size"] == 1
+
+
+def test_forget_gem(clock, monkeypatch):
+    monkeypatch.setattr(qcache, "results", TTLCache(10, 60))
+    qcache.results.put(("g1", "gen1", "q"), [1])
+    qcache.results.put(("g2", "gen1", "q"), [2])
+    assert qcache.forget_gem("g1") == 1
+    assert qcache.results.get(("g2", "gen1", "q")) == [2]
+
+
+def test_keys():
+    assert qcache.text_key("вопрос") == qcache.text_key("вопрос") != qcache.text_key("вопрос ")
+    assert qcache.filters_key(None) == ""
+    assert qcache.filters_key({"b": 1, "a": [2]}) == qcache.filters_key({"a": [2], "b": 1})
@@ -0,0 +1,133 @@
+import numpy as np
+import pytest
+
+from app import quant
+
+
+def _data(n=300, d=64, seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.normal(size=(n, d)).astype(np.float32)
+
+
+def _exact(vecs, q):
+    v, q = quant.normalize(vecs), quant.normalize(q)
+    return v @ q
+
+
+@pytest.mark.parametrize("kind", quant.KINDS)
+def test_encode_kind_and_size(kind):
+    arrays = quant.encode(_data(), kind)
+    assert quant.kind_of(arrays) == kind
+    assert quant.size(arrays) == 300
+
+
+def test_footprint():
+    vecs = _data()
+    none = quant.nbytes(quant.encode(vecs, "none"))
+    assert quant.nbytes(quant.encode(vecs, "int8")) < none / 3.5
+    assert quant.nbytes(quant.encode(vecs, "binary")) < none / 30
+
+
+def test_none_scores_exact_cosine():
+    vecs, q = _data(), _data(1, seed=1)[0]
+    rows, sims = quant.score(quant.encode(vecs, "none"), q)
+    assert np.array_equal(rows, np.arange(300))
+    np.testing.assert_allclose(sims, _exact(vecs, q), atol=1e-5)
+
+
+def test_int8_round_trip():
+    vecs, q = _data(), _data(1, seed=1)[0]
+    arrays = quant.encode(vecs, "int8")
+    rows, sims = quant.score(arrays, q)
+    np.testing.assert_allclose(sims, _exact(vecs, q), atol=0.02)
+    np.testing.assert_allclose(quant.decode(arrays, np.arange(5)), quant.normalize(vecs[:5]), atol=0.02)
+
+
+@pytest.mark.parametrize("kind", ["binary", "binary_f16"])
+def test_binary_finds_nearest(kind):
+    vecs = _data()
+    arrays = quant.encode(vecs, kind)
+    # запрос — строка индекса с шумом: её строка должна оказаться наверху
+    rng = np.random.default_rng(2)
+    for i in (3, 150, 299):
+        q = vecs[i] + rng.normal(0, 0.05, size=64).astype(np.float32)
+        rows, sims = quant.score(arrays, q, shortlist=20)
+        assert len(rows) == 20
+        assert rows[np.argmax(sims)] == i
+
+
+def test_binary_f16_rescoring_is_exact_on_shortlist():
+    vecs, q = _data(), _data(1, seed=1)[0]
+    rows, sims = quant.score(quant.encode(vecs, "binary_f16"), q, shortlist=50)
+    np.testing.assert_allclose(sims, _exact(vecs, q)[rows], atol=2e-3)
+
+
+@pytest.mark.parametrize("kind", quant.KINDS)
+def test_score_rows_subset(kind):
+    vecs = _data()
+    arrays = quant.encode(vecs, kind)
+    allowed = np.array([10, 20, 30, 40, 250])
+    q = vecs[30]
+    rows, sims = quant.score(arrays, q, shortlist=3, rows=allowed)
+    # номера строк — глобальные и только из разрешённых
+    assert set(rows.tolist()) <= set(allowed.tolist())
+    assert rows[np.argmax(sims)] == 30
+
+
+def test_int8_appends_keep_fidelity():
+    # первая пачка — один вектор, следующие — с другим диапазоном координат: масштаб первой их не обрежет
+    rng = np.random.default_rng(4)
+    first = _data(1, seed=5)
+    later = rng.normal(size=(299, 64)).astype(np.float32) * rng.uniform(0.1, 10, size=(299, 1))
+    later[:, :4] *= 20  # несколько «громких» измерений
+    arrays = quant.encode(first, "int8")
+    for batch in np.array_split(later, 5):
+        arrays = quant.concat(arrays, quant.encode_like(arrays, batch))
+    vecs = np.concatenate([first, later])
+    assert quant.size(arrays) == 300
+    cos = np.sum(quant.decode(arrays, np.arange(300)) * quant.normalize(vecs), axis=1)
+    assert cos.min() > 0.999
+    q = vecs[123] + rng.normal(0, 0.05, size=64).astype(np.float32)
+    rows, sims = quant.score(arrays, q)
+    exact = _exact(vecs, q)
+    np.testing.assert_allclose(sims, exact, atol=0.02)
+    assert set(np.argsort(-sims)[:10]) == set(np.argsort(-exact)[:10])
+    with pytest.raises(ValueError):
+        quant.concat(arrays, quant.encode(_data(10), "binary"))
+
+
+def test_upgrade_legacy_int8():
+    vecs = quant.normalize(_data())
+    scale = (np.abs(vecs).max(axis=0) / 127.0).astype(np.float32)
+    legacy = {"q8": np.round(vecs / scale).astype(np.int8), "q8_scale": scale, "mh": np.zeros((300, 2), np.uint32)}
+    q = _data(1, seed=1)[0]
+    np.testing.assert_allclose(quant.score(legacy, q)[1], _exact(vecs, q), atol=0.02)  # старый формат читается
+    up = quant.upgrade(legacy)
+    assert set(up) == {"q8", "q8_row", "mh"} and quant.kind_of(up) == "int8"
+    np.testing.assert_allclose(quant.score(up, q)[1], _exact(vecs, q), atol=0.02)
+    block = {**quant.encode_like(up, _data(3)), "mh": np.zeros((3, 2), np.uint32)}
+    assert quant.size(quant.concat(up, block)) == 303
+
+
+def test_unknown_kind():
+    with pytest.raises(ValueError):
+        quant.encode(_data(), "int4")
+
+
+@pytest.mark.parametrize("kind", quant.KINDS)
+def test_score_skips_dead_rows(kind):
+    vecs = _data()
+    arrays = quant.encode(vecs, kind)
+    dead = np.array([30, 31, 200])
+    rows, sims = quant.score(arrays, vecs[30], shortlist=10, dead=dead)
+    assert not set(rows.tolist()) & set(dead.tolist())
+    assert len(rows) == len(sims) == (10 if kind.startswith("binary") else 297)
+    all_dead = np.arange(300)
+    assert len(quant.score(arrays, vecs[0], dead=all_dead)[0]) == 0
+
+
+def test_take_keys_skips_unused_arrays():
+    arrays = {**quant.encode(_data(), "int8"), "mh": np.zeros((300, 128), dtype=np.uint32)}
+    sub = quant.take(arrays, np.array([1, 2]), keys=("q8", "q8_row"))
+    assert set(sub) == {"q8", "q8_row"} and len(sub["q8"]) == len(sub["q8_row"]) == 2
+    assert set(quant.take(arrays, np.array([1]))) == {"q8", "q8_row", "mh"}
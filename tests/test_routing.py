@@ -0,0 +1,78 @@
+import pytest
+
+from app import routing
+from app.models import Gem
+
+
+@pytest.fixture
+def gem():
+    return Gem(id="g", name="Router", routing="auto", small_model="tiny")
+
+
+def test_off_goes_to_gem_model():
+    d = routing.decide(Gem(id="g", name="Plain"), "ollama", "big", "Ответь одним словом: OK")
+    assert (d.route, d.model, d.reasons) == (routing.LARGE, "big", ("off",))
+
+
+def test_small_model_same_as_main(gem):
+    assert routing.decide(gem, "ollama", "tiny", "hi").route == routing.LARGE
+
+
+def test_simple_turns_go_small(gem):
+    for text in ("Ответь одним словом: OK", "Привет!", "What is the capital of France?", "ok"):
+        d = routing.decide(gem, "ollama", "big", text)
+        assert (d.route, d.model) == (routing.SMALL, "tiny"), text
+
+
+def test_hard_turns_go_large(gem):
+    cases = {
+        "Объясни, почему быстрая сортировка в среднем работает за n log n": "reasoning",
+        "```python\ndef f(x):\n    return x\n```\nwhat does it return": "code",
+        "word " * 200: "length",
+    }
+    for text, reason in cases.items():
+        d = routing.decide(gem, "ollama", "big", text)
+        assert (d.route, d.model) == (routing.LARGE, "big")
+        assert reason in d.reasons and d.score >= routing.ROUTE_THRESHOLD
+
+
+def test_context_raises_score(gem):
+    text = "When does the store open?"
+    assert routing.decide(gem, "ollama", "big", text).route == routing.SMALL
+    assert routing.decide(gem, "ollama", "big", text, n_snippets=3).route == routing.LARGE
+    d = routing.decide(gem, "ollama", "big", text, tools=True, turns=10)
+    assert d.route == routing.LARGE and {"tools", "history"} <= set(d.reasons)
+
+
+def test_small_model_fallbacks(monkeypatch):
+    monkeypatch.setattr(routing, "ROUTE_SMALL_MODEL", "")
+    g = Gem(id="g", name="Auto", routing="auto")
+    assert routing.small_model(g, "openai") == routing._SMALL_DEFAULTS["openai"]
+    assert routing.small_model(g, "unknown") is None
+    monkeypatch.setattr(routing, "ROUTE_SMALL_MODEL", "env-small")
+    assert routing.small_model(g, "openai") == "env-small"
+    assert routing.small_model(g.model_copy(update={"small_model": "own"}), "openai") == "own"
+
+
+@pytest.mark.parametrize("text, tools, called, expected", [
+    ("", False, False, True),
+    ("   \n", True, True, True),
+    ("Paris.", False, False, False),
+    ('{"tool": "kb_search", "input": ', True, False, True),   # недописанный вызов инструмента
+    ('{"tool": "kb_search", "input": "x"}', True, True, False),
+    ('{"answer": 1}', False, False, False),                  # JSON-ответ без инструментов — нормальный ответ
+])
+def test_needs_escalation(text, tools, called, expected):
+    assert routing.needs_escalation(text, tools, called) is expected
+
+
+def test_stats():
+    routing.reset()
+    routing.record("g", routing.SMALL, 10.0)
+    routing.record("g", routing.LARGE, 30.0, escalated=True)
+    routing.record("h", routing.SMALL, 20.0)
+    s = routing.stats()
+    assert s["total"]["small"]["count"] == 2 and s["total"]["large"]["escalated"] == 1
+    assert routing.stats("g")["small"]["p50_ms"] == 10.0
+    assert routing.stats("missing") == {}
+    routing.reset()
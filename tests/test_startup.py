@@ -0,0 +1,24 @@
+import builtins
+import sys
+
+import pytest
+
+from app import startup
+
+
+def test_track_imports_restores_import(monkeypatch):
+    orig = builtins.__import__
+    monkeypatch.delitem(sys.modules, "colorsys", raising=False)
+    with startup.track_imports():
+        assert builtins.__import__ is not orig
+        import colorsys  # noqa: F401
+    assert builtins.__import__ is orig
+    assert "colorsys" in startup._boot_imports
+
+
+def test_track_imports_restores_on_error():
+    orig = builtins.__import__
+    with pytest.raises(ImportError):
+        with startup.track_imports():
+            import no_such_module_xyz  # noqa: F401
+    assert builtins.__import__ is orig
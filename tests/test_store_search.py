@@ -0,0 +1,69 @@
+import pytest
+
+from app import store
+from app.models import Gem
+
+
+@pytest.fixture
+def gems(tmp_path, monkeypatch):
+    monkeypatch.setattr(store, "DATA_PATH", str(tmp_path / "gems.json"))
+    monkeypatch.setattr(store, "_cache", {"sig": None, "etag": "", "gems": [], "by_id": {}, "hashes": {}})
+    monkeypatch.setattr(store, "_index", store._GemIndex())
+    items = [
+        Gem(id=f"id{i:03d}", name=f"Gem {i:03d}", tools=["calculator"] if i % 3 == 0 else ["web_search"])
+        for i in range(100)
+    ]
+    items.append(Gem(id="dup-b", name="gem 050"))  # то же имя без учёта регистра — порядок по id
+    store.save_all(items)
+    return items
+
+
+def _walk(limit, **kw):
+    names, cursor, pages = [], None, 0
+    while True:
+        page = store.search(cursor=cursor, limit=limit, **kw)
+        names += [g.id for g in page["gems"]]
+        pages += 1
+        cursor = page["next_cursor"]
+        if cursor is None:
+            return names, pages
+
+
+def test_walk_all_pages(gems):
+    ids, pages = _walk(7)
+    expected = [g.id for g in sorted(gems, key=lambda g: (g.name.lower(), g.id))]
+    assert ids == expected and pages == 15
+    assert store.search(limit=500)["total"] == 101
+
+
+def test_cursor_stable_under_writes(gems):
+    first = store.search(limit=10)
+    seen = [g.id for g in first["gems"]]
+    # запись между страницами: новый gem до курсора, новый после, удалённый с уже отданной страницы
+    store.add_gem(Gem(id="early", name="Gem 000a"))
+    store.add_gem(Gem(id="late", name="Gem 050b"))
+    store.delete_gem(seen[3])
+    rest, cursor = [], first["next_cursor"]
+    while cursor:
+        page = store.search(cursor=cursor, limit=10)
+        rest += [g.id for g in page["gems"]]
+        cursor = page["next_cursor"]
+    assert not set(seen) & set(rest)
+    assert "early" not in rest and "late" in rest
+    assert len(seen) + len(rest) == 102
+
+
+@pytest.mark.parametrize("limit", [1, 4, 50])
+def test_filtered_pages(gems, limit):
+    # q по инструменту: много совпадений — проход по порядку; узкий q — сортировка только совпадений
+    ids, _ = _walk(limit, q="calc")
+    assert ids == [g.id for g in gems[:100] if g.id in {f"id{i:03d}" for i in range(0, 100, 3)}]
+    ids, _ = _walk(limit, q="gem 05")
+    assert ids == ["dup-b", "id050", "id051", "id052", "id053", "id054", "id055", "id056", "id057", "id058", "id059"]
+    ids, _ = _walk(limit, q="gem 05", tool="web_search")
+    assert "id051" not in ids and "dup-b" not in ids and "id050" in ids
+
+
+def test_invalid_cursor(gems):
+    with pytest.raises(ValueError):
+        store.search(cursor="not-a-cursor")